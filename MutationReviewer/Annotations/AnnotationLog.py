@@ -0,0 +1,543 @@
+"""
+Append-only log of annotation events in SQLite (WAL mode). Each submitted annotation is one small transaction
+appending the event and updating a materialised table of the current annotations, so saving takes the same time
+at the start and the end of a review. The full data pickle is only rewritten by a background compaction,
+and events newer than the pickle are replayed from the log when the review is reopened.
+
+Several reviewers can share one log, each running their own app: writes are serialised by SQLite, 
+reviewers lease shards of unannotated mutations, annotations from the other reviewers are synced in the background, 
+and annotating a mutation someone else annotated since it was loaded is recorded as a conflict.
+"""
+import os
+import json
+import pickle
+import sqlite3
+import threading
+import time
+import warnings
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from typing import Dict, Tuple, Union
+from pathlib import Path
+
+from AnnoMate.ReviewDataInterface import ReviewDataInterface
+from AnnoMate.Data import Data
+from AnnoMate.MetadataHandler import MetadataHandler
+
+
+def _encode_value(value) -> str:
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    elif isinstance(value, np.generic):
+        value = value.item()
+    return json.dumps(value)
+
+
+class AnnotationLog:
+    """
+    SQLite annotation event log. The events table is append-only; current_annotations holds the latest value
+    of each annotation of each index (the materialised view of the events).
+    """
+    def __init__(self, log_fn: Union[str, Path], timeout=30):
+        """
+        Parameters
+        ----------
+        log_fn: str, Path
+            Path to the SQLite database. Created if it does not exist
+
+        timeout: float, default=30
+            Seconds to wait for another connection holding the write lock
+        """
+        self.log_fn = str(log_fn)
+        self.timeout = timeout
+        self._lock = threading.RLock()
+        self._conn = self._connect()
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS events (
+                event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idx TEXT NOT NULL,
+                annotations TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                source TEXT
+            );
+            CREATE TABLE IF NOT EXISTS current_annotations (
+                idx TEXT NOT NULL,
+                annot_name TEXT NOT NULL,
+                value TEXT,
+                event_id INTEGER NOT NULL,
+                PRIMARY KEY (idx, annot_name)
+            );
+            CREATE TABLE IF NOT EXISTS leases (
+                idx TEXT PRIMARY KEY,
+                reviewer TEXT NOT NULL,
+                expires REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS conflicts (
+                conflict_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idx TEXT NOT NULL,
+                event_id INTEGER NOT NULL,
+                reviewer TEXT,
+                base_event_id INTEGER,
+                other_event_id INTEGER NOT NULL,
+                other_reviewer TEXT,
+                timestamp TEXT NOT NULL
+            );
+        ''')
+        # logs created before reviewers were recorded
+        if 'reviewer' not in [r[1] for r in self._conn.execute('PRAGMA table_info(events)')]:
+            self._conn.execute('ALTER TABLE events ADD COLUMN reviewer TEXT')
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.log_fn, timeout=self.timeout, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # with WAL, NORMAL only syncs at checkpoints and still never corrupts the database
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def append(
+        self, 
+        idx, 
+        annotations: Dict, 
+        timestamp: datetime, 
+        source: str = None, 
+        reviewer: str = None, 
+        base_event_id: int = None,
+    ) -> Tuple[int, bool]:
+        """
+        Appends an annotation event and updates the current annotations in one transaction. 
+        Transactions from all connections to the log are serialised.
+
+        Parameters
+        ----------
+        idx:
+            Index of the annotated item in the data
+
+        annotations: Dict
+            Annotation name to value (json serialisable, ie lists for multi annotations)
+
+        timestamp: datetime
+            Time of the annotation
+
+        source: str
+            Where the annotation came from (ie the data pickle)
+
+        reviewer: str
+            Name of the reviewer. If None, conflicts are not checked
+
+        base_event_id: int
+            Event id of the annotation of idx the reviewer saw before annotating (0 if none). 
+            If another reviewer has annotated idx since, the event is still appended and a conflict is recorded
+
+        Returns
+        -------
+        int
+            Event id
+
+        bool
+            Whether a conflict was recorded
+        """
+        encoded = {annot_name: _encode_value(value) for annot_name, value in annotations.items()}
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                event_id = self._conn.execute(
+                    'INSERT INTO events (idx, annotations, timestamp, source, reviewer) VALUES (?, ?, ?, ?, ?)',
+                    (str(idx), json.dumps(encoded), timestamp.isoformat(), source, reviewer),
+                ).lastrowid
+
+                conflict = False
+                if reviewer is not None and base_event_id is not None:
+                    other = self._conn.execute(
+                        'SELECT c.event_id, e.reviewer FROM current_annotations c JOIN events e USING (event_id) '
+                        'WHERE c.idx = ? ORDER BY c.event_id DESC LIMIT 1',
+                        (str(idx),),
+                    ).fetchone()
+                    if other is not None and other[0] > base_event_id and other[1] != reviewer:
+                        conflict = True
+                        self._conn.execute(
+                            'INSERT INTO conflicts (idx, event_id, reviewer, base_event_id, other_event_id, other_reviewer, timestamp) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (str(idx), event_id, reviewer, base_event_id, other[0], other[1], timestamp.isoformat()),
+                        )
+
+                self._conn.executemany(
+                    'INSERT INTO current_annotations (idx, annot_name, value, event_id) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (idx, annot_name) DO UPDATE SET value = excluded.value, event_id = excluded.event_id',
+                    [(str(idx), annot_name, value, event_id) for annot_name, value in encoded.items()],
+                )
+                if reviewer is not None:
+                    self._conn.execute('DELETE FROM leases WHERE idx = ? AND reviewer = ?', (str(idx), reviewer))
+        return event_id, conflict
+
+    def get_last_event_id(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COALESCE(MAX(event_id), 0) FROM events').fetchone()[0]
+
+    def get_events(self, since_event_id=0) -> pd.DataFrame:
+        """
+        Events after since_event_id, in order, with one column per annotation
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT event_id, idx, annotations, timestamp, source, reviewer FROM events WHERE event_id > ? '
+                'ORDER BY event_id',
+                (since_event_id,),
+            ).fetchall()
+        return pd.DataFrame([
+            {
+                'event_id': event_id,
+                'idx': idx,
+                'timestamp': datetime.fromisoformat(timestamp),
+                'source': source,
+                'reviewer': reviewer,
+                **{annot_name: json.loads(value) for annot_name, value in json.loads(annotations).items()},
+            }
+            for event_id, idx, annotations, timestamp, source, reviewer in rows
+        ])
+
+    def get_current_annotations(self) -> pd.DataFrame:
+        """
+        Latest value of each annotation of each index, read from the materialised view.
+        One row per index and one column per annotation
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT idx, annot_name, value FROM current_annotations').fetchall()
+        if len(rows) == 0:
+            return pd.DataFrame()
+        long_df = pd.DataFrame(rows, columns=['idx', 'annot_name', 'value'])
+        long_df['value'] = [json.loads(value) for value in long_df['value']]
+        return long_df.pivot(index='idx', columns='annot_name', values='value')
+
+    def get_current_event_ids(self) -> Dict[str, int]:
+        """
+        Event id of the current annotation of each annotated index
+        """
+        with self._lock:
+            return dict(self._conn.execute('SELECT idx, MAX(event_id) FROM current_annotations GROUP BY idx').fetchall())
+
+    def acquire_leases(self, reviewer: str, idxs: list, n: int, lease_seconds=8 * 3600) -> list:
+        """
+        Leases up to n unannotated items to a reviewer. Items already leased to the reviewer are renewed and count 
+        towards n. Items leased to other reviewers are skipped until their lease expires
+
+        Parameters
+        ----------
+        reviewer: str
+            Name of the reviewer
+
+        idxs: list
+            Items to hand out, in review order
+
+        n: int
+            Number of items the reviewer should hold
+
+        lease_seconds: float, default=8 hours
+            How long the items are reserved for the reviewer
+
+        Returns
+        -------
+        list
+            Items leased to the reviewer, in the order of idxs
+        """
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._conn.execute('DELETE FROM leases WHERE expires < ?', (now,))
+                annotated = {r[0] for r in self._conn.execute('SELECT DISTINCT idx FROM current_annotations')}
+                leased = dict(self._conn.execute('SELECT idx, reviewer FROM leases').fetchall())
+
+                own = [str(idx) for idx in idxs if leased.get(str(idx)) == reviewer and str(idx) not in annotated]
+                new = []
+                for idx in idxs:
+                    if len(own) + len(new) >= n:
+                        break
+                    if str(idx) not in annotated and str(idx) not in leased:
+                        new.append(str(idx))
+                self._conn.executemany(
+                    'INSERT INTO leases (idx, reviewer, expires) VALUES (?, ?, ?) '
+                    'ON CONFLICT (idx) DO UPDATE SET reviewer = excluded.reviewer, expires = excluded.expires',
+                    [(idx, reviewer, now + lease_seconds) for idx in own + new],
+                )
+        leased_idxs = set(own + new)
+        return [idx for idx in idxs if str(idx) in leased_idxs]
+
+    def release_leases(self, reviewer: str):
+        """
+        Returns the unannotated items leased to a reviewer
+        """
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._conn.execute('DELETE FROM leases WHERE reviewer = ?', (reviewer,))
+
+    def get_conflicts(self) -> pd.DataFrame:
+        """
+        Annotations made by a reviewer after another reviewer annotated the same item
+        """
+        with self._lock:
+            return pd.read_sql_query('SELECT * FROM conflicts ORDER BY conflict_id', self._conn)
+
+    def get_reviewer_progress(self) -> pd.DataFrame:
+        """
+        Number of annotation events, annotated items and leased items of each reviewer
+        """
+        with self._lock:
+            return pd.read_sql_query(
+                '''
+                SELECT reviewer, 
+                    COUNT(*) AS n_events, 
+                    COUNT(DISTINCT idx) AS n_annotated, 
+                    (SELECT COUNT(*) FROM leases l WHERE l.reviewer = e.reviewer AND l.expires >= ?) AS n_leased
+                FROM events e GROUP BY reviewer
+                ''',
+                self._conn,
+                params=(time.time(),),
+            )
+
+    def checkpoint(self):
+        """
+        Moves the WAL into the database and truncates it
+        """
+        with self._lock:
+            self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def reopen(self):
+        """
+        Opens a new connection after close(), ie once worker processes have been forked 
+        (a SQLite connection must not be used across a fork)
+        """
+        with self._lock:
+            self._conn = self._connect()
+
+
+class AnnotationLogDataInterface(ReviewDataInterface):
+    """
+    ReviewDataInterface that appends each annotation to an AnnotationLog instead of pickling the whole data object.
+    The pickle is rewritten in a background thread (compaction) when there are new events. 
+    When the log is shared by several reviewers, their annotations are synced into the data by the same thread.
+    """
+    def __init__(
+        self,
+        data_pkl_fn: Union[str, Path],
+        data: Data,
+        mh: MetadataHandler,
+        log_fn: Union[str, Path],
+        compact_interval=60,
+        reviewer: str = None,
+        sync_interval=10,
+    ):
+        """
+        Parameters
+        ----------
+        data_pkl_fn: str, Path
+            Pickle file the data object is saved to
+
+        data: Data
+            Data object being reviewed (ie loaded from data_pkl_fn by ReviewerTemplate.set_review_data).
+            Events in the log newer than the data are replayed onto it
+
+        mh: MetadataHandler
+            Metadata of the review session
+
+        log_fn: str, Path
+            Path to the SQLite annotation log
+
+        compact_interval: float, default=60
+            Seconds between background compactions. Compaction rewrites the pickle only if there are new events
+
+        reviewer: str
+            Name of the reviewer, when several reviewers share the log. Enables conflict detection
+
+        sync_interval: float, default=10
+            Seconds between syncs of the other reviewers' annotations. Only used if reviewer is set
+        """
+        self.data_pkl_fn = data_pkl_fn
+        self.mh = mh
+        self.data = data
+        self.log = AnnotationLog(log_fn)
+        self.compact_interval = compact_interval
+        self.reviewer = reviewer
+        self.sync_interval = sync_interval
+        self._lock = threading.RLock()
+        self._saved_event_id = None
+        # own events not yet covered by annotation_log_event_id (other reviewers wrote in between)
+        self._unsynced_own_event_ids = set()
+
+        event_id = getattr(self.data, 'annotation_log_event_id', 0)
+        self.replay_log()
+        self._idx_event_ids = self.log.get_current_event_ids()
+        if getattr(self.data, 'annotation_log_event_id', 0) != event_id or not os.path.exists(self.data_pkl_fn):
+            self.save_data()
+        else:
+            # the data was just pickled (ie by ReviewerTemplate.set_review_data) and there was nothing to replay
+            self._saved_event_id = event_id
+
+        self._stop_compaction = threading.Event()
+        self._compaction_thread = threading.Thread(target=self._compaction_loop, daemon=True)
+        self._compaction_thread.start()
+
+    def replay_log(self):
+        """
+        Applies the events that are newer than the data object (ie annotations made after the last compaction, 
+        or by other reviewers)
+        """
+        with self._lock:
+            events_df = self.log.get_events(since_event_id=getattr(self.data, 'annotation_log_event_id', 0))
+            if events_df.empty:
+                return
+            last_event_id = int(events_df['event_id'].max())
+            idx_lookup = {str(idx): idx for idx in self.data.annot_df.index}
+            events_df = events_df.loc[
+                events_df['idx'].isin(idx_lookup.keys()) & ~events_df['event_id'].isin(self._unsynced_own_event_ids)
+            ]
+            annot_cols = [c for c in events_df.columns if c in self.data.annot_df.columns]
+
+            history_df = events_df.rename(columns={'idx': 'index', 'source': 'source_data_fn'})
+            history_df['index'] = history_df['index'].map(idx_lookup)
+            history_df = history_df[['index', 'timestamp', 'source_data_fn'] + annot_cols]
+            if hasattr(self.data, 'append_history_rows'):
+                self.data.append_history_rows(history_df.to_dict('records'))
+            else:
+                self.data.history_df = pd.concat([self.data.history_df, history_df], ignore_index=True)
+
+            # current values are read from the materialised view instead of applying every event
+            current_df = self.log.get_current_annotations()
+            current_df = current_df.loc[current_df.index.isin(events_df['idx'].unique())]
+            for str_idx, r in current_df[[c for c in current_df.columns if c in annot_cols]].iterrows():
+                self._set_annotations(idx_lookup[str_idx], r.dropna().to_dict())
+            self._idx_event_ids = self.log.get_current_event_ids()
+            self._unsynced_own_event_ids = set()
+            self.data.annotation_log_event_id = last_event_id
+            if events_df.shape[0] > 0:
+                print(f'Replayed {events_df.shape[0]} annotations from {self.log.log_fn}')
+
+    def save_data(self):
+        """
+        Compaction: pickles a consistent snapshot of the data object, then checkpoints the log
+        """
+        with self._lock:
+            if len(self._unsynced_own_event_ids) > 0:
+                self.replay_log()
+            event_id = getattr(self.data, 'annotation_log_event_id', 0)
+            snapshot = object.__new__(type(self.data))
+            snapshot.__dict__.update(self.data.__dict__)
+            snapshot.annot_df = self.data.annot_df.copy()
+            snapshot.history_df = self.data.history_df.copy()
+
+        tmp_fn = f'{self.data_pkl_fn}.tmp'
+        with open(tmp_fn, 'wb') as f:
+            pickle.dump(snapshot, f, 2)
+        os.replace(tmp_fn, self.data_pkl_fn)
+        self._saved_event_id = event_id
+        self.log.checkpoint()
+
+    def _compaction_loop(self):
+        interval = self.compact_interval if self.reviewer is None else min(self.compact_interval, self.sync_interval)
+        last_compaction = time.time()
+        while not self._stop_compaction.wait(interval):
+            if self.reviewer is not None:
+                self.replay_log()
+            if time.time() - last_compaction >= self.compact_interval:
+                last_compaction = time.time()
+                if getattr(self.data, 'annotation_log_event_id', 0) != self._saved_event_id:
+                    self.save_data()
+
+    def stop(self):
+        """
+        Stops the background compaction after a final compaction
+        """
+        self._stop_compaction.set()
+        self._compaction_thread.join()
+        self.save_data()
+
+    def _set_annotations(self, data_idx, dictionary: Dict):
+        with warnings.catch_warnings():
+            # Catching warning where the annotation value is "multi" (a list type)
+            warnings.simplefilter('ignore')
+            # set cell by cell, so list values of "multi" annotations are not broadcast
+            for annot_name, value in dictionary.items():
+                self.data.annot_df.at[data_idx, annot_name] = value
+
+    def _update(self, data_idx, dictionary: Dict):
+        """
+        Update data annotation table with values in dictionary at index data_idx, and append the event to the log
+
+        Parameters
+        ----------
+        data_idx:
+            Index in self.data.annot_df
+        dictionary: Dict
+            A dictionary with keys that exist in self.data.annot_df.columns, and values to put in self.data.annot_df
+            at data_idx
+        """
+        with self._lock:
+            annot_names = list(dictionary.keys())
+            if list(self.data.annot_df.loc[data_idx, annot_names].values) == list(dictionary.values()):
+                return
+
+            self.append_event(
+                data_idx, dictionary, datetime.today(), base_event_id=self._idx_event_ids.get(str(data_idx), 0)
+            )
+
+    def append_event(self, data_idx, dictionary: Dict, timestamp: datetime, base_event_id: int = 0) -> Tuple[int, bool]:
+        """
+        Appends an annotation event to the log and applies it to the data
+
+        Parameters
+        ----------
+        data_idx:
+            Index in self.data.annot_df
+
+        dictionary: Dict
+            Annotation name to value
+
+        timestamp: datetime
+            Time of the annotation
+
+        base_event_id: int, default=0
+            Event id of the annotation of data_idx the reviewer saw before annotating. See AnnotationLog.append()
+
+        Returns
+        -------
+        int
+            Event id
+
+        bool
+            Whether a conflict was recorded
+        """
+        with self._lock:
+            # the log is written first, so a failed write leaves the annotations unchanged
+            event_id, conflict = self._write_event(data_idx, dictionary, timestamp, base_event_id)
+            if conflict:
+                warnings.warn(f'{data_idx} was annotated by another reviewer since it was loaded. Recorded as a conflict')
+            self._set_annotations(data_idx, dictionary)
+            history_row = {**dictionary, 'timestamp': timestamp, 'index': data_idx, 'source_data_fn': self.data_pkl_fn}
+            if hasattr(self.data, 'append_history_rows'):
+                # history_df is not copied for every annotation
+                self.data.append_history_rows([history_row])
+            else:
+                self.data.history_df = pd.concat([self.data.history_df, pd.Series(history_row).to_frame().T])
+            self._idx_event_ids[str(data_idx)] = event_id
+
+            if event_id == getattr(self.data, 'annotation_log_event_id', 0) + 1 and len(self._unsynced_own_event_ids) == 0:
+                self.data.annotation_log_event_id = event_id
+            else:
+                # other reviewers' events in between are applied at the next sync
+                self._unsynced_own_event_ids.add(event_id)
+            return event_id, conflict
+
+    def _write_event(self, data_idx, dictionary: Dict, timestamp: datetime, base_event_id: int) -> Tuple[int, bool]:
+        return self.log.append(
+            data_idx, 
+            dictionary, 
+            timestamp, 
+            source=str(self.data_pkl_fn), 
+            reviewer=self.reviewer, 
+            base_event_id=base_event_id,
+        )
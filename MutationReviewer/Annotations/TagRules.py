@@ -0,0 +1,217 @@
+"""
+Rules suggesting review tags (sequencing_tags, alignment_tags, normal_tags, tumor_tags) from the read evidence
+reference context and panel of normals records of each mutation. Rules are evaluated for all mutations at once and aggregated per mutation group,
+so suggestions are ready before review starts.
+"""
+import numpy as np
+import pandas as pd
+
+from MutationReviewer.ReadData.ReadEvidence import gen_mutation_read_evidence_df, READ_EVIDENCE_METRICS
+
+
+TAG_ANNOTATIONS = ['sequencing_tags', 'alignment_tags', 'normal_tags', 'tumor_tags']
+
+DEFAULT_TAG_THRESHOLDS = {
+    # tumor_tags
+    'min_tumor_alt_count': 3,
+    'min_tumor_vaf': 0.05,
+    # normal_tags
+    'min_normal_depth': 8,
+    'min_normal_alt_count': 2,
+    # sequencing_tags
+    'min_alt_count_strand': 4,
+    'max_alt_minor_strand_frac': 0.1,
+    'three_prime_dist': 30,
+    'min_alt_count_same_start': 2,
+    # alignment_tags
+    'min_alt_mean_mapq': 20,
+    # normal_tags from the panel of normals
+    'min_pon_coverage': 10,
+}
+
+
+def _get(features_df, col):
+    if col not in features_df.columns:
+        return np.full(features_df.shape[0], np.nan)
+    return features_df[col].to_numpy(dtype=float)
+
+
+def eval_tag_rules(features_df: pd.DataFrame, tumor_prefix: str, normal_prefix: str = None, thresholds: dict = None):
+    """
+    Evaluates the tag rules for every mutation at once
+
+    Parameters
+    ----------
+    features_df: pd.DataFrame
+        One row per mutation with read evidence columns named f'{bam_source}_{metric}'.
+        See ReadData.ReadEvidence.gen_mutation_read_evidence_df()
+
+    tumor_prefix: str
+        Bam source (bam column) of the tumor bams
+
+    normal_prefix: str
+        Bam source (bam column) of the normal bams. If None, normal_tags are not evaluated
+
+    thresholds: dict
+        Values overriding DEFAULT_TAG_THRESHOLDS
+
+    Returns
+    -------
+    Dict[str, Dict[str, np.ndarray]]
+        For each annotation, the boolean mask over mutations of each tag. Missing evidence never triggers a tag
+    """
+    t = {**DEFAULT_TAG_THRESHOLDS, **(thresholds or {})}
+
+    tumor = {m: _get(features_df, f'{tumor_prefix}_{m}') for m in READ_EVIDENCE_METRICS}
+    has_tumor = ~np.isnan(tumor['depth'])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        alt_minor_strand_frac = np.minimum(tumor['alt_fwd'], tumor['alt_rev']) / tumor['alt_count']
+
+    tags = {
+        'tumor_tags': {
+            'Low Count Tumor': has_tumor & (tumor['alt_count'] < t['min_tumor_alt_count']),
+            'Low Vaf in Tumor': has_tumor & (np.nan_to_num(tumor['vaf'], nan=0) < t['min_tumor_vaf']),
+        },
+        'sequencing_tags': {
+            'Directional': (tumor['alt_count'] >= t['min_alt_count_strand'])
+                & (alt_minor_strand_frac <= t['max_alt_minor_strand_frac']),
+            'Within 30bp of 3prime end': tumor['alt_three_prime_dist_median'] <= t['three_prime_dist'],
+            'Same Start and End': (tumor['alt_count'] >= t['min_alt_count_same_start'])
+                & (tumor['alt_unique_starts'] == 1),
+        },
+        'alignment_tags': {
+            'Low Mapping Quality': tumor['alt_mean_mapq'] < t['min_alt_mean_mapq'],
+        },
+        'normal_tags': {},
+    }
+
+    if normal_prefix is not None:
+        normal = {m: _get(features_df, f'{normal_prefix}_{m}') for m in ['depth', 'alt_count']}
+        has_normal = ~np.isnan(normal['depth'])
+        tags['normal_tags'] = {
+            'No Count Normal': has_normal & (normal['depth'] == 0),
+            'Low Count Normal': has_normal & (normal['depth'] > 0) & (normal['depth'] < t['min_normal_depth']),
+            'Tumor in Normal': normal['alt_count'] >= t['min_normal_alt_count'],
+        }
+    return tags
+
+
+def eval_reference_context_rules(reference_context_df: pd.DataFrame):
+    """
+    alignment_tags suggested from the repeats around each mutation. 
+    See ReadData.ReferenceContext.compute_reference_context()
+
+    Returns
+    -------
+    Dict[str, Dict[str, np.ndarray]]
+        For each annotation, the boolean mask over mutations of each tag
+    """
+    return {
+        'alignment_tags': {
+            'Mononucleotide Repeat': reference_context_df['mononucleotide_repeat'].to_numpy(dtype=bool),
+            'Dinucleotide Repeat': reference_context_df['dinucleotide_repeat'].to_numpy(dtype=bool),
+            'Tandem Repeat': reference_context_df['tandem_repeat'].to_numpy(dtype=bool),
+        }
+    }
+
+
+def eval_pon_rules(pon_df: pd.DataFrame, coverage_col: str = None, thresholds: dict = None):
+    """
+    normal_tags suggested from the panel of normals record of each mutation. See ReadData.PanelOfNormals.compute_pon()
+
+    Parameters
+    ----------
+    pon_df: pd.DataFrame
+        One row per mutation with pon_found and the PoN value columns
+
+    coverage_col: str
+        Column of pon_df with the number of normals (or reads) covering the site. 
+        If None, only missing PoN records are tagged
+
+    thresholds: dict
+        Values overriding DEFAULT_TAG_THRESHOLDS
+
+    Returns
+    -------
+    Dict[str, Dict[str, np.ndarray]]
+        For each annotation, the boolean mask over mutations of each tag
+    """
+    t = {**DEFAULT_TAG_THRESHOLDS, **(thresholds or {})}
+    found = pon_df['pon_found'].to_numpy(dtype=bool)
+    if coverage_col is None:
+        return {'normal_tags': {'No PoN coverage': ~found}}
+
+    coverage = pd.to_numeric(pon_df[coverage_col], errors='coerce').to_numpy(dtype=float)
+    return {
+        'normal_tags': {
+            'No PoN coverage': ~found | (coverage == 0),
+            'Low Count Normal': found & (coverage > 0) & (coverage < t['min_pon_coverage']),
+        }
+    }
+
+
+def gen_mutation_tags_df(
+    data,
+    tumor_bam_col: str = None,
+    normal_bam_col: str = None,
+    thresholds: dict = None,
+) -> pd.DataFrame:
+    """
+    Suggested tags of each mutation group, from the read evidence, reference context and panel of normals records 
+    of its mutations.
+    A group gets a tag if any of its mutations does.
+
+    Parameters
+    ----------
+    data: GeneralMutationData
+        Data object with read evidence (see GeneralMutationData.compute_read_evidence), 
+        reference context (see GeneralMutationData.compute_reference_context) 
+        and/or panel of normals records (see GeneralMutationData.compute_pon) computed
+
+    tumor_bam_col: str
+        Column of bams_df with the tumor bams. Defaults to the first bam column
+
+    normal_bam_col: str
+        Column of bams_df with the normal bams. If None, normal_tags are not suggested
+
+    thresholds: dict
+        Values overriding DEFAULT_TAG_THRESHOLDS
+
+    Returns
+    -------
+    pd.DataFrame
+        Indexed by the data index, with one column per annotation in TAG_ANNOTATIONS containing the list of suggested tags
+    """
+    tag_masks = {annot_name: {} for annot_name in TAG_ANNOTATIONS}
+    if data.read_evidence_df is not None:
+        tumor_bam_col = data.bam_cols[0] if tumor_bam_col is None else tumor_bam_col
+        features_df = gen_mutation_read_evidence_df(
+            data.read_evidence_df, data.mutations_df.shape[0], metrics=READ_EVIDENCE_METRICS
+        )
+        for annot_name, masks in eval_tag_rules(features_df, tumor_bam_col, normal_bam_col, thresholds).items():
+            tag_masks[annot_name].update(masks)
+    if data.reference_context_df is not None:
+        for annot_name, masks in eval_reference_context_rules(data.reference_context_df).items():
+            tag_masks[annot_name].update(masks)
+    if data.pon_df is not None:
+        for annot_name, masks in eval_pon_rules(data.pon_df, data.pon_coverage_col, thresholds).items():
+            for tag, mask in masks.items():
+                # combined with the matched normal evidence when both suggest the same tag
+                tag_masks[annot_name][tag] = mask | tag_masks[annot_name].get(tag, np.zeros(len(mask), dtype=bool))
+
+    # group number of each mutation row in the data index, -1 if it does not belong to a group
+    index_group = np.full(len(data.mutation_index), -1)
+    index_group_ids = data.mutation_index.get_group_ids(data.index)
+    index_group[index_group_ids[index_group_ids >= 0]] = np.flatnonzero(index_group_ids >= 0)
+    group_of_row = np.where(data.mutation_index.group_ids >= 0, index_group[data.mutation_index.group_ids], -1)
+    in_group = group_of_row >= 0
+
+    mutation_tags_df = pd.DataFrame(index=pd.Index(data.index))
+    for annot_name in TAG_ANNOTATIONS:
+        group_tags = [[] for _ in range(len(data.index))]
+        for tag, mask in tag_masks[annot_name].items():
+            n_tagged = np.bincount(group_of_row[in_group & mask], minlength=len(data.index))
+            for group_i in np.flatnonzero(n_tagged):
+                group_tags[group_i].append(tag)
+        mutation_tags_df[annot_name] = group_tags
+    return mutation_tags_df
@@ -3,6 +3,7 @@ Table of bam files. Each row corresponds to a different bam file, and includes a
 """
 import pandas as pd
 import numpy as np
+import dash
 from dash import dcc, html, dash_table
 from dash.dependencies import Input, Output, State
 import dash_bootstrap_components as dbc
@@ -48,11 +49,16 @@ def gen_bam_table_component(
     return AppComponent(
         name='Sample Bam table',
         layout=gen_mutation_table_igv_layout(bam_table_page_size, init_max_bams_view),
-        callback_input=[Input('bam-table', 'selected_rows')],
+        callback_input=[
+            Input('bam-table', 'selected_rows'), 
+            Input('bam-table-cache-interval', 'n_intervals'),
+        ],
+        callback_state=[State('bam-table', 'data')],
         callback_output=[
             Output('bam-table', 'selected_rows'), 
             Output('bam-table', 'data'), 
-            Output('bam-table', 'columns')
+            Output('bam-table', 'columns'),
+            Output('bam-table-cache-interval', 'disabled'),
         ],
         new_data_callback=new_update_bam_table,
         internal_callback=update_bam_table,
@@ -93,7 +99,9 @@ def gen_mutation_table_igv_layout(
                 page_action="native",
                 page_current= 0,
                 page_size=bam_table_page_size,
-            )
+            ),
+            # polls for prefetched reads of the current mutation while they are being extracted
+            dcc.Interval(id='bam-table-cache-interval', interval=2000, disabled=True),
         ],
     )
 
@@ -101,9 +109,12 @@ def new_update_bam_table(
     data: GeneralMutationData, 
     idx, 
     selected_rows,
+    cache_n_intervals,
+    bam_table,
     bam_table_display_cols,
-    gen_data_mut_index_name_func,
-    init_max_bams_view
+    init_max_bams_view,
+    prefetcher=None,
+    use_cached_bams=False,
 ):
     '''
     Callback function to update the bam table when a new mutation is selected
@@ -114,94 +125,169 @@ def new_update_bam_table(
         List passed by a component State reference that indicates which bam rows are selected.
         For updates, this list is overrided by init_max_bams_view
         
-    bam_table_display_cols: list
-        List of columns to display the bams_df table
+    cache_n_intervals: int
+        Number of times the table checked for newly prefetched reads
         
-    gen_data_mut_index_name_func: func
-        Function used to parse the index to filter the mutation table
+    bam_table: State list
+        Records of the bam table currently displayed
+        
+    bam_table_display_cols: list
+        List of columns to display the bams_df table. 
+        Read evidence columns are added if read evidence was computed (see GeneralMutationData.compute_read_evidence)
         
     init_max_bams_view:
         Number of bams to pre-select for loading to IGV.
         
+    prefetcher: MutationPrefetcher
+        If provided, starts prefetching reads for the selected and following mutations. 
+        See ReadData.Prefetcher.MutationPrefetcher
+        
+    use_cached_bams: bool, default=False
+        If True and a prefetcher is provided, the bam table points to the prefetched mini-bams 
+        of the mutation instead of the original bams when they are cached. 
+        While the reads are being extracted, the table is refreshed when they are cached.
+        
     Returns
     -------
+    List[int]
+        Array of indices to select from the bam table to view in IGV
+        
+    List[Dict]
+        List of records of all the relevant bams to be displayed in a table in the dashboard
+        
+    List[Dict]
+        List of records indicating the columns to display in the bam table
+        
+    bool
+        Whether to stop checking for prefetched reads
+    '''
+    if prefetcher is not None:
+        prefetcher.update_position(data, idx)
+    # checked before reading the cache, so the reads finishing in between are picked up by the next check
+    poll_cache = prefetcher is not None and use_cached_bams and prefetcher.is_pending(data, idx)
     
+    bam_table_records, bam_table_cols = gen_bam_table_records(
+        data, idx, bam_table_display_cols, prefetcher=prefetcher, use_cached_bams=use_cached_bams
+    )
     
+    # reset selected rows
+    selected_rows = list(range(min(init_max_bams_view, len(bam_table_records))))
+    return [selected_rows, bam_table_records, [{"name": i, "id": i} for i in bam_table_cols], not poll_cache]
+
+def gen_bam_table_records(
+    data: GeneralMutationData, 
+    idx, 
+    bam_table_display_cols,
+    prefetcher=None,
+    use_cached_bams=False,
+):
+    """
+    Records and columns of the bam table of a mutation. See new_update_bam_table()
+    """
+    bam_table_cols = get_bam_table_cols(data, bam_table_display_cols)
+    if prefetcher is not None and use_cached_bams:
+        bam_table_records = prefetcher.get_cached_bam_table_df(
+            data, idx, data.get_bam_table_df(idx, bam_table_cols)
+        ).to_dict('records')
+        bam_table_cols = bam_table_cols + ['source_bam', 'source_bai']
+    else:
+        bam_table_records = data.get_bam_table_records(idx, bam_table_cols)
+        
+    bam_table_evidence_df = data.get_bam_table_read_evidence_df(idx)
+    if bam_table_evidence_df is not None:
+        for record, evidence_record in zip(bam_table_records, bam_table_evidence_df.to_dict('records')):
+            record.update(evidence_record)
+        bam_table_cols = bam_table_cols + bam_table_evidence_df.columns.tolist()
+    return bam_table_records, bam_table_cols
+
+def get_bam_table_cols(data: GeneralMutationData, bam_table_display_cols):
+    """
+    Columns displayed in the bam table
+    """
+    return list(dict.fromkeys(
+        [data.bams_df_ref_col] + bam_table_display_cols + ['bam_source', 'bam', 'bai_source', 'bai']
+    ))
+
+def gen_bam_table_df(
+    data: GeneralMutationData, 
+    idx, 
+    bam_table_display_cols,
+):
     '''
+    Table of the bams relevant to the mutation, with one row per bam file and its corresponding bai file
     
-    # reset selected rows
-    selected_rows = list(range(init_max_bams_view))
-    return update_bam_table(
-        data=data, 
-        idx=idx, 
-        selected_rows=selected_rows,
-        bam_table_display_cols=bam_table_display_cols,
-        gen_data_mut_index_name_func=gen_data_mut_index_name_func,
-        init_max_bams_view=init_max_bams_view
-    )
+    Parameters
+    ----------
+    bam_table_display_cols: list
+        List of columns from the bams_df table to include
+        
+    Returns
+    -------
+    pd.DataFrame
+        Table with the bams_df_ref_col column, bam_table_display_cols, 
+        and the bam_source, bam, bai_source and bai columns
+    '''
+    return data.get_bam_table_df(idx, get_bam_table_cols(data, bam_table_display_cols))
 
 def update_bam_table(
     data: GeneralMutationData, 
     idx, 
     selected_rows,
+    cache_n_intervals,
+    bam_table,
     bam_table_display_cols,
-    gen_data_mut_index_name_func,
-    init_max_bams_view
+    init_max_bams_view,
+    prefetcher=None,
+    use_cached_bams=False,
 ):
     
     '''
-    Display bam table with bam file paths in a single column.
+    Callback function to run when rows of the bam table are selected.
     
     Parameters
     ----------
     selected_rows: State list
         List passed by a component State reference that indicates which bam rows are selected.
         
+    cache_n_intervals: int
+        Number of times the table checked for newly prefetched reads
+        
+    bam_table: State list
+        Records of the bam table currently displayed
+        
     bam_table_display_cols: list
         List of columns to display the bams_df table
         
-    gen_data_mut_index_name_func: func
-        Function used to parse the index to filter the mutation table
-        
     init_max_bams_view:
         Number of bams to pre-select for loading to IGV.
         
-    Returns
-    -------
-    List[int]
-        Array of indices to select from the bam table to view in IGV
+    prefetcher: MutationPrefetcher
+        See new_update_bam_table()
         
-    List[Dict]
-        List of records of all the relevant bams to be displayed in a table in the dashboard
+    use_cached_bams: bool, default=False
+        See new_update_bam_table()
         
-    List[Dict]
-        List of records indicating the columns to display in the bam table
+    Returns
+    -------
+    When the reads of more bams of the mutation have been prefetched, the table pointing to them 
+    and whether to stop checking. Otherwise no updates to the component will be made. 
+    The selected rows are kept by the table.
     '''
     
-    idx_mut_df = data.mutations_df.loc[
-        data.mutations_df[data.mutation_groupby_cols].apply(
-            lambda r: gen_data_mut_index_name_func(r.astype(str).tolist()), 
-            axis=1
-        ) == idx,
-    ]
-    
-    bam_ref_values = idx_mut_df[data.mutations_df_bam_ref_col].tolist()
+    # the table only changes with the mutation or the prefetched reads, so selecting rows does not update the table
+    if not dash.callback_context.triggered[0]['prop_id'].startswith('bam-table-cache-interval'):
+        return [dash.no_update, dash.no_update, dash.no_update, dash.no_update]
+    if prefetcher is None or not use_cached_bams:
+        return [dash.no_update, dash.no_update, dash.no_update, True]
     
-    bams_df = data.bams_df.loc[data.bams_df[data.bams_df_ref_col].isin(bam_ref_values)].copy()
-
-    stack_cols = [data.bams_df_ref_col] + bam_table_display_cols
+    poll_cache = prefetcher.is_pending(data, idx)
+    displayed_cached_bams = {r.get('source_bam') for r in (bam_table or []) if r.get('bam') != r.get('source_bam')}
+    if not prefetcher.get_cached_bams(data, idx) - displayed_cached_bams:
+        return [dash.no_update, dash.no_update, dash.no_update, not poll_cache]
     
-    stack_bams_df = pd.concat(
-        [
-            bams_df.set_index(stack_cols)[data.bam_cols].stack().reset_index().rename(columns={0: 'bam', f'level_{len(stack_cols)}': 'bam_source'}), 
-            bams_df.set_index(stack_cols)[data.bai_cols].stack().reset_index().rename(columns={0: 'bai', f'level_{len(stack_cols)}': 'bai_source'}), 
-        ],
-        axis=1
+    bam_table_records, _ = gen_bam_table_records(
+        data, idx, bam_table_display_cols, prefetcher=prefetcher, use_cached_bams=use_cached_bams
     )
-    
-    stack_bams_df = stack_bams_df.loc[:,~stack_bams_df.columns.duplicated()]
-    valid_indices = [i for i in selected_rows if i in range(stack_bams_df.shape[0])]
-    
-    return [valid_indices, stack_bams_df.to_dict('records'), [{"name": i, "id": i} for i in stack_bams_df.columns.tolist()]]
+    return [dash.no_update, bam_table_records, dash.no_update, not poll_cache]
     
     
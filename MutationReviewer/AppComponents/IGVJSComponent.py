@@ -1,8 +1,11 @@
 """
 Displays an internal IGV session inside the dashboard. Takes a list of bams to load and a genomic coordinate to go to. 
+A single IGV.js browser is kept and only the locus and changed tracks are updated for each mutation. If igv.js cannot 
+be loaded (ie offline), IGV.js is rebuilt for each mutation with the igv.js bundled in dash-bio.
 """
 import pandas as pd
 import numpy as np
+import dash
 from dash import dcc, html, dash_table
 from dash.dependencies import Input, Output, State
 import dash_bootstrap_components as dbc
@@ -18,12 +21,26 @@ import os
 import pickle
 import sys
 from MutationReviewer.DataTypes.GeneralMutationData import GeneralMutationData
+from MutationReviewer.AppComponents.BamTableComponent import gen_bam_table_df
+from MutationReviewer.Serving.BamServer import get_bam_url, is_gcs_url
+from MutationReviewer.Serving.BlockCacheProxy import get_proxy_url
 
 
 import os
 import shlex
+import threading
+import time
+import warnings
 from subprocess import Popen, PIPE
 
+
+class OAuthTokenError(RuntimeError):
+    """
+    Raised when the command to generate an oauth token fails or returns an empty token
+    """
+    pass
+
+
 def get_gcs_oauth_token(
     set_env_command=None, 
     access_token_command='gcloud auth application-default print-access-token'
@@ -42,6 +59,11 @@ def get_gcs_oauth_token(
     -------
     str
         Authorization token for loading remote bams in IGV
+
+    Raises
+    ------
+    OAuthTokenError
+        If the command exits with an error or does not print a token
     '''
     if set_env_command:
         full_command = f'bash -c "{set_env_command}; {access_token_command}"'
@@ -49,33 +71,266 @@ def get_gcs_oauth_token(
         full_command = access_token_command
         
     command = shlex.split(full_command)
-    process = Popen(command, stdout=PIPE, stderr=PIPE)
+    try:
+        process = Popen(command, stdout=PIPE, stderr=PIPE)
+    except OSError as e:
+        raise OAuthTokenError(f'Could not run access token command "{full_command}": {e}')
     stdout, stderr = process.communicate()
-    GCS_OAUTH_TOKEN = stdout.decode()
+    GCS_OAUTH_TOKEN = stdout.decode().strip()
+
+    if process.returncode != 0 or not GCS_OAUTH_TOKEN:
+        raise OAuthTokenError(
+            f'Access token command "{full_command}" failed with exit code {process.returncode}: '
+            f'{stderr.decode().strip() or "no token printed"}'
+        )
 
     return GCS_OAUTH_TOKEN
 
 
+class OAuthTokenProvider:
+    """
+    Caches an oauth token and refreshes it in a background thread before it expires, 
+    so the token command is not run for every track or callback.
+    """
+    def __init__(
+        self,
+        set_env_command=None,
+        access_token_command='gcloud auth application-default print-access-token',
+        token_ttl=3000,
+        refresh_margin=300,
+        retry_interval=30,
+    ):
+        """
+        Parameters
+        ----------
+        set_env_command: str
+            bash command to run to set the environment before running the command to get the access token
+            
+        access_token_command: str
+            bash command to get the access token. Default is for gcloud
+            
+        token_ttl: int, default=3000
+            Number of seconds a token is considered valid. gcloud access tokens expire after 3600 seconds
+            
+        refresh_margin: int, default=300
+            Number of seconds before expiration to refresh the token in the background
+            
+        retry_interval: int, default=30
+            Number of seconds to wait before retrying a failed background refresh
+        """
+        self.set_env_command = set_env_command
+        self.access_token_command = access_token_command
+        self.token_ttl = token_ttl
+        self.refresh_margin = min(refresh_margin, token_ttl)
+        self.retry_interval = retry_interval
+        
+        self._token = None
+        self._expires_at = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._refresh_thread = None
+        
+    def _refresh(self):
+        token = get_gcs_oauth_token(
+            set_env_command=self.set_env_command, 
+            access_token_command=self.access_token_command
+        )
+        self._token = token
+        self._expires_at = time.monotonic() + self.token_ttl
+        self.last_error = None
+        return token
+        
+    def _refresh_loop(self):
+        while not self._stop_event.is_set():
+            wait = self._expires_at - self.refresh_margin - time.monotonic()
+            if wait > 0 and self._stop_event.wait(wait):
+                break
+            try:
+                with self._lock:
+                    self._refresh()
+            except OAuthTokenError as e:
+                self.last_error = e
+                if self._stop_event.wait(self.retry_interval):
+                    break
+                    
+    def get_token(self):
+        """
+        Returns the cached token, or generates a new one if none is cached or it has expired
+        
+        Returns
+        -------
+        str
+            Authorization token for loading remote bams in IGV
+            
+        Raises
+        ------
+        OAuthTokenError
+            If a new token is needed and the token command fails
+        """
+        with self._lock:
+            if self._token is None or time.monotonic() >= self._expires_at:
+                try:
+                    self._refresh()
+                except OAuthTokenError as e:
+                    self.last_error = e
+                    raise
+            token = self._token
+            
+        if self._refresh_thread is None or not self._refresh_thread.is_alive():
+            self._stop_event.clear()
+            self._refresh_thread = threading.Thread(target=self._refresh_loop, daemon=True)
+            self._refresh_thread.start()
+        return token
+    
+    def stop(self):
+        """
+        Stops background refreshing
+        """
+        self._stop_event.set()
+        
+        
+_oauth_token_providers = {}
+_oauth_token_providers_lock = threading.Lock()
+
+def get_oauth_token_provider(
+    set_env_command=None,
+    access_token_command='gcloud auth application-default print-access-token',
+    **kwargs
+) -> OAuthTokenProvider:
+    """
+    Returns the OAuthTokenProvider shared by all tracks and callbacks using the same commands. See OAuthTokenProvider
+    """
+    key = (set_env_command, access_token_command)
+    with _oauth_token_providers_lock:
+        if key not in _oauth_token_providers:
+            _oauth_token_providers[key] = OAuthTokenProvider(
+                set_env_command=set_env_command, 
+                access_token_command=access_token_command,
+                **kwargs
+            )
+        return _oauth_token_providers[key]
+
+
+# Url igv.js is loaded from by default. dash-bio only ships igv.js as a lazily loaded chunk of its own bundle, 
+# which cannot be loaded on its own, so the standalone build is used.
+DEFAULT_IGV_JS_URL = 'https://cdn.jsdelivr.net/npm/igv@2.15.11/dist/igv.min.js'
+
+# Clientside bridge keeping a single IGV.js browser alive across mutations, used when an igv.js url is given.
+# On each session update it only searches the new locus and adds/removes tracks whose url changed. 
+# Tracks still shown only get their oauth token updated in place.
+# If igv.js cannot be loaded it sets igv-js-fallback-store, so IGV.js is rendered with dash-bio instead.
+# It has no output, so it can be added to every app without the IGV.js component (see register_igv_js_bridge()).
+IGV_JS_BRIDGE = """
+function(session) {
+    function setStatus(status) {
+        const statusElement = document.getElementById('igv-js-status');
+        if (statusElement) {
+            statusElement.textContent = status;
+        }
+    }
+    if (!session || !session.igv_js_url) {
+        return;
+    }
+    if (session.error) {
+        setStatus(session.error);
+        return;
+    }
+    const bridge = window.mutationReviewerIGV = window.mutationReviewerIGV || {
+        browser: null, genome: null, tracks: {}, queue: Promise.resolve(), igvLoaded: null
+    };
+
+    function loadIGV(url) {
+        if (window.igv && window.igv.createBrowser) {
+            return Promise.resolve(window.igv);
+        }
+        if (!bridge.igvLoaded) {
+            bridge.igvLoaded = new Promise(function(resolve, reject) {
+                const script = document.createElement('script');
+                script.src = url;
+                script.onload = function() { resolve(window.igv); };
+                script.onerror = function() { bridge.igvLoaded = null; reject(new Error('Could not load ' + url)); };
+                document.head.appendChild(script);
+            });
+        }
+        return bridge.igvLoaded;
+    }
+
+    async function update(igv) {
+        const div = document.getElementById('igv-js-div');
+        const locus = session.locus.join(' ');
+        if (!bridge.browser || bridge.genome !== session.genome || !document.body.contains(bridge.div)) {
+            if (bridge.browser) {
+                igv.removeBrowser(bridge.browser);
+            }
+            bridge.browser = await igv.createBrowser(div, {
+                genome: session.genome, locus: locus, minimumBases: session.minimumBases, tracks: []
+            });
+            bridge.genome = session.genome;
+            bridge.div = div;
+            bridge.tracks = {};
+        } else {
+            await bridge.browser.search(locus);
+        }
+
+        const keep = {};
+        session.tracks.forEach(function(t) { keep[t.url] = t; });
+        Object.keys(bridge.tracks).forEach(function(url) {
+            if (!(url in keep)) {
+                bridge.browser.removeTrack(bridge.tracks[url]);
+                delete bridge.tracks[url];
+            }
+        });
+        for (const [url, config] of Object.entries(keep)) {
+            if (!(url in bridge.tracks)) {
+                bridge.tracks[url] = await bridge.browser.loadTrack(config);
+            } else if (config.oauthToken && bridge.tracks[url].config.oauthToken !== config.oauthToken) {
+                // the track's readers request data with its config, so a refreshed token is used without reloading
+                bridge.tracks[url].config.oauthToken = config.oauthToken;
+            }
+        }
+    }
+
+    function fallback(e) {
+        console.error('Could not load igv.js', e);
+        setStatus('Could not load igv.js from ' + session.igv_js_url + '. Rendering IGV.js with dash-bio');
+        window.dash_clientside.set_props('igv-js-fallback-store', {data: true});
+    }
+
+    bridge.queue = bridge.queue
+        .then(function() { return loadIGV(session.igv_js_url).then(update, fallback); })
+        .catch(function(e) { console.error('IGV.js update failed', e); setStatus('IGV.js update failed: ' + e); });
+    setStatus('Showing ' + session.tracks.length + ' track(s) at ' + session.locus.join(', '));
+}
+"""
+
+
 def gen_igv_session(
     data: GeneralMutationData, 
     idx, 
     update_tracks_n_clicks,
+    igv_js_fallback,
     bam_table,
     bam_table_selected_rows,
     genome,
     track_height,
     minimumBases,
-    gen_data_mut_index_name_func,
     set_env_command=None,
+    init_max_bams_view=2,
+    igv_js_url=DEFAULT_IGV_JS_URL,
 ):
     """
-    Callback function to generate an IGV.js window centered around the locus/loci of interest 
-    and specified bams loaded when the Update Tracks button is clicked.
+    Callback function to update the IGV.js session to the locus/loci of interest 
+    with the specified bams when the Update Tracks button is clicked.
     
     Parameters
     ------
-    update_tracks_n_clicks: State
-        Dash.State of the number of times a button was clicked
+    update_tracks_n_clicks: Input
+        Dash.Input of the number of times a button was clicked
+        
+    igv_js_fallback: Input, bool
+        Dash.Input of whether igv.js could not be loaded from igv_js_url, in which case 
+        IGV.js is rendered with the igv.js bundled in dash-bio
         
     bam_table: State
         Dash.State object referencing a state of a dash component containing 
@@ -94,106 +349,203 @@ def gen_igv_session(
     minimumBases: int, default=200
         Minimum number of bases to display in a window in IGV.js mode
         
-    gen_data_mut_index_name_func: func
-        Function used to parse the index to filter the mutation table
+    init_max_bams_view: int, default=2
+        Number of bams to load when a new mutation is selected. Only used by gen_igv_session_update()
+        
+    igv_js_url: str, default=DEFAULT_IGV_JS_URL
+        Url to load the igv.js library from (ie a copy served with the app). A single IGV.js browser is kept
+        and updated by the clientside bridge (see IGV_JS_BRIDGE). If None, or if igv.js cannot be loaded, 
+        IGV.js is rebuilt for each mutation with the igv.js bundled in dash-bio
         
     Return
     ------
-    A dash_bio.IGV component
-        Contains the tracks specified to load and window centering around the locus (or loci) of interest
+    List
+        IGV.js session (genome, locus and tracks) for the clientside bridge, status, and dash-bio IGV.js layout. 
+        See gen_igv_js_outputs()
     
     """
-    
-    idx_mut_df = data.mutations_df.loc[
-        data.mutations_df[data.mutation_groupby_cols].apply(
-            lambda r: gen_data_mut_index_name_func(r.astype(str).tolist()), 
-            axis=1
-        ) == idx,
-    ]
-
     bams_df = pd.DataFrame.from_records(bam_table)
     valid_indices = [i for i in bam_table_selected_rows if i in range(bams_df.shape[0])]
-
-    tracks = [
-        {
-            'name': r[data.bams_df_ref_col],
-            'url': str(r['bam']),
-            'indexURL': str(r['bai']),
-            'displayMode': "COLLAPSED",
-            'oauthToken': get_gcs_oauth_token(set_env_command=set_env_command),
-            'showCoverage': True,
-            'height': track_height,
-            'color': 'rgb(170, 170, 170)'
-        } for _, r in bams_df.iloc[valid_indices].iterrows()
-    ]
     
-    locus = [f'{idx_mut_df.iloc[0][chrom]}:{idx_mut_df.iloc[0][pos]}' for chrom, pos in zip(data.chrom_cols, data.pos_cols)]
-    return gen_igv_session_layout(
-        genome=genome, 
-        tracks=tracks, 
-        locus=locus, 
-        minimumBases=minimumBases,
+    return gen_igv_js_outputs(
+        gen_igv_session_data(
+            data=data,
+            idx=idx,
+            selected_bams_df=bams_df.iloc[valid_indices],
+            genome=genome,
+            track_height=track_height,
+            minimumBases=minimumBases,
+            set_env_command=set_env_command,
+        ),
+        igv_js_url=None if igv_js_fallback else igv_js_url,
     )
 
 def gen_igv_session_update(
     data: GeneralMutationData, 
     idx, 
     update_tracks_n_clicks,
+    igv_js_fallback,
     bam_table,
     bam_table_selected_rows,
     genome,
     track_height,
     minimumBases,
-    gen_data_mut_index_name_func,
     set_env_command=None,
+    init_max_bams_view=2,
+    igv_js_url=DEFAULT_IGV_JS_URL,
 ):
     '''
+    Callback function to move the IGV.js session to a new mutation. 
+    Loads the first init_max_bams_view bams of the mutation, matching the rows pre-selected in the bam table.
+    
     See gen_igv_session()
     '''
+    bams_df = gen_bam_table_df(data, idx, bam_table_display_cols=[])
     
-    return [html.Div()]
+    return gen_igv_js_outputs(
+        gen_igv_session_data(
+            data=data,
+            idx=idx,
+            selected_bams_df=bams_df.iloc[:init_max_bams_view],
+            genome=genome,
+            track_height=track_height,
+            minimumBases=minimumBases,
+            set_env_command=set_env_command,
+        ),
+        igv_js_url=None if igv_js_fallback else igv_js_url,
+    )
     
+def get_igv_track_url(path: str) -> str:
+    """
+    Url IGV.js loads a bam or index from: the app's url for local files served by the app (see Serving.BamServer) 
+    and remote files read through the block cache proxy (see Serving.BlockCacheProxy), otherwise path itself
+    """
+    return get_proxy_url(get_bam_url(path))
 
 
-def gen_igv_session_layout(genome, tracks, locus, minimumBases):
+def gen_igv_session_data(
+    data: GeneralMutationData,
+    idx,
+    selected_bams_df: pd.DataFrame,
+    genome,
+    track_height,
+    minimumBases,
+    set_env_command=None,
+):
     """
-    Generate layout for displaying IGV inside the dashboard. See https://dash.plotly.com/dash-bio/igv
+    Generates the IGV.js session for the selected bams
     
     Parameters
     ----------
+    selected_bams_df: pd.DataFrame
+        Rows of the bam table to load as tracks
+        
     genome: str
         Select a genome using an identifier string (e.g. "hg19"). A list of pre-defined genomes hosted by IGV can be found here: https://s3.amazonaws.com/igv.org.genomes/genomes.json.
         
-    tracks: 
-        Array of configuration objects defining tracks initially displayed when app launches. See https://github.com/igvteam/igv.js/wiki/Tracks-2.0
-        
-    locus: str, List[str]
-        String or list of strings formatted for querying regions of the genome (ie 'chr#', 'chr#:###-###', ['chr2', 'chr3']
+    track_height: int
+        Height to display each track
         
     minimumBases: int
         Minimum window size in base pairs when zooming in
         
     Returns
     -------
-    plotly.dash.html
-        Layout for dash
+    Dict
+        IGV.js session with the genome, locus and tracks (see https://github.com/igvteam/igv.js/wiki/Tracks-2.0), 
+        or an error message. Track urls are given by get_igv_track_url()
     """
+    track_urls = [
+        (get_igv_track_url(str(r['bam'])), get_igv_track_url(str(r['bai']))) for _, r in selected_bams_df.iterrows()
+    ]
+    oauth_token = None
+    if any(is_gcs_url(bam_url) for bam_url, _ in track_urls):
+        try:
+            oauth_token = get_oauth_token_provider(set_env_command=set_env_command).get_token()
+        except OAuthTokenError as e:
+            return {'error': f'Could not load tracks. {e}'}
+
+    tracks = [
+        {
+            'name': r[data.bams_df_ref_col],
+            'url': bam_url,
+            'indexURL': bai_url,
+            'displayMode': "COLLAPSED",
+            'oauthToken': oauth_token if is_gcs_url(bam_url) else None,
+            'showCoverage': True,
+            'height': track_height,
+            'color': 'rgb(170, 170, 170)'
+        } for (_, r), (bam_url, bai_url) in zip(selected_bams_df.iterrows(), track_urls)
+    ]
     
+    idx_mut_df = data.get_mutation_df(idx)
+    locus = [f'{idx_mut_df.iloc[0][chrom]}:{idx_mut_df.iloc[0][pos]}' for chrom, pos in zip(data.chrom_cols, data.pos_cols)]
+    return {
+        'genome': genome,
+        'locus': locus,
+        'minimumBases': minimumBases,
+        'tracks': tracks,
+    }
+
+
+def gen_igv_js_outputs(session, igv_js_url=DEFAULT_IGV_JS_URL):
+    """
+    Outputs of the IGV.js component for a session (see gen_igv_session_data()): 
+    the session for the clientside bridge if igv_js_url is given, otherwise a dash-bio IGV.js browser 
+    rebuilt for the session
+
+    Returns
+    -------
+    List
+        Session store data, status and IGV.js container children
+    """
+    if igv_js_url is not None:
+        return [{**session, 'igv_js_url': igv_js_url}, dash.no_update, dash.no_update]
+    if 'error' in session:
+        return [dash.no_update, session['error'], []]
     return [
-        dashbio.Igv(
-            children='igv',
-            id='default-igv',
-            genome=genome,
-            minimumBases=minimumBases,
-            locus=locus,
-            tracks=tracks
-        )
+        dash.no_update,
+        f"Showing {len(session['tracks'])} track(s) at {', '.join(session['locus'])}",
+        [
+            dashbio.Igv(
+                id='default-igv',
+                genome=session['genome'],
+                minimumBases=session['minimumBases'],
+                locus=session['locus'],
+                tracks=session['tracks'],
+            )
+        ],
     ]
 
+
+def _add_igv_js_bridge(app):
+    app.clientside_callback(IGV_JS_BRIDGE, Input('igv-js-session-store', 'data', allow_optional=True))
+
+
+def register_igv_js_bridge() -> bool:
+    """
+    Adds the clientside bridge (see IGV_JS_BRIDGE) to each Dash app created afterwards (see dash.hooks), 
+    so every app built by the reviewer has it, not only the first one started in the process
+
+    Returns
+    -------
+    bool
+        Whether the bridge is available
+    """
+    try:
+        from dash import hooks
+    except ImportError:
+        warnings.warn('Updating a single IGV.js browser requires dash>=3.0. IGV.js is rendered with dash-bio instead')
+        return False
+    if _add_igv_js_bridge not in [hook.func for hook in hooks.get_hooks('setup')]:
+        hooks.setup()(_add_igv_js_bridge)
+    return True
+
 def gen_igv_js_component(bam_table_state: State, bam_table_selected_rows_state: State) -> AppComponent:
     '''
-    Returns a pre-built AppComponent with a button that will update a running local IGV session 
-    on click given which rows are selected in a bam table located in a separate component.
+    Returns a pre-built AppComponent rendering a single IGV.js browser inside the dashboard. 
+    The browser is moved to each new mutation, and a button updates the tracks 
+    given which rows are selected in a bam table located in a separate component.
     
     Parameters
     ----------
@@ -210,21 +562,31 @@ def gen_igv_js_component(bam_table_state: State, bam_table_selected_rows_state:
     AppComponent
         Interactive component rendering IGV.js
     '''
+    has_bridge = register_igv_js_bridge()
     
     return AppComponent(
         name='IGV.js embedded component',
-        layout=gen_igv_js_layout(),
+        layout=gen_igv_js_layout(igv_js_fallback=not has_bridge),
         new_data_callback=gen_igv_session_update,
         internal_callback=gen_igv_session,
-        callback_output=[Output('default-igv-container', 'children')],
-        callback_input=[Input('update-tracks-button', 'n_clicks')],
+        callback_output=[
+            Output('igv-js-session-store', 'data'), 
+            Output('igv-js-status', 'children'), 
+            Output('igv-js-div', 'children'),
+        ],
+        callback_input=[Input('update-tracks-button', 'n_clicks'), Input('igv-js-fallback-store', 'data')],
         callback_state_external=[bam_table_state, bam_table_selected_rows_state]
     )
 
-def gen_igv_js_layout():
+def gen_igv_js_layout(igv_js_fallback=False):
     """
     Generates dash layout container to hold the igv.js element
     
+    Parameters
+    ----------
+    igv_js_fallback: bool, default=False
+        Whether to start rendering IGV.js with dash-bio instead of the clientside bridge
+    
     Returns
     -------
     dash.html
@@ -233,6 +595,8 @@ def gen_igv_js_layout():
     
     return html.Div([
         html.Button('Update tracks from bam table', id='update-tracks-button', n_clicks=0),
-        dcc.Loading(children="Press button to load IGV", id='default-igv-container'),
+        dcc.Store(id='igv-js-session-store'),
+        dcc.Store(id='igv-js-fallback-store', data=igv_js_fallback),
+        html.P("Select a mutation to load IGV", id='igv-js-status'),
+        html.Div(children=[], id='igv-js-div'),
     ])
-    
\ No newline at end of file
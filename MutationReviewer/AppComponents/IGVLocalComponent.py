@@ -19,7 +19,7 @@ import os
 import pickle
 import sys
 
-from .utils import load_bams_igv
+from .utils import get_igv_local_session, IGVLocalSession
 from MutationReviewer.DataTypes.GeneralMutationData import GeneralMutationData
 
 
@@ -27,9 +27,10 @@ def load_igv_session(
     data: GeneralMutationData, 
     idx, 
     update_tracks_n_clicks,
+    status_n_intervals,
     bam_table,
     bam_table_selected_rows,
-    gen_data_mut_index_name_func,
+    igv_local_session: IGVLocalSession = None,
 ):
     """
     Callback function to run when the data to review changes
@@ -39,6 +40,9 @@ def load_igv_session(
     update_tracks_n_clicks: State
         Dash.State of the number of times a button was clicked
         
+    status_n_intervals: int
+        Number of times the status was refreshed
+        
     bam_table: State
         Dash.State object referencing a state of a dash component containing 
         a table with the bam files
@@ -47,8 +51,8 @@ def load_igv_session(
         Dash.State object referencing a state of a dash component referencing 
         which rows are selected in a table with the bam files
         
-    gen_data_mut_index_name_func: func
-        Function used to parse the index to filter the mutation table
+    igv_local_session: IGVLocalSession
+        Connection to the local IGV app. See AppComponents.utils.IGVLocalSession
         
     Return
     ------
@@ -57,15 +61,16 @@ def load_igv_session(
     
     """
 
-    return [dash.no_update]
+    return [dash.no_update, dash.no_update, dash.no_update]
 
 def load_igv_session_update(
     data: GeneralMutationData, 
     idx, 
     update_tracks_n_clicks,
+    status_n_intervals,
     bam_table,
     bam_table_selected_rows,
-    gen_data_mut_index_name_func,
+    igv_local_session: IGVLocalSession = None,
 ):
     """
     Callback function to update local IGV when the Update Tracks button is clicked.
@@ -76,6 +81,9 @@ def load_igv_session_update(
     update_tracks_n_clicks: State
         Dash.State of the number of times a button was clicked
         
+    status_n_intervals: int
+        Number of times the status was refreshed
+        
     bam_table: State
         Dash.State object referencing a state of a dash component containing 
         a table with the bam files
@@ -84,31 +92,37 @@ def load_igv_session_update(
         Dash.State object referencing a state of a dash component referencing 
         which rows are selected in a table with the bam files
         
-    gen_data_mut_index_name_func: func
-        Function used to parse the index to filter the mutation table
+    igv_local_session: IGVLocalSession
+        Connection to the local IGV app. If None, uses the default shared session. 
+        See AppComponents.utils.get_igv_local_session
         
     Return
     ------
     
-    No updates to the component will be made.
+    Status of the request sent to the local IGV app, and whether to stop refreshing it. 
+    The request is sent in the background so the dashboard does not wait for IGV, 
+    and the status is refreshed on an interval until it is loaded or fails.
     
     """
+    igv_local_session = get_igv_local_session() if igv_local_session is None else igv_local_session
+    if dash.callback_context.triggered[0]['prop_id'].startswith('local-igv-status-interval'):
+        return [dash.no_update, html.P(igv_local_session.status), not igv_local_session.is_busy()]
     
     # reset igv
-    idx_mut_df = data.mutations_df.loc[
-        data.mutations_df[data.mutation_groupby_cols].apply(
-            lambda r: gen_data_mut_index_name_func(r.astype(str).tolist()), 
-            axis=1
-        ) == idx,
-    ]
+    idx_mut_df = data.get_mutation_df(idx)
 
     bams_df = pd.DataFrame.from_records(bam_table)
     valid_indices = [i for i in bam_table_selected_rows if i in range(bams_df.shape[0])]
     
     load_bams_list = bams_df.loc[valid_indices]['bam'].tolist()
-    load_bams_igv(load_bams_list, idx_mut_df.iloc[0][data.chrom_cols], idx_mut_df.iloc[0][data.pos_cols])
     
-    return [dash.no_update]
+    status = igv_local_session.submit(
+        load_bams_list, 
+        [str(chrom) for chrom in idx_mut_df.iloc[0][data.chrom_cols]], 
+        idx_mut_df.iloc[0][data.pos_cols].tolist()
+    )
+    
+    return [dash.no_update, html.P(status), False]
     
     
     
@@ -139,8 +153,15 @@ def gen_igv_local_component(bam_table_data_state: State, bam_table_selected_rows
         layout=gen_igv_local_layout(),
         new_data_callback=load_igv_session,
         internal_callback=load_igv_session_update,
-        callback_output=[Output('local-igv-container', 'children')],
-        callback_input=[Input('update-local-igv-button', 'n_clicks')],
+        callback_output=[
+            Output('local-igv-container', 'children'), 
+            Output('local-igv-status', 'children'),
+            Output('local-igv-status-interval', 'disabled'),
+        ],
+        callback_input=[
+            Input('update-local-igv-button', 'n_clicks'), 
+            Input('local-igv-status-interval', 'n_intervals'),
+        ],
         callback_state_external=[bam_table_data_state, bam_table_selected_rows_state]
     )
 
@@ -165,5 +186,8 @@ def gen_igv_local_layout():
             ), 
             id='local-igv-container'
         ),
+        html.Div(children=[], id='local-igv-status'),
+        # enabled while a request is being sent to IGV
+        dcc.Interval(id='local-igv-status-interval', interval=2000, disabled=True),
     ])
     
\ No newline at end of file
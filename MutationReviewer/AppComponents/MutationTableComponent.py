@@ -16,19 +16,52 @@ from AnnoMate.DataTypes.GenericData import GenericData
 import os
 import pickle
 import sys
+import re
 
 from MutationReviewer.DataTypes.GeneralMutationData import GeneralMutationData
 
 
-def gen_mutation_table_component():
+def gen_mutation_table_component(mutation_table_mode='static', mutation_table_page_size=20):
     """
     Generates table of occurences of the mutation from a maf file
     
+    Parameters
+    ----------
+    mutation_table_mode: str, ['static', 'paged'], default='static'
+        'static' renders all the mutations in the group as an html table.
+        'paged' renders a table that is sorted, filtered and paged on the server, 
+        so only the visible page is sent to the browser. Use for large mutation groups (ie grouping by gene)
+        
+    mutation_table_page_size: int, default=20
+        Number of mutations to display per page in 'paged' mode
+    
     Returns
     -------
     AppComponent
         Interactive component displaying all occurences of the selected mutation
     """
+    if mutation_table_mode == 'paged':
+        return AppComponent(
+            name='Mutation Table',
+            layout=gen_paged_mutation_table_layout(mutation_table_page_size),
+            callback_input=[
+                Input('paged-mut-table', 'page_current'),
+                Input('paged-mut-table', 'page_size'),
+                Input('paged-mut-table', 'sort_by'),
+                Input('paged-mut-table', 'filter_query'),
+            ],
+            callback_output=[
+                Output('paged-mut-table', 'data'),
+                Output('paged-mut-table', 'columns'),
+                Output('paged-mut-table', 'page_count'),
+                Output('paged-mut-table', 'page_current'),
+            ],
+            new_data_callback=new_update_paged_mut_table,
+            internal_callback=update_paged_mut_table,
+        )
+    elif mutation_table_mode != 'static':
+        raise ValueError(f'mutation_table_mode must be "static" or "paged". Got "{mutation_table_mode}"')
+        
     return AppComponent(
         name='Mutation Table',
         layout=gen_mutation_table_layout(),
@@ -54,7 +87,6 @@ def update_mut_table(
     data: GeneralMutationData, 
     idx, 
     mutation_table_display_cols,
-    gen_data_mut_index_name_func,
 ):
     """
     Callback function to update the mutation table when a new mutation is selected
@@ -68,21 +100,209 @@ def update_mut_table(
         Current mutation to be reviewed
         
     mutation_table_display_cols: List[str]
-        List of column names in the maf file to display in the mutation table
-        
-    gen_data_mut_index_name_func: func
-        Function that regenerates the mutation index to match which rows in the maf to display given the currently selected mutation
+        List of column names in the maf file to display in the mutation table. 
+        Read evidence summary columns are added if read evidence was computed (see GeneralMutationData.compute_read_evidence)
         
     Returns
     -------
     dash.Table
         Dash table displaying all relevant mutations given the selected mutation
     """
-    df = data.mutations_df.loc[
-        data.mutations_df.apply(
-            lambda r: gen_data_mut_index_name_func(r[data.mutation_groupby_cols].astype(str).tolist()), 
-            axis=1
-        ) == idx,
-        mutation_table_display_cols
-    ]
+    df = data.get_mutation_table_df(idx, mutation_table_display_cols)
     return [dbc.Table.from_dataframe(df=df)]
+
+
+def gen_paged_mutation_table_layout(mutation_table_page_size):
+    """
+    Generates dash layout for the server-side paged mutation table
+    
+    Parameters
+    ----------
+    mutation_table_page_size: int
+        Number of mutations to display per page
+    
+    Returns
+    -------
+    dash.html
+        plotly dash layout
+    """
+    return html.Div(
+        children=[
+            dash_table.DataTable(
+                id='paged-mut-table',
+                data=[],
+                columns=[],
+                page_action='custom',
+                page_current=0,
+                page_size=mutation_table_page_size,
+                page_count=1,
+                sort_action='custom',
+                sort_mode='multi',
+                sort_by=[],
+                filter_action='custom',
+                filter_query='',
+                style_table={'overflowX': 'auto'},
+            )
+        ]
+    )
+
+
+FILTER_PATTERN = re.compile(
+    r'^\s*\{(?P<col>[^}]+)\}\s*(?P<case>[si]?)(?P<op>>=|<=|!=|=|<|>|eq|ne|ge|le|gt|lt|contains|datestartswith)\s*(?P<value>.*?)\s*$'
+)
+
+def filter_mutation_df(df: pd.DataFrame, filter_query: str) -> pd.DataFrame:
+    """
+    Filters a dataframe with the filter_query of a dash DataTable (ie '{Hugo_Symbol} contains TP && {t_alt_count} > 3')
+    
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Dataframe to filter
+        
+    filter_query: str
+        Expressions of the form "{column} operator value" joined by " && ". 
+        Expressions that cannot be parsed or reference missing columns are ignored
+        
+    Returns
+    -------
+    pd.DataFrame
+        Rows of df matching all the expressions
+    """
+    if not filter_query:
+        return df
+    
+    mask = np.ones(df.shape[0], dtype=bool)
+    for filter_part in filter_query.split(' && '):
+        m = FILTER_PATTERN.match(filter_part)
+        if m is None or m['col'] not in df.columns:
+            continue
+            
+        col = df[m['col']]
+        value = m['value']
+        if len(value) > 1 and value[0] == value[-1] and value[0] in ('"', "'", '`'):
+            value = value[1:-1].replace('\\' + value[0], value[0])
+        op = {'=': 'eq', '!=': 'ne', '>=': 'ge', '<=': 'le', '>': 'gt', '<': 'lt'}.get(m['op'], m['op'])
+        
+        if op in ('contains', 'datestartswith'):
+            col_str = col.astype(str)
+            value = str(value)
+            if m['case'] == 'i':
+                col_str, value = col_str.str.lower(), value.lower()
+            part_mask = col_str.str.contains(value, regex=False) if op == 'contains' else col_str.str.startswith(value)
+        else:
+            if pd.api.types.is_numeric_dtype(col):
+                value = pd.to_numeric(value, errors='coerce')
+                if pd.isna(value):
+                    continue
+            else:
+                col = col.astype(str)
+                value = str(value)
+                if m['case'] == 'i':
+                    col, value = col.str.lower(), value.lower()
+            part_mask = getattr(col, op)(value)
+            
+        mask &= part_mask.fillna(False).to_numpy(dtype=bool)
+    return df.loc[mask]
+
+def sort_mutation_df(df: pd.DataFrame, sort_by: list) -> pd.DataFrame:
+    """
+    Sorts a dataframe with the sort_by of a dash DataTable (ie [{'column_id': 'Start_position', 'direction': 'asc'}])
+    """
+    sort_by = [s for s in (sort_by or []) if s['column_id'] in df.columns]
+    if len(sort_by) == 0:
+        return df
+    return df.sort_values(
+        [s['column_id'] for s in sort_by],
+        ascending=[s['direction'] == 'asc' for s in sort_by],
+        kind='stable',
+        na_position='last',
+    )
+
+def new_update_paged_mut_table(
+    data: GeneralMutationData, 
+    idx, 
+    page_current,
+    page_size,
+    sort_by,
+    filter_query,
+    mutation_table_display_cols,
+):
+    """
+    Callback function to update the paged mutation table when a new mutation is selected. 
+    Keeps the sorting and filters and goes back to the first page.
+    
+    See update_paged_mut_table()
+    """
+    return update_paged_mut_table(
+        data=data, 
+        idx=idx, 
+        page_current=0,
+        page_size=page_size,
+        sort_by=sort_by,
+        filter_query=filter_query,
+        mutation_table_display_cols=mutation_table_display_cols,
+    )
+
+def update_paged_mut_table(
+    data: GeneralMutationData, 
+    idx, 
+    page_current,
+    page_size,
+    sort_by,
+    filter_query,
+    mutation_table_display_cols,
+):
+    """
+    Callback function to update the paged mutation table when the page, sorting or filters change
+    
+    Parameters
+    ----------
+    data: GeneralMutationData
+        Data object storing the relevant data for mutation review
+        
+    idx: str
+        Current mutation to be reviewed
+        
+    page_current: int
+        Index of the page to display
+        
+    page_size: int
+        Number of mutations per page
+        
+    sort_by: List[Dict]
+        Columns to sort by. See sort_mutation_df()
+        
+    filter_query: str
+        Filters to apply. See filter_mutation_df()
+        
+    mutation_table_display_cols: List[str]
+        List of column names in the maf file to display in the mutation table
+        
+    Returns
+    -------
+    List[Dict]
+        Records of the mutations on the current page
+        
+    List[Dict]
+        Columns of the table
+        
+    int
+        Number of pages
+        
+    int
+        Index of the current page
+    """
+    df = data.get_mutation_table_df(idx, mutation_table_display_cols)
+    df = sort_mutation_df(filter_mutation_df(df, filter_query), sort_by)
+    
+    page_size = page_size or 1
+    page_count = max(int(np.ceil(df.shape[0] / page_size)), 1)
+    page_current = min(page_current or 0, page_count - 1)
+    page_df = df.iloc[page_current * page_size: (page_current + 1) * page_size]
+    
+    columns = [
+        {'name': c, 'id': c, 'type': 'numeric' if pd.api.types.is_numeric_dtype(df[c]) else 'text'} 
+        for c in df.columns
+    ]
+    return [page_df.to_dict('records'), columns, page_count, page_current]
@@ -0,0 +1,83 @@
+"""
+Tags suggested for the current mutation from its read evidence. The suggestions can be copied into the annotation panel
+with the autofill button (see GeneralMutationReviewer.set_default_autofill).
+"""
+import pandas as pd
+import numpy as np
+from dash import dcc, html
+from dash.dependencies import Input, Output, State
+
+from AnnoMate.ReviewDataApp import ReviewDataApp, AppComponent
+
+from MutationReviewer.DataTypes.GeneralMutationData import GeneralMutationData
+from MutationReviewer.Annotations.TagRules import TAG_ANNOTATIONS
+
+
+def get_suggested_tags_store_id(annot_name):
+    """
+    Id of the dcc.Store holding the suggested tags of an annotation for the current mutation
+    """
+    return f'suggested-{annot_name.replace("_", "-")}-store'
+
+
+def gen_suggested_tags_component():
+    """
+    Generates a component listing the tags suggested for the current mutation
+
+    Returns
+    -------
+    AppComponent
+        Component displaying the suggested tags and storing them for autofill
+    """
+    return AppComponent(
+        name='Suggested tags',
+        layout=gen_suggested_tags_layout(),
+        callback_output=[Output('suggested-tags-list', 'children')] + [
+            Output(get_suggested_tags_store_id(annot_name), 'data') for annot_name in TAG_ANNOTATIONS
+        ],
+        new_data_callback=update_suggested_tags,
+    )
+
+def gen_suggested_tags_layout():
+    """
+    Generates dash layout for the suggested tags
+
+    Returns
+    -------
+    dash.html
+        plotly dash layout
+    """
+    return html.Div(
+        children=[html.Ul(children=[], id='suggested-tags-list')] + [
+            dcc.Store(id=get_suggested_tags_store_id(annot_name), data=[]) for annot_name in TAG_ANNOTATIONS
+        ]
+    )
+
+def update_suggested_tags(data: GeneralMutationData, idx):
+    """
+    Callback function to update the suggested tags when a new mutation is selected
+
+    Parameters
+    ----------
+    data: GeneralMutationData
+        Data object storing the relevant data for mutation review
+
+    idx: str
+        Current mutation to be reviewed
+
+    Returns
+    -------
+    List[html.Li]
+        One item per annotation with suggested tags
+
+    List[str]
+        Suggested tags of each annotation in TAG_ANNOTATIONS
+    """
+    suggested_tags = data.get_mutation_tags(idx)
+    items = [
+        html.Li(f'{annot_name}: {", ".join(suggested_tags[annot_name])}')
+        for annot_name in TAG_ANNOTATIONS if len(suggested_tags[annot_name]) > 0
+    ]
+    if len(items) == 0:
+        items = [html.Li('No suggested tags')]
+    return [items] + [suggested_tags[annot_name] for annot_name in TAG_ANNOTATIONS]
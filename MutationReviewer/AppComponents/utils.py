@@ -1,4 +1,11 @@
 import igv_remote
+import os
+import queue
+import re
+import socket
+import threading
+import time
+import pandas as pd
 
 def load_bams_igv(bams_list, chroms, poss, view_type="collapse", sort="base", img_dir= "igv_snapshots/", verbose=False, recv_timeout=60):
     """
@@ -38,3 +45,559 @@ def load_bams_igv(bams_list, chroms, poss, view_type="collapse", sort="base", im
     else:
         print("no bams selected")
         
+
+
+class IGVBatchConnection:
+    """
+    Connection to the batch port of a running IGV app (see https://igv.org/doc/desktop/#UserGuide/tools/batch/). 
+    IGV serves one client at a time, so all the commands of a client should go through one connection.
+    """
+    def __init__(self, host='127.0.0.1', port=60151, timeout=60):
+        """
+        Parameters
+        ----------
+        host: str, default='127.0.0.1'
+            Host running IGV
+            
+        port: int, default=60151
+            Port IGV is listening on (View > Preferences > Advanced > Enable port)
+            
+        timeout: int, default=60
+            Seconds to wait for IGV to reply to each command
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self._sock_file = None
+        
+    def connect(self):
+        self.close()
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._sock_file = self.sock.makefile('rw')
+        
+    def send(self, commands):
+        """
+        Sends batch commands in order and waits for each reply. Connects if needed
+        
+        Returns
+        -------
+        List[str]
+            IGV's reply to each command
+        """
+        if self.sock is None:
+            self.connect()
+        replies = []
+        for command in commands:
+            self._sock_file.write(f'{command}\n')
+            self._sock_file.flush()
+            reply = self._sock_file.readline()
+            if reply == '':
+                raise ConnectionResetError(f'IGV on {self.host}:{self.port} closed the connection')
+            replies.append(reply.strip())
+        return replies
+    
+    def close(self):
+        for f in [self._sock_file, self.sock]:
+            if f is not None:
+                try:
+                    f.close()
+                except OSError:
+                    pass
+        self.sock = None
+        self._sock_file = None
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+
+def send_igv_batch_commands(commands, host='127.0.0.1', port=60151, timeout=60):
+    """
+    Sends IGV batch commands (see https://igv.org/doc/desktop/#UserGuide/tools/batch/) 
+    to the port of a running IGV app and waits for each reply
+    
+    Parameters
+    ----------
+    commands: List[str]
+        Batch commands to send in order (ie ['goto chr17:7577120', 'snapshot test.png'])
+        
+    host: str, default='127.0.0.1'
+        Host running IGV
+        
+    port: int, default=60151
+        Port IGV is listening on (View > Preferences > Advanced > Enable port)
+        
+    timeout: int, default=60
+        Seconds to wait for IGV to reply to each command
+        
+    Returns
+    -------
+    List[str]
+        IGV's reply to each command
+    """
+    with IGVBatchConnection(host=host, port=port, timeout=timeout) as connection:
+        return connection.send(commands)
+
+
+def get_igv_track_name(bam, used_names=()):
+    """
+    Name to load a bam under, so its tracks can be removed by name later. 
+    Based on the file name, without characters that would split a batch command, and unique among used_names
+    """
+    base_name = re.sub(r'[^A-Za-z0-9._-]+', '_', os.path.basename(str(bam).split('?')[0])) or 'track'
+    name, i = base_name, 1
+    while name in used_names:
+        i += 1
+        name = f'{base_name}_{i}'
+    return name
+
+
+def get_igv_track_names(track_name):
+    """
+    Names of the tracks IGV creates when loading a bam under track_name (load <bam> name=<track_name>)
+    """
+    return [f'{track_name} Coverage', f'{track_name} Junctions', track_name]
+
+
+class IGVLocalSession:
+    """
+    Long-lived connection to a local IGV app. Requests are sent to IGV by a worker thread so callers
+    return immediately. Only the latest pending request is kept, so if several mutations are requested
+    while IGV is busy, only the last one is shown.
+    
+    The session remembers which bams are loaded, and the track names they were loaded under. 
+    When the next request uses the same bams, IGV only navigates to the new loci. 
+    Otherwise only the removed bams are unloaded and only the new bams are loaded.
+    """
+    def __init__(
+        self,
+        view_type="collapse",
+        sort="base",
+        img_dir="igv_snapshots/",
+        verbose=False,
+        recv_timeout=60,
+        max_retries=3,
+        reconnect_interval=5,
+        host='127.0.0.1',
+        port=60151,
+    ):
+        """
+        Parameters
+        ----------
+        view_type: str, ["collapsed", "expanded", "squished"], default="collapsed"
+            How to view the alignments.
+
+        sort: str, default="base"
+            Feature to sort by
+
+        img_dir: str, Path
+            Path to save igv snapshots
+
+        recv_timeout: int, default=60
+            Seconds to wait for IGV to reply to a command
+
+        max_retries: int, default=3
+            Number of times to reconnect and resend a request after a failure before dropping it
+
+        reconnect_interval: int, default=5
+            Seconds to wait before reconnecting after a failure
+
+        host: str, default='127.0.0.1'
+            Host running IGV
+            
+        port: int, default=60151
+            Port IGV is listening on
+        """
+        self.view_type = view_type
+        self.sort = sort
+        self.img_dir = img_dir
+        self.verbose = verbose
+        self.max_retries = max_retries
+        self.reconnect_interval = reconnect_interval
+        self.connection = IGVBatchConnection(host=host, port=port, timeout=recv_timeout)
+
+        # bam -> name of its tracks in IGV
+        self.loaded_tracks = None
+        self.status = 'IGV session idle'
+        self._pending = None
+        self._sending = False
+        self._n_submitted = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._worker_thread = threading.Thread(target=self._worker, daemon=True)
+        self._worker_thread.start()
+
+    def submit(self, bams_list, chroms, poss) -> str:
+        """
+        Queues a request to load bams into IGV and navigate to the loci. Replaces any request that has not been sent yet
+
+        Parameters
+        ----------
+        bams_list: List[Union[str, path]]
+            List of paths to bam files
+
+        chroms: List
+            List of chromosomes to navigate to
+
+        poss: List
+            List of position to navigate to. Corresponds chromosome value in chroms in the same index
+
+        Returns
+        -------
+        str
+            Status message
+        """
+        loci_str = ', '.join(f'{chrom}:{pos}' for chrom, pos in zip(chroms, poss))
+        with self._condition:
+            self._n_submitted += 1
+            replaced = self._pending is not None
+            self._pending = {
+                'bams_list': list(bams_list),
+                'chroms': list(chroms),
+                'poss': list(poss),
+                'request_id': self._n_submitted,
+                'retries': 0,
+            }
+            self.status = f'Queued request {self._n_submitted}: {len(bams_list)} bam(s) at {loci_str}.'
+            if replaced:
+                self.status += ' Replaced a request that had not been sent yet.'
+            self._condition.notify()
+        return self.status
+
+    def is_busy(self) -> bool:
+        """
+        Whether a request is waiting to be sent or being sent, including retries
+        """
+        with self._condition:
+            return self._pending is not None or self._sending
+
+    def reset_tracks(self):
+        """
+        Forget which bams are loaded, so the next request starts a new IGV session. 
+        Use if tracks were changed directly in the IGV app.
+        """
+        self.loaded_tracks = None
+
+    def close(self):
+        """
+        Stops the worker thread, drops any pending request and closes the connection to IGV
+        """
+        with self._condition:
+            self._closed = True
+            self._pending = None
+            self._condition.notify()
+
+    def _send_commands(self, commands):
+        if self.verbose:
+            print('\n'.join(commands))
+        replies = self.connection.send(commands)
+        errors = [r for r in replies if r.lower().startswith('error')]
+        if errors:
+            raise RuntimeError('; '.join(errors))
+
+    def _send(self, request):
+        bams_list = list(dict.fromkeys(request['bams_list']))
+        if self.loaded_tracks is None or len(bams_list) == 0:
+            self._send_commands(['new', f'snapshotDirectory {os.path.abspath(self.img_dir)}'])
+            self.loaded_tracks = {}
+        if len(bams_list) == 0:
+            return
+
+        removed_bams = [b for b in self.loaded_tracks if b not in bams_list]
+        added_bams = [b for b in bams_list if b not in self.loaded_tracks]
+
+        # tracks are unknown until the commands succeed
+        loaded_tracks = self.loaded_tracks
+        self.loaded_tracks = None
+        commands = [f'remove {name}' for b in removed_bams for name in get_igv_track_names(loaded_tracks[b])]
+        kept_tracks = {b: name for b, name in loaded_tracks.items() if b not in removed_bams}
+        added_tracks = {}
+        for b in added_bams:
+            added_tracks[b] = get_igv_track_name(b, used_names=set(kept_tracks.values()) | set(added_tracks.values()))
+            commands.append(f'load {b} name={added_tracks[b]}')
+
+        loci = [f'{chrom}:{pos}' for chrom, pos in zip(request['chroms'], request['poss'])]
+        commands += [
+            f'goto {" ".join(loci)}',
+            f'sort {self.sort}',
+            {'collapsed': 'collapse', 'expanded': 'expand', 'squished': 'squish'}.get(self.view_type, self.view_type),
+        ]
+        self._send_commands(commands)
+        self.loaded_tracks = {**kept_tracks, **added_tracks}
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    self.connection.close()
+                    return
+                request = self._pending
+                self._pending = None
+                self._sending = True
+
+            self.status = f'Loading request {request["request_id"]}'
+            try:
+                self._send(request)
+                self.status = f'Loaded request {request["request_id"]}'
+                self._sending = False
+            except Exception as e:
+                # close the connection so the next attempt reconnects, and start a new IGV session 
+                # as the tracks are unknown
+                self.connection.close()
+                self.loaded_tracks = None
+                request['retries'] += 1
+                if request['retries'] > self.max_retries:
+                    self.status = f'Failed request {request["request_id"]}: {e}'
+                    self._sending = False
+                    continue
+
+                self.status = f'Request {request["request_id"]} failed ({e}). Retrying in {self.reconnect_interval}s'
+                time.sleep(self.reconnect_interval)
+                with self._condition:
+                    if self._pending is None:
+                        self._pending = request
+                    self._sending = False
+
+
+_igv_local_sessions = {}
+_igv_local_sessions_lock = threading.Lock()
+
+def get_igv_local_session(**kwargs) -> IGVLocalSession:
+    """
+    Returns the IGVLocalSession shared by all callbacks using the same settings. See IGVLocalSession
+    """
+    key = tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+    with _igv_local_sessions_lock:
+        if key not in _igv_local_sessions:
+            _igv_local_sessions[key] = IGVLocalSession(**kwargs)
+        return _igv_local_sessions[key]
+
+
+def gen_igv_snapshot_filename(idx, locus_i, chrom, pos):
+    """
+    Name of the snapshot of one locus of a mutation. Characters that are not safe in file names are replaced by "_"
+    """
+    safe_idx = re.sub(r'[^A-Za-z0-9._-]+', '_', str(idx))
+    return f'{safe_idx}.locus{locus_i + 1}.{chrom}_{pos}.png'
+
+
+def gen_igv_snapshot_commands(
+    loci,
+    snapshot_fns,
+    bams_list=None,
+    bais_list=None,
+    view_type="collapsed",
+    sort="base",
+    max_panel_height=1000,
+):
+    """
+    IGV batch commands to take one snapshot per locus
+    
+    Parameters
+    ----------
+    loci: List[Tuple]
+        List of (chrom, pos) to take snapshots of
+        
+    snapshot_fns: List[str]
+        Absolute paths of the snapshot of each locus
+        
+    bams_list: List[str]
+        Bams to load in a new session before taking the snapshots. If None, uses the tracks already loaded
+        
+    bais_list: List[str]
+        Index of each bam in bams_list. If None, IGV looks for the index next to the bam
+        
+    view_type: str, ["collapsed", "expanded", "squished"], default="collapsed"
+        How to view the alignments
+        
+    sort: str, default="base"
+        Feature to sort the alignments by at each locus
+        
+    max_panel_height: int, default=1000
+        Maximum height of each panel in the snapshot
+        
+    Returns
+    -------
+    List[str]
+        Batch commands (see https://igv.org/doc/desktop/#UserGuide/tools/batch/)
+    """
+    commands = []
+    if bams_list is not None:
+        commands.append('new')
+        bais_list = [None] * len(bams_list) if bais_list is None else bais_list
+        for bam, bai in zip(bams_list, bais_list):
+            commands.append(f'load {bam}' if bai is None else f'load {bam} index={bai}')
+    commands.append(f'maxPanelHeight {max_panel_height}')
+    
+    for (chrom, pos), snapshot_fn in zip(loci, snapshot_fns):
+        commands += [
+            f'snapshotDirectory {os.path.dirname(snapshot_fn)}',
+            f'goto {chrom}:{pos}',
+            f'sort {sort} {chrom}:{pos}',
+            {'collapsed': 'collapse', 'expanded': 'expand', 'squished': 'squish'}.get(view_type, view_type),
+            f'snapshot {os.path.basename(snapshot_fn)}',
+        ]
+    return commands
+
+
+def run_igv_snapshot_batch(
+    tasks,
+    ports=(60151,),
+    host='127.0.0.1',
+    script_dir=None,
+    max_retries=2,
+    resume=True,
+    timeout=300,
+    view_type="collapsed",
+    sort="base",
+    verbose=False,
+):
+    """
+    Takes snapshots with a pool of running IGV apps, one worker per port. 
+    Tasks are pulled from a shared queue so faster instances take more tasks. 
+    A worker only reloads bams when they differ from the previous task it ran.
+    
+    Snapshots are written to a temporary name and renamed once IGV replies, 
+    so with resume=True, tasks whose snapshots all exist are skipped.
+    
+    Parameters
+    ----------
+    tasks: List[Dict]
+        Snapshot tasks with the keys 
+            - idx: mutation index name
+            - bams: list of bam paths or urls
+            - bais: list of the corresponding bai paths or urls
+            - loci: list of (chrom, pos)
+            - snapshot_fns: absolute path of the snapshot of each locus
+        
+    ports: List[int], default=(60151,)
+        Ports of the running IGV apps. Start one IGV per port (ie igv.sh --port 60152)
+        
+    host: str, default='127.0.0.1'
+        Host running the IGV apps
+        
+    script_dir: str, Path
+        If provided, the batch script of each task is written to this directory, 
+        so it can be rerun with IGV (igv.sh -b script.txt)
+        
+    max_retries: int, default=2
+        Number of times to retry a failed task, on any instance
+        
+    resume: bool, default=True
+        Skip tasks whose snapshots already exist
+        
+    timeout: int, default=300
+        Seconds to wait for IGV to reply to each command
+        
+    view_type: str, ["collapsed", "expanded", "squished"], default="collapsed"
+        How to view the alignments
+        
+    sort: str, default="base"
+        Feature to sort the alignments by
+        
+    Returns
+    -------
+    pd.DataFrame
+        One row per task with the idx, status ('done', 'skipped' or 'failed'), port, number of attempts and error
+    """
+    if script_dir is not None:
+        os.makedirs(script_dir, exist_ok=True)
+        
+    results = []
+    task_queue = queue.Queue()
+    for task in tasks:
+        if resume and all(os.path.exists(fn) for fn in task['snapshot_fns']):
+            results.append({'idx': task['idx'], 'status': 'skipped', 'port': None, 'attempts': 0, 'error': None})
+        else:
+            task_queue.put((task, 0))
+    results_lock = threading.Lock()
+    
+    def worker(port):
+        loaded_bams = None
+        n_connection_errors = 0
+        while True:
+            try:
+                task, attempts = task_queue.get_nowait()
+            except queue.Empty:
+                return
+            
+            tmp_fns = [f'{fn[:-len(".png")]}.{port}.tmp.png' for fn in task['snapshot_fns']]
+            bams = list(zip(task['bams'], task['bais']))
+            commands = gen_igv_snapshot_commands(
+                task['loci'],
+                tmp_fns,
+                bams_list=None if bams == loaded_bams else task['bams'],
+                bais_list=task['bais'],
+                view_type=view_type,
+                sort=sort,
+            )
+            try:
+                if script_dir is not None:
+                    script_commands = gen_igv_snapshot_commands(
+                        task['loci'], task['snapshot_fns'], task['bams'], task['bais'], view_type=view_type, sort=sort
+                    )
+                    safe_idx = os.path.basename(task['snapshot_fns'][0]).split('.locus')[0]
+                    with open(os.path.join(script_dir, f'{safe_idx}.txt'), 'w') as f:
+                        f.write('\n'.join(script_commands + ['exit']) + '\n')
+                    
+                for fn in task['snapshot_fns']:
+                    os.makedirs(os.path.dirname(fn), exist_ok=True)
+                loaded_bams = None
+                replies = send_igv_batch_commands(commands, host=host, port=port, timeout=timeout)
+                errors = [r for r in replies if r.lower().startswith('error')]
+                if errors:
+                    raise RuntimeError('; '.join(errors))
+                loaded_bams = bams
+                
+                missing_fns = [fn for fn in tmp_fns if not os.path.exists(fn)]
+                if missing_fns:
+                    raise RuntimeError(f'IGV did not write snapshots {missing_fns}')
+                for tmp_fn, fn in zip(tmp_fns, task['snapshot_fns']):
+                    os.replace(tmp_fn, fn)
+                n_connection_errors = 0
+                result = {'idx': task['idx'], 'status': 'done', 'port': port, 'attempts': attempts + 1, 'error': None}
+            except (ConnectionRefusedError, ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as e:
+                # IGV instance unreachable: give the task to another instance and stop using this port
+                # after repeated failures. Timeouts and file errors are failures of the task, retried below
+                task_queue.put((task, attempts))
+                n_connection_errors += 1
+                if verbose:
+                    print(f'IGV on port {port} unreachable: {e}')
+                if n_connection_errors > max_retries:
+                    return
+                time.sleep(1)
+                continue
+            except Exception as e:
+                for tmp_fn in tmp_fns:
+                    if os.path.exists(tmp_fn):
+                        os.remove(tmp_fn)
+                if attempts < max_retries:
+                    task_queue.put((task, attempts + 1))
+                    if verbose:
+                        print(f'Retrying {task["idx"]} after error on port {port}: {e}')
+                    continue
+                result = {'idx': task['idx'], 'status': 'failed', 'port': port, 'attempts': attempts + 1, 'error': str(e)}
+                
+            with results_lock:
+                results.append(result)
+                if verbose:
+                    print(f'{len(results)}/{len(tasks)} {task["idx"]}: {result["status"]}')
+    
+    threads = [threading.Thread(target=worker, args=(port,), daemon=True) for port in ports]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+        
+    while not task_queue.empty():
+        task, attempts = task_queue.get_nowait()
+        results.append({
+            'idx': task['idx'], 'status': 'failed', 'port': None, 'attempts': attempts, 'error': 'No IGV instance reachable'
+        })
+        
+    return pd.DataFrame(results, columns=['idx', 'status', 'port', 'attempts', 'error'])
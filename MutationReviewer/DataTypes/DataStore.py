@@ -0,0 +1,283 @@
+"""
+Fast save and load of GeneralMutationData objects. Tables (mutations_df, bams_df, the mutation index, the precomputed
+read evidence, reference context, panel of normals and suggested tags, and the annotation tables) are saved as
+uncompressed Feather (Arrow IPC) files next to a small manifest.json, and are memory-mapped when loaded.
+Requires pyarrow.
+"""
+import os
+import json
+import pickle
+import numpy as np
+import pandas as pd
+from typing import Union, List, Dict
+from pathlib import Path
+
+from MutationReviewer.DataTypes.GeneralMutationData import GeneralMutationData, MutationIndex
+
+
+DATA_STORE_VERSION = 1
+
+DATA_STORE_TABLES = [
+    'mutations_df',
+    'bams_df',
+    'read_evidence_df',
+    'mutation_read_evidence_df',
+    'reference_context_df',
+    'pon_df',
+    'mutation_tags_df',
+]
+
+DATA_STORE_ANNOTATION_TABLES = ['annot_df', 'history_df']
+
+DATA_STORE_CONFIG_ATTRS = [
+    'mutation_groupby_cols',
+    'mutations_df_bam_ref_col',
+    'chrom_cols',
+    'pos_cols',
+    'bams_df_ref_col',
+    'bam_cols',
+    'bai_cols',
+    'pon_coverage_col',
+    'mutations_df_memory_report',
+]
+
+
+def get_manifest_fn(store_dir: Union[str, Path]) -> str:
+    return os.path.join(str(store_dir), 'manifest.json')
+
+
+def write_table(df: pd.DataFrame, store_dir: Union[str, Path], name: str) -> Dict:
+    """
+    Writes a dataframe to store_dir as uncompressed Feather, so it can be memory-mapped.
+    Tables Arrow cannot represent (ie object columns mixing types) are pickled instead
+
+    Returns
+    -------
+    Dict
+        Manifest entry of the table, with the file name, format and number of rows
+    """
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        fn, table_format = f'{name}.feather', 'feather'
+        tmp_fn = os.path.join(str(store_dir), f'{fn}.tmp')
+        feather.write_feather(table, tmp_fn, compression='uncompressed')
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        fn, table_format = f'{name}.pkl', 'pickle'
+        tmp_fn = os.path.join(str(store_dir), f'{fn}.tmp')
+        with open(tmp_fn, 'wb') as f:
+            pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_fn, os.path.join(str(store_dir), fn))
+    return {'fn': fn, 'format': table_format, 'n_rows': int(df.shape[0])}
+
+
+def read_table(store_dir: Union[str, Path], entry: Dict, memory_map=True) -> pd.DataFrame:
+    """
+    Reads a table written by write_table(). Feather tables are memory-mapped if memory_map is True
+    """
+    fn = os.path.join(str(store_dir), entry['fn'])
+    if entry['format'] == 'pickle':
+        with open(fn, 'rb') as f:
+            return pickle.load(f)
+
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    table = feather.read_table(fn, memory_map=memory_map)
+    df = table.to_pandas(split_blocks=True)
+    # Arrow returns list columns (ie suggested tags, multi annotations) as numpy arrays
+    for field in table.schema:
+        if pa.types.is_list(field.type) or pa.types.is_large_list(field.type):
+            df[field.name] = [v.tolist() if isinstance(v, np.ndarray) else v for v in df[field.name]]
+    return df
+
+
+def save_mutation_data(data: GeneralMutationData, store_dir: Union[str, Path], slim_pickle=False) -> str:
+    """
+    Saves a GeneralMutationData object to store_dir. Existing files are replaced, and the manifest is written last
+    so an interrupted save is never loaded.
+
+    Parameters
+    ----------
+    data: GeneralMutationData
+        Data object to save
+
+    store_dir: str, Path
+        Directory to save the data in
+
+    slim_pickle: bool, default=False
+        Afterwards, pickling data (ie when annotations are saved) skips the saved tables as long as
+        they are not replaced, and reads them back from store_dir when unpickled. 
+        The pickle can then only be loaded while store_dir exists at the same absolute path
+
+    Returns
+    -------
+    str
+        Path to the manifest
+    """
+    store_dir = os.path.abspath(str(store_dir))
+    os.makedirs(store_dir, exist_ok=True)
+
+    tables = {name: getattr(data, name) for name in DATA_STORE_TABLES + DATA_STORE_ANNOTATION_TABLES}
+    tables['index'] = pd.DataFrame({'index': list(data.index)})
+    tables['mutation_index_groups'] = pd.DataFrame({
+        'name': data.mutation_index.names,
+        'end': data.mutation_index.group_bounds[1:],
+        # -1 if names are looked up in a dict, see MutationIndex
+        'name_order': -1 if data.mutation_index.name_order is None else data.mutation_index.name_order,
+    })
+    tables['mutation_index_rows'] = pd.DataFrame({
+        'group_id': data.mutation_index.group_ids,
+        'row_order': data.mutation_index.row_order,
+    })
+
+    # the annotation column configs hold AnnoMate validation objects, which are pickled
+    config_fn = 'annot_col_config_dict.pkl'
+    with open(os.path.join(store_dir, f'{config_fn}.tmp'), 'wb') as f:
+        pickle.dump(data.annot_col_config_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(os.path.join(store_dir, f'{config_fn}.tmp'), os.path.join(store_dir, config_fn))
+
+    manifest = {
+        'version': DATA_STORE_VERSION,
+        'description': data.description,
+        'config': {attr: getattr(data, attr) for attr in DATA_STORE_CONFIG_ATTRS},
+        'config_fn': config_fn,
+        'mutation_index_first_bound': int(data.mutation_index.group_bounds[0]),
+        'tables': {
+            name: write_table(df, store_dir, name) for name, df in tables.items() if df is not None
+        },
+    }
+
+    manifest_fn = get_manifest_fn(store_dir)
+    with open(f'{manifest_fn}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, default=str)
+    os.replace(f'{manifest_fn}.tmp', manifest_fn)
+
+    data.data_store_dir = store_dir
+    data._data_store_objects = {name: getattr(data, name) for name in DATA_STORE_TABLES + ['mutation_index']}
+    data.slim_pickle = slim_pickle
+    return manifest_fn
+
+
+def read_manifest(store_dir: Union[str, Path]) -> Dict:
+    with open(get_manifest_fn(store_dir)) as f:
+        manifest = json.load(f)
+    if manifest['version'] != DATA_STORE_VERSION:
+        raise ValueError(
+            f'Data store {store_dir} has version {manifest["version"]}. Expected version {DATA_STORE_VERSION}'
+        )
+    return manifest
+
+
+def read_data_store_tables(store_dir: Union[str, Path], table_names: List[str], memory_map=True) -> Dict:
+    """
+    Reads tables of a data store. "mutation_index" returns the MutationIndex.
+    Tables that were not saved (ie read evidence was not computed) are None
+
+    Returns
+    -------
+    Dict
+        Table name to dataframe (or MutationIndex)
+    """
+    manifest = read_manifest(store_dir)
+    tables = {}
+    for name in table_names:
+        if name == 'mutation_index':
+            groups_df = read_table(store_dir, manifest['tables']['mutation_index_groups'], memory_map=memory_map)
+            rows_df = read_table(store_dir, manifest['tables']['mutation_index_rows'], memory_map=memory_map)
+            tables[name] = MutationIndex(
+                groups_df['name'].to_numpy(dtype=object),
+                rows_df['group_id'].to_numpy(),
+                row_order=rows_df['row_order'].to_numpy(),
+                group_bounds=np.append(
+                    [manifest['mutation_index_first_bound']], groups_df['end'].to_numpy()
+                ).astype(np.int64),
+                name_order=None if (groups_df['name_order'] < 0).any() else groups_df['name_order'].to_numpy(),
+            )
+        elif name in manifest['tables']:
+            tables[name] = read_table(store_dir, manifest['tables'][name], memory_map=memory_map)
+        else:
+            tables[name] = None
+    return tables
+
+
+def load_mutation_data(
+    store_dir: Union[str, Path],
+    description: str = None,
+    annot_df: pd.DataFrame = None,
+    annot_col_config_dict: Dict = None,
+    history_df: pd.DataFrame = None,
+    memory_map=True,
+    slim_pickle=False,
+) -> GeneralMutationData:
+    """
+    Loads a GeneralMutationData object saved with save_mutation_data(), without rebuilding the mutation index
+    or recomputing the read evidence, reference context, panel of normals and suggested tags
+
+    Parameters
+    ----------
+    store_dir: str, Path
+        Directory the data was saved in
+
+    description: str
+        Overrides the saved description
+
+    annot_df, annot_col_config_dict, history_df:
+        Override the saved annotation tables (ie from a newer review session)
+
+    memory_map: bool, default=True
+        Memory-map the Feather files instead of reading them into memory
+
+    slim_pickle: bool, default=False
+        Pickle the data without the tables read from store_dir. See save_mutation_data()
+
+    Returns
+    -------
+    GeneralMutationData
+        The saved data object
+    """
+    store_dir = os.path.abspath(str(store_dir))
+    manifest = read_manifest(store_dir)
+    tables = read_data_store_tables(
+        store_dir,
+        ['index', 'mutation_index'] + DATA_STORE_TABLES + DATA_STORE_ANNOTATION_TABLES,
+        memory_map=memory_map,
+    )
+    if annot_col_config_dict is None:
+        with open(os.path.join(store_dir, manifest['config_fn']), 'rb') as f:
+            annot_col_config_dict = pickle.load(f)
+
+    config = manifest['config']
+    data = GeneralMutationData(
+        index=tables['index']['index'].tolist(),
+        description=manifest['description'] if description is None else description,
+        mutations_df=tables['mutations_df'],
+        mutation_groupby_cols=config['mutation_groupby_cols'],
+        mutations_df_bam_ref_col=config['mutations_df_bam_ref_col'],
+        chrom_cols=config['chrom_cols'],
+        pos_cols=config['pos_cols'],
+        bams_df=tables['bams_df'],
+        bams_df_ref_col=config['bams_df_ref_col'],
+        bam_cols=config['bam_cols'],
+        bai_cols=config['bai_cols'],
+        annot_df=annot_df,
+        annot_col_config_dict=annot_col_config_dict,
+        history_df=history_df,
+        mutation_index=tables['mutation_index'],
+    )
+    # annotation tables are restored as saved, unless newer ones are provided
+    if annot_df is None and tables['annot_df'] is not None:
+        data.annot_df = tables['annot_df']
+    if history_df is None and tables['history_df'] is not None:
+        data.history_df = tables['history_df']
+    for name in ['read_evidence_df', 'mutation_read_evidence_df', 'reference_context_df', 'pon_df', 'mutation_tags_df']:
+        setattr(data, name, tables[name])
+    data.pon_coverage_col = config['pon_coverage_col']
+    data.mutations_df_memory_report = config['mutations_df_memory_report']
+
+    data.data_store_dir = store_dir
+    data._data_store_objects = {name: getattr(data, name) for name in DATA_STORE_TABLES + ['mutation_index']}
+    data.slim_pickle = slim_pickle
+    return data
@@ -6,6 +6,334 @@ import numpy as np
 from typing import Union, List, Dict
 from pathlib import Path
 import os
+import threading
+
+from MutationReviewer.ReadData.ReadEvidence import compute_read_evidence, gen_mutation_read_evidence_df, READ_EVIDENCE_METRICS
+from MutationReviewer.ReadData.ReferenceContext import compute_reference_context, REFERENCE_CONTEXT_DISPLAY_COLS
+from MutationReviewer.ReadData.PanelOfNormals import compute_pon
+from MutationReviewer.Annotations.TagRules import gen_mutation_tags_df, TAG_ANNOTATIONS
+
+
+# guards the history buffer while the annotation log appends rows and the app reads history_df
+_history_lock = threading.RLock()
+
+# minimum number of rows allocated for history_df when it is appended to (see GeneralMutationData.append_history_rows)
+HISTORY_BUFFER_MIN_ROWS = 1024
+
+
+def gen_mutation_index_name(value_list):
+    """
+    Default function to name a group of mutations from the values of the groupby columns
+    """
+    return ':'.join(value_list)
+
+
+class MutationIndex:
+    """
+    Compact mapping of each mutation index name to the row positions of mutations_df belonging to that group.
+    Rows are stored once, ordered by group, so large indices do not hold one array per group. 
+    Names are looked up by binary search over their sorted order, which is faster to build than a hash table of all names.
+    """
+    def __init__(
+        self, 
+        names: np.ndarray, 
+        group_ids: np.ndarray, 
+        row_order: np.ndarray = None, 
+        group_bounds: np.ndarray = None, 
+        name_order: np.ndarray = None,
+    ):
+        """
+        Parameters
+        ----------
+        names: np.ndarray
+            Unique name of each group, in index order
+
+        group_ids: np.ndarray
+            Group number (position in names) of each row of mutations_df. -1 for rows that do not belong to a group
+
+        row_order, group_bounds, name_order: np.ndarray
+            Previously computed row_order, group_bounds and name_order (ie from a saved data store). 
+            Computed from group_ids and names if None
+        """
+        self.names = np.asarray(names, dtype=object)
+        self.group_ids = np.asarray(group_ids)
+        if row_order is None or group_bounds is None:
+            # rows with a group id of -1 sort first and are excluded by the bounds
+            row_order = np.argsort(self.group_ids, kind='stable')
+            group_bounds = np.searchsorted(self.group_ids[row_order], np.arange(len(self.names) + 1))
+        self.row_order = np.asarray(row_order)
+        self.group_bounds = np.asarray(group_bounds)
+
+        if name_order is None:
+            try:
+                name_order = np.argsort(self.names, kind='stable')
+            except TypeError:
+                # names that cannot be compared with each other are looked up in a dict
+                name_order = None
+        self.name_order = name_order
+        self._name_to_group = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return self.get_group_ids([name])[0] >= 0
+
+    def keys(self) -> List[str]:
+        return self.names.tolist()
+
+    def get_group_ids(self, names) -> np.ndarray:
+        """
+        Group number (position in names) of each name. -1 for names that are not in the index
+        """
+        lookup_names = np.empty(len(names), dtype=object)
+        lookup_names[:] = list(names)
+        if len(lookup_names) == 0 or len(self.names) == 0:
+            return np.full(len(lookup_names), -1)
+
+        if self.name_order is None:
+            if self._name_to_group is None:
+                self._name_to_group = {name: i for i, name in enumerate(self.names)}
+            return np.array([self._name_to_group.get(name, -1) for name in lookup_names])
+
+        try:
+            sorted_i = np.searchsorted(self.names, lookup_names, sorter=self.name_order)
+        except TypeError:
+            return np.full(len(lookup_names), -1)
+        group_ids = self.name_order[np.minimum(sorted_i, len(self.names) - 1)]
+        return np.where(self.names[group_ids] == lookup_names, group_ids, -1)
+
+    def get(self, name, default=None) -> np.ndarray:
+        """
+        Row positions (for .iloc) in mutations_df of the group named name, in row order
+        """
+        group_i = self.get_group_ids([name])[0]
+        if group_i < 0:
+            return default
+        return self.row_order[self.group_bounds[group_i]:self.group_bounds[group_i + 1]]
+
+
+def renumber_group_ids(group_ids: np.ndarray):
+    """
+    Renumbers group ids to 0..n_groups - 1, keeping their order. Ids of -1 are kept
+    """
+    valid = group_ids >= 0
+    unique_ids, new_ids = np.unique(group_ids[valid], return_inverse=True)
+    group_ids = np.full(len(group_ids), -1, dtype=np.int64)
+    group_ids[valid] = new_ids
+    return group_ids, len(unique_ids)
+
+
+def has_unique_strs(values, value_strs) -> bool:
+    """
+    Whether distinct values have distinct strings without ':', so the names joining them are distinct
+    """
+    if np.asarray(values).dtype.kind in 'iub':
+        return True
+    return pd.Index(value_strs).is_unique and not any(':' in value_str for value_str in value_strs)
+
+
+def build_mutation_index(
+    mutations_df: pd.DataFrame,
+    mutation_groupby_cols: list,
+    gen_data_mut_index_name_func=gen_mutation_index_name,
+) -> MutationIndex:
+    """
+    Maps each mutation index name to the row positions of mutations_df belonging to that group.
+    Each groupby column is factorized and the names are built once per group. mutations_df is not modified.
+
+    Groups follow mutations_df.groupby(mutation_groupby_cols) on the original column types, as gen_data did before
+    the index was built here, rather than grouping the columns converted to strings:
+
+    - rows with a missing value in any groupby column are left out of the index, instead of being named "nan"
+    - numeric columns are ordered by value (ie chromosomes 1, 2, 10 and positions 900, 1000), not as strings
+
+    Parameters
+    ----------
+    mutations_df: pd.DataFrame
+        Dataframe with mutations to review
+
+    mutation_groupby_cols: list
+        List of columns in mutations_df to group mutations by
+
+    gen_data_mut_index_name_func: func
+        Function that takes the list of string values of the groupby columns and returns the mutation index name
+
+    Returns
+    -------
+    MutationIndex
+        Mutation index name to the row positions in mutations_df, ordered like the sorted groupby keys. 
+        Groups with the same name are merged
+    """
+    # number the groups from the factorized codes of each column. Codes are sorted like the values, 
+    # so groups are numbered in the order of the sorted groupby keys
+    col_codes = []
+    col_values = []
+    group_ids = np.zeros(mutations_df.shape[0], dtype=np.int64)
+    n_groups = 1
+    for col in mutation_groupby_cols:
+        codes, values = pd.factorize(mutations_df[col], sort=True)
+        col_codes.append(codes)
+        col_values.append(values)
+        # rows with missing groupby values are labeled -1 and excluded, as with groupby
+        group_ids = np.where((group_ids < 0) | (codes < 0), -1, group_ids * len(values) + codes)
+        n_groups *= len(values)
+        if n_groups > np.iinfo(np.int32).max:
+            # renumber the groups seen so far so the ids of the next columns do not overflow
+            group_ids, n_groups = renumber_group_ids(group_ids)
+
+    # sorting the rows by group both renumbers the groups present and gives the rows of each group
+    row_order = np.argsort(group_ids, kind='stable')
+    sorted_group_ids = group_ids[row_order]
+    n_missing = np.searchsorted(sorted_group_ids, 0)
+    group_starts = n_missing + np.flatnonzero(np.diff(sorted_group_ids[n_missing:], prepend=-1))
+    group_bounds = np.append(group_starts, len(group_ids))
+    group_ids = np.full(len(group_ids), -1, dtype=np.int64)
+    group_ids[row_order[n_missing:]] = np.repeat(np.arange(len(group_starts)), np.diff(group_bounds))
+    first_rows = row_order[group_starts]
+
+    # each distinct value is converted to a string once, and each name is built once per group
+    col_strs = [np.array([str(v) for v in values.tolist()], dtype=object) for values in col_values]
+    key_strs = [value_strs[codes[first_rows]].tolist() for value_strs, codes in zip(col_strs, col_codes)]
+    if gen_data_mut_index_name_func is gen_mutation_index_name:
+        names = np.array([':'.join(key) for key in zip(*key_strs)], dtype=object)
+        unique_names = all(has_unique_strs(values, value_strs) for values, value_strs in zip(col_values, col_strs))
+    else:
+        names = np.array([gen_data_mut_index_name_func(list(key)) for key in zip(*key_strs)], dtype=object)
+        unique_names = False
+
+    if not unique_names:
+        # merge groups with the same name, keeping the order of their first group
+        name_codes, merged_names = pd.factorize(names)
+        if len(merged_names) < len(names):
+            group_ids = np.where(group_ids >= 0, name_codes[group_ids], -1)
+            return MutationIndex(np.asarray(merged_names, dtype=object), group_ids)
+    return MutationIndex(names, group_ids, row_order=row_order, group_bounds=group_bounds)
+
+
+def build_bam_table(
+    bams_df: pd.DataFrame,
+    bams_df_ref_col: str,
+    bam_cols: list,
+    bai_cols: list,
+):
+    """
+    Reshapes bams_df to one row per bam file and its corresponding bai file, 
+    and indexes the rows by the values of bams_df_ref_col
+
+    Parameters
+    ----------
+    bams_df: pd.DataFrame
+        Dataframe with bam files
+
+    bams_df_ref_col: str
+        Column in bams_df to query the bam files (ie sample, participant)
+
+    bam_cols: list
+        Columns in bams_df with the bam file paths or urls
+
+    bai_cols: list
+        Columns in bams_df with the corresponding bai file paths or urls
+
+    Returns
+    -------
+    pd.DataFrame
+        Table with the columns of bams_df other than bam_cols and bai_cols, 
+        and the bam_source, bam, bai_source and bai columns. Rows without a bam are dropped. 
+        Rows are ordered like bams_df, then like bam_cols
+
+    Dict[Any, np.ndarray]
+        Dictionary of bams_df_ref_col value to the row positions (for .iloc) in the table
+    """
+    info_cols = [c for c in bams_df.columns if c not in bam_cols + bai_cols]
+    pair_dfs = []
+    for pair_i, (bam_col, bai_col) in enumerate(zip(bam_cols, bai_cols)):
+        pair_df = bams_df[info_cols].assign(
+            bam_source=bam_col, 
+            bam=bams_df[bam_col], 
+            bai_source=bai_col, 
+            bai=bams_df[bai_col],
+            _row=np.arange(bams_df.shape[0]),
+            _pair=pair_i,
+        )
+        pair_dfs.append(pair_df)
+
+    bam_table_df = pd.concat(pair_dfs, ignore_index=True)
+    bam_table_df = bam_table_df.loc[bam_table_df['bam'].notna()]
+    bam_table_df = bam_table_df.sort_values(['_row', '_pair'], kind='stable').drop(columns=['_row', '_pair'])
+    bam_table_df = bam_table_df.reset_index(drop=True)
+
+    bam_table_index = {
+        ref_value: np.asarray(positions) 
+        for ref_value, positions in bam_table_df.groupby(bams_df_ref_col, sort=False).indices.items()
+    }
+    return bam_table_df, bam_table_index
+
+
+def get_df_memory_usage(df: pd.DataFrame) -> int:
+    """
+    Bytes used by a dataframe, including the contents of object columns
+    """
+    return int(df.memory_usage(deep=True, index=True).sum())
+
+
+def compact_df(df: pd.DataFrame, keep_cols: list = None, max_category_frac=0.5):
+    """
+    Compact copy of a dataframe. The input dataframe is not modified.
+        - columns not in keep_cols are dropped
+        - string columns with few distinct values (ie chromosome, gene, sample ids, classifications) become categorical
+        - integer columns (ie positions) become int32 when their values fit
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Dataframe to compact
+
+    keep_cols: list
+        Columns to keep, in their original order. If None, all columns are kept
+
+    max_category_frac: float, default=0.5
+        String columns with at most max_category_frac * number of rows distinct values become categorical
+
+    Returns
+    -------
+    pd.DataFrame
+        Compacted dataframe, with the same index
+
+    Dict
+        Memory report with before_bytes, after_bytes, dropped_cols, categorical_cols and int32_cols
+    """
+    before_bytes = get_df_memory_usage(df)
+    cols = df.columns.tolist() if keep_cols is None else [c for c in df.columns if c in set(keep_cols)]
+
+    compact_cols = {}
+    categorical_cols = []
+    int32_cols = []
+    int32_info = np.iinfo(np.int32)
+    for col in cols:
+        values = df[col]
+        if pd.api.types.is_integer_dtype(values.dtype) and values.dtype.itemsize > 4 and not values.empty \
+                and int32_info.min <= values.min() and values.max() <= int32_info.max:
+            values = values.astype(np.int32 if isinstance(values.dtype, np.dtype) else 'Int32')
+            int32_cols.append(col)
+        elif (values.dtype == object or pd.api.types.is_string_dtype(values.dtype)) \
+                and not isinstance(values.dtype, pd.CategoricalDtype) \
+                and pd.api.types.infer_dtype(values, skipna=True) in ('string', 'empty') \
+                and values.nunique() <= max_category_frac * len(values):
+            # only all-string columns, so categories sort like the original values
+            values = values.astype('category')
+            categorical_cols.append(col)
+        compact_cols[col] = values
+
+    compacted_df = pd.DataFrame(compact_cols, index=df.index)
+    return compacted_df, {
+        'before_bytes': before_bytes,
+        'after_bytes': get_df_memory_usage(compacted_df),
+        'dropped_cols': [c for c in df.columns if c not in compact_cols],
+        'categorical_cols': categorical_cols,
+        'int32_cols': int32_cols,
+    }
+
 
 class GeneralMutationData(Data):
     """
@@ -27,6 +355,7 @@ class GeneralMutationData(Data):
         annot_df: pd.DataFrame = None,
         annot_col_config_dict: Dict = None,
         history_df: pd.DataFrame = None,
+        mutation_index: MutationIndex = None,
     ):
         """
         Parameters
@@ -67,6 +396,10 @@ class GeneralMutationData(Data):
         bai_cols:
             Column(s) in bams_df with the bai file paths or urls. 
             Must be same length as bam_cols and corresponding bam/bai columns must be in the same order
+
+        mutation_index: MutationIndex
+            Mutation index name to row positions in mutations_df. See build_mutation_index().
+            If None, it is built from mutation_groupby_cols with gen_mutation_index_name()
         """
         super().__init__(
             index=index,
@@ -106,3 +439,394 @@ class GeneralMutationData(Data):
         self.bams_df_ref_col = bams_df_ref_col
         self.bam_cols = bam_cols
         self.bai_cols = bai_cols
+
+        self.mutation_index = mutation_index if mutation_index is not None else build_mutation_index(
+            mutations_df, mutation_groupby_cols
+        )
+        self.bam_table_df, self.bam_table_index = build_bam_table(bams_df, bams_df_ref_col, bam_cols, bai_cols)
+        self.bam_table_records = self.bam_table_df.to_dict('records')
+        
+        self.read_evidence_df = None
+        self.mutation_read_evidence_df = None
+        self.reference_context_df = None
+        self.pon_df = None
+        self.pon_coverage_col = None
+        self.mutation_tags_df = None
+        self.mutations_df_memory_report = None
+        self.data_store_dir = None
+        self._data_store_objects = {}
+        # pickle without the tables saved in data_store_dir. See DataTypes.DataStore.save_mutation_data
+        self.slim_pickle = False
+        # last event of the annotation log included in annot_df and history_df. See Annotations.AnnotationLog
+        self.annotation_log_event_id = 0
+
+    @property
+    def history_df(self) -> pd.DataFrame:
+        """
+        Table of all annotation events. After append_history_rows(), it is a view of the filled rows of a buffer
+        """
+        with _history_lock:
+            return self._history_df
+
+    @history_df.setter
+    def history_df(self, history_df: pd.DataFrame):
+        with _history_lock:
+            self._history_df = history_df
+            self._history_buffer = None
+            self._history_buffer_columns = None
+
+    def append_history_rows(self, rows: List[Dict]):
+        """
+        Adds annotation events to history_df. Rows are written into spare rows of an object array 
+        that doubles in size when full, so history_df is not copied for each event
+        """
+        with _history_lock:
+            history_df = self._history_df
+            columns = list(history_df.columns)
+            columns += list(dict.fromkeys(c for row in rows for c in row if c not in columns))
+            n_rows = history_df.shape[0]
+            buffer = self.__dict__.get('_history_buffer')
+            # rebuilt when history_df was replaced or had columns added (ie by ReviewDataInterface.add_annotation)
+            if buffer is None or buffer.shape[0] < n_rows + len(rows) or columns != self._history_buffer_columns \
+                    or list(history_df.columns) != columns:
+                buffer = np.empty((max(2 * (n_rows + len(rows)), HISTORY_BUFFER_MIN_ROWS), len(columns)), dtype=object)
+                buffer[:n_rows] = history_df.reindex(columns=columns).to_numpy(dtype=object)
+
+            for i, row in enumerate(rows):
+                # set cell by cell, so list values of "multi" annotations are not broadcast
+                for j, c in enumerate(columns):
+                    buffer[n_rows + i, j] = row.get(c, np.nan)
+
+            self._history_df = pd.DataFrame(buffer[:n_rows + len(rows)], columns=columns, dtype=object, copy=False)
+            self._history_buffer = buffer
+            self._history_buffer_columns = columns
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the view of the filled rows is pickled, not the spare rows
+        state.pop('_history_buffer', None)
+        state.pop('_history_buffer_columns', None)
+        data_store_objects = state.pop('_data_store_objects', None) or {}
+        # with slim_pickle, tables unchanged since they were saved to or loaded from the data store are not pickled, 
+        # they are read back from the data store when unpickled
+        state['_data_store_table_names'] = [
+            name for name, obj in data_store_objects.items() if state.get(name) is obj and obj is not None
+        ] if getattr(self, 'slim_pickle', False) else []
+        for name in state['_data_store_table_names']:
+            state[name] = None
+        return state
+
+    def __setstate__(self, state):
+        table_names = state.pop('_data_store_table_names', [])
+        if 'history_df' in state:
+            # pickled before history_df was a property
+            state['_history_df'] = state.pop('history_df')
+        self.__dict__.update(state)
+        self.__dict__.setdefault('data_store_dir', None)
+        self.__dict__.setdefault('slim_pickle', False)
+        self._data_store_objects = {}
+        if len(table_names) > 0:
+            from MutationReviewer.DataTypes.DataStore import read_data_store_tables, get_manifest_fn
+            if not os.path.exists(get_manifest_fn(self.data_store_dir)):
+                raise FileNotFoundError(
+                    f'This data was pickled with slim_pickle=True and its tables are read from the data store '
+                    f'{self.data_store_dir}, which no longer exists. If the data store was moved, '
+                    f'load it with DataTypes.DataStore.load_mutation_data(<new data store dir>) instead.'
+                )
+            self._data_store_objects = read_data_store_tables(self.data_store_dir, table_names)
+            self.__dict__.update(self._data_store_objects)
+
+    def compact_mutations_df(self, keep_cols: list = None, max_category_frac=0.5, verbose=True) -> Dict:
+        """
+        Replaces mutations_df with a compact copy (see compact_df()). The columns used as keys 
+        (mutation_groupby_cols, mutations_df_bam_ref_col, chrom_cols and pos_cols) are always kept. 
+        Rows keep their positions, so the mutation index and precomputed tables are unchanged
+        
+        Parameters
+        ----------
+        keep_cols: list
+            Other columns of mutations_df to keep (ie the displayed columns and the allele columns). 
+            If None, all columns are kept
+            
+        max_category_frac: float, default=0.5
+            See compact_df()
+            
+        verbose: bool, default=True
+            Print the memory used by mutations_df before and after
+            
+        Returns
+        -------
+        Dict
+            Memory report of compact_df(), also stored in mutations_df_memory_report
+        """
+        if keep_cols is not None:
+            keep_cols = list(keep_cols) + self.mutation_groupby_cols + [self.mutations_df_bam_ref_col] \
+                + self.chrom_cols + self.pos_cols
+        self.mutations_df, self.mutations_df_memory_report = compact_df(
+            self.mutations_df, keep_cols=keep_cols, max_category_frac=max_category_frac
+        )
+        if verbose:
+            report = self.mutations_df_memory_report
+            print(
+                f'mutations_df memory: {report["before_bytes"] / 1024 ** 2:.1f} MB -> '
+                f'{report["after_bytes"] / 1024 ** 2:.1f} MB '
+                f'({len(report["dropped_cols"])} columns dropped, {len(report["categorical_cols"])} categorical, '
+                f'{len(report["int32_cols"])} int32)'
+            )
+        return self.mutations_df_memory_report
+
+    def get_mutation_row_positions(self, idx) -> np.ndarray:
+        """
+        Row positions in mutations_df of the mutations in the group named idx. Empty if idx is not in the index
+        """
+        return self.mutation_index.get(idx, np.array([], dtype=int))
+
+    def get_mutation_df(self, idx, cols: list = None) -> pd.DataFrame:
+        """
+        Rows of mutations_df belonging to the mutation group named idx
+
+        Parameters
+        ----------
+        idx: str
+            Name of the mutation group (an item of the data index)
+
+        cols: list
+            Optional subset of columns to return
+
+        Returns
+        -------
+        pd.DataFrame
+            Subset of mutations_df corresponding to idx
+        """
+        idx_mut_df = self.mutations_df.iloc[self.get_mutation_row_positions(idx)]
+        return idx_mut_df if cols is None else idx_mut_df[cols]
+
+
+    def get_bam_table_row_positions(self, idx) -> np.ndarray:
+        """
+        Row positions in bam_table_df of the bams referenced by the mutations in the group named idx, 
+        in the order of bams_df
+        """
+        bam_ref_values = pd.unique(self.get_mutation_df(idx, self.mutations_df_bam_ref_col))
+        positions = [self.bam_table_index[v] for v in bam_ref_values if v in self.bam_table_index]
+        if len(positions) == 0:
+            return np.array([], dtype=int)
+        return np.sort(np.concatenate(positions))
+
+    def get_bam_table_df(self, idx, cols: list = None) -> pd.DataFrame:
+        """
+        Rows of bam_table_df (one row per bam and bai pair) of the bams relevant to the mutation group named idx
+
+        Parameters
+        ----------
+        idx: str
+            Name of the mutation group (an item of the data index)
+
+        cols: list
+            Optional subset of columns to return
+
+        Returns
+        -------
+        pd.DataFrame
+            Subset of bam_table_df corresponding to idx
+        """
+        idx_bam_table_df = self.bam_table_df.iloc[self.get_bam_table_row_positions(idx)].reset_index(drop=True)
+        return idx_bam_table_df if cols is None else idx_bam_table_df[cols]
+
+    def get_bam_table_records(self, idx, cols: list) -> List[Dict]:
+        """
+        Same as get_bam_table_df() as a list of records, built from the precomputed records of bam_table_df
+        """
+        return [
+            {c: self.bam_table_records[i][c] for c in cols} 
+            for i in self.get_bam_table_row_positions(idx)
+        ]
+
+
+    def compute_read_evidence(
+        self, 
+        ref_allele_col: str, 
+        alt_allele_col: str, 
+        n_workers: int = None, 
+        min_mapping_quality=0, 
+        min_base_quality=0,
+    ):
+        """
+        Counts the reads supporting each mutation in each of its bams in parallel, 
+        and stores the results in read_evidence_df (one row per mutation and bam) 
+        and mutation_read_evidence_df (one row per mutation in mutations_df). 
+        See ReadData.ReadEvidence.compute_read_evidence()
+        
+        Parameters
+        ----------
+        ref_allele_col: str
+            Column in mutations_df with the reference allele
+            
+        alt_allele_col: str
+            Column in mutations_df with the alternate allele
+            
+        n_workers: int
+            Number of processes. If None, uses the number of cpus
+            
+        min_mapping_quality: int, default=0
+            Reads with a lower mapping quality are ignored
+            
+        min_base_quality: int, default=0
+            Bases with a lower base quality are ignored
+        """
+        self.read_evidence_df = compute_read_evidence(
+            self, 
+            ref_allele_col, 
+            alt_allele_col, 
+            n_workers=n_workers, 
+            min_mapping_quality=min_mapping_quality, 
+            min_base_quality=min_base_quality,
+        )
+        self.mutation_read_evidence_df = gen_mutation_read_evidence_df(self.read_evidence_df, self.mutations_df.shape[0])
+
+    def compute_reference_context(self, fasta_path, flank=20, block_size=1_000_000, thresholds: dict = None):
+        """
+        Reads the reference around every mutation and finds the repeats at each mutation. 
+        Stores the results in reference_context_df (one row per mutation in mutations_df). 
+        See ReadData.ReferenceContext.compute_reference_context()
+        
+        Parameters
+        ----------
+        fasta_path: str, Path
+            Path to the indexed reference fasta the mutations were called against
+            
+        flank: int, default=20
+            Number of reference bases on each side of the mutation
+            
+        block_size: int, default=1_000_000
+            Maximum span of the reference read at once
+            
+        thresholds: dict
+            Values overriding ReadData.ReferenceContext.DEFAULT_REPEAT_THRESHOLDS
+        """
+        self.reference_context_df = compute_reference_context(
+            self, fasta_path, flank=flank, block_size=block_size, thresholds=thresholds
+        )
+
+    def compute_pon(
+        self, 
+        pon_path, 
+        ref_allele_col: str = None, 
+        alt_allele_col: str = None, 
+        coverage_col: str = None, 
+        cache_dir='pon_cache/', 
+        **query_kwargs
+    ):
+        """
+        Looks up the panel of normals record of every mutation in one sweep per chromosome and stores the results 
+        in pon_df (one row per mutation in mutations_df). See ReadData.PanelOfNormals.compute_pon()
+        
+        Parameters
+        ----------
+        pon_path: str, Path
+            bgzipped, tabix-indexed panel of normals
+            
+        ref_allele_col, alt_allele_col: str
+            Columns in mutations_df with the alleles, to match PoN records on alleles
+            
+        coverage_col: str
+            Column of the PoN with the number of normals covering the site, used to suggest normal_tags. 
+            Added to value_cols if they are given without it
+            
+        cache_dir: str, Path, default='pon_cache/'
+            Directory to cache results in, keyed by the PoN checksum. If None, results are not cached
+            
+        **query_kwargs:
+            Arguments for ReadData.PanelOfNormals.query_pon() (ie chrom_col, pos_col, ref_col, alt_col, value_cols)
+        """
+        value_cols = query_kwargs.get('value_cols')
+        if coverage_col is not None and value_cols is not None and coverage_col not in value_cols:
+            query_kwargs['value_cols'] = list(value_cols) + [coverage_col]
+        pon_df = compute_pon(
+            self, 
+            pon_path, 
+            ref_allele_col=ref_allele_col, 
+            alt_allele_col=alt_allele_col, 
+            cache_dir=cache_dir, 
+            **query_kwargs
+        )
+        if coverage_col is not None and f'pon_{coverage_col}' not in pon_df.columns:
+            # ie the coverage column is one of the PoN's chrom, pos, ref or alt columns
+            raise ValueError(f'coverage_col "{coverage_col}" is not a value column of the PoN: {list(pon_df.columns)}')
+        self.pon_df = pon_df
+        self.pon_coverage_col = None if coverage_col is None else f'pon_{coverage_col}'
+
+    def get_mutation_table_df(self, idx, cols: list = None) -> pd.DataFrame:
+        """
+        Same as get_mutation_df() with the read evidence summary, reference context and panel of normals columns added, 
+        if computed
+        """
+        idx_mut_df = self.get_mutation_df(idx, cols)
+        positions = self.get_mutation_row_positions(idx)
+        table_dfs = [idx_mut_df.reset_index(drop=True)]
+        if self.mutation_read_evidence_df is not None:
+            table_dfs.append(self.mutation_read_evidence_df.iloc[positions].reset_index(drop=True))
+        if self.reference_context_df is not None:
+            table_dfs.append(self.reference_context_df[REFERENCE_CONTEXT_DISPLAY_COLS].iloc[positions].reset_index(drop=True))
+        if self.pon_df is not None:
+            table_dfs.append(self.pon_df.iloc[positions].reset_index(drop=True))
+        if len(table_dfs) == 1:
+            return idx_mut_df
+        return pd.concat(table_dfs, axis=1)
+
+    def get_bam_table_read_evidence_df(self, idx) -> pd.DataFrame:
+        """
+        Read evidence of each bam in the bam table of the mutation group named idx, aligned with get_bam_table_df(). 
+        If several mutations of the group use the same bam, the evidence of the first one is used. 
+        Returns None if read evidence was not computed
+        """
+        if self.read_evidence_df is None:
+            return None
+        mutation_rows = self.read_evidence_df['mutation_row'].to_numpy()
+        positions = self.get_mutation_row_positions(idx)
+        evidence_positions = np.concatenate(
+            [np.arange(np.searchsorted(mutation_rows, p), np.searchsorted(mutation_rows, p, side='right')) for p in positions] 
+            + [np.array([], dtype=int)]
+        )
+        idx_evidence_df = self.read_evidence_df.iloc[evidence_positions].drop_duplicates('bam_table_row')
+        return idx_evidence_df.set_index('bam_table_row').reindex(
+            self.get_bam_table_row_positions(idx)
+        )[READ_EVIDENCE_METRICS].reset_index(drop=True)
+
+    def compute_mutation_tags(self, tumor_bam_col: str = None, normal_bam_col: str = None, thresholds: dict = None):
+        """
+        Suggests tags for every mutation group from the read evidence, reference context and panel of normals, 
+        and stores them in mutation_tags_df. 
+        See Annotations.TagRules.gen_mutation_tags_df()
+        
+        Parameters
+        ----------
+        tumor_bam_col: str
+            Column of bams_df with the tumor bams. Defaults to the first bam column
+            
+        normal_bam_col: str
+            Column of bams_df with the normal bams. If None, normal_tags are not suggested
+            
+        thresholds: dict
+            Values overriding Annotations.TagRules.DEFAULT_TAG_THRESHOLDS
+        """
+        if self.read_evidence_df is None and self.reference_context_df is None and self.pon_df is None:
+            raise ValueError(
+                'Read evidence, reference context or panel of normals must be computed before suggesting tags. '
+                'See compute_read_evidence(), compute_reference_context() and compute_pon()'
+            )
+        for arg_name, bam_col in [('tumor_bam_col', tumor_bam_col), ('normal_bam_col', normal_bam_col)]:
+            # the rules of a misspelled bam column would silently read missing read evidence
+            if bam_col is not None and bam_col not in self.bam_cols:
+                raise ValueError(f'{arg_name} "{bam_col}" is not a bam column. Bam columns are {self.bam_cols}')
+        self.mutation_tags_df = gen_mutation_tags_df(
+            self, tumor_bam_col=tumor_bam_col, normal_bam_col=normal_bam_col, thresholds=thresholds
+        )
+
+    def get_mutation_tags(self, idx) -> Dict[str, List[str]]:
+        """
+        Suggested tags of each tag annotation for the mutation group named idx. Empty if tags were not computed
+        """
+        if self.mutation_tags_df is None or idx not in self.mutation_tags_df.index:
+            return {annot_name: [] for annot_name in TAG_ANNOTATIONS}
+        return self.mutation_tags_df.loc[idx].to_dict()
@@ -0,0 +1,235 @@
+"""
+Panel of normals (PoN) lookup for all mutations at once. Loci are sorted and nearby loci are merged into regions,
+so a bgzipped, tabix-indexed PoN is read in one sweep per chromosome. Results are cached on disk,
+keyed by the checksum of the PoN file.
+"""
+import os
+import hashlib
+import json
+import pickle
+import numpy as np
+import pandas as pd
+from typing import Union
+from pathlib import Path
+
+from MutationReviewer.ReadData.RegionCache import match_contig
+
+
+def get_file_checksum(path: Union[str, Path], cache_dir: Union[str, Path] = None, chunk_size=1024 ** 2) -> str:
+    """
+    sha1 checksum of a file. If cache_dir is provided, the checksum is saved there and reused
+    while the file size and modification time are unchanged.
+    """
+    path = str(path)
+    stat = os.stat(path)
+    stat_key = hashlib.sha1(json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime_ns]).encode()).hexdigest()
+    checksum_fn = None if cache_dir is None else os.path.join(str(cache_dir), f'checksum.{stat_key}.txt')
+    if checksum_fn is not None and os.path.exists(checksum_fn):
+        with open(checksum_fn) as f:
+            return f.read().strip()
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    checksum = sha1.hexdigest()
+
+    if checksum_fn is not None:
+        os.makedirs(str(cache_dir), exist_ok=True)
+        with open(checksum_fn, 'w') as f:
+            f.write(checksum)
+    return checksum
+
+
+def merge_loci(poss: np.ndarray, max_gap: int):
+    """
+    Groups sorted positions into regions where consecutive positions are at most max_gap apart
+
+    Returns
+    -------
+    np.ndarray
+        Index in poss of the first position of each region
+
+    np.ndarray
+        Index in poss after the last position of each region
+    """
+    breaks = np.flatnonzero(np.diff(poss) > max_gap) + 1
+    return np.concatenate([[0], breaks]), np.concatenate([breaks, [len(poss)]])
+
+
+def _to_numeric(values: pd.Series) -> pd.Series:
+    numeric = pd.to_numeric(values, errors='coerce')
+    # keep text columns (ie vcf INFO) as they are
+    return numeric if numeric.notna().sum() == values.notna().sum() else values
+
+
+def query_pon(
+    pon_path: Union[str, Path],
+    chroms,
+    poss,
+    refs=None,
+    alts=None,
+    chrom_col='CHROM',
+    pos_col='POS',
+    ref_col=None,
+    alt_col=None,
+    value_cols: list = None,
+    max_gap=10000,
+) -> pd.DataFrame:
+    """
+    Looks up the PoN record of each locus
+
+    Parameters
+    ----------
+    pon_path: str, Path
+        bgzipped, tabix-indexed tab-delimited PoN (ie a vcf, or a table of counts per site).
+        Column names are taken from the last header line ("#" is stripped)
+
+    chroms: array-like
+        Chromosome of each locus. A missing or extra "chr" prefix is allowed
+
+    poss: array-like
+        1-based position of each locus
+
+    refs, alts: array-like
+        Reference and alternate allele of each locus. Used with ref_col and alt_col to match records on alleles
+
+    chrom_col, pos_col: str
+        Columns of the PoN with the chromosome and 1-based position
+
+    ref_col, alt_col: str
+        Columns of the PoN with the alleles. If None, records are matched on position only. 
+        Multi-allelic records (ie ALT "T,G") match each of their comma separated alternate alleles
+
+    value_cols: list
+        Columns of the PoN to return. Defaults to all other columns
+
+    max_gap: int, default=10000
+        Loci closer than max_gap are read with a single tabix query
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per locus, in the input order, with pon_found and the value_cols prefixed with "pon_"
+    """
+    import pysam
+
+    chroms = np.asarray(chroms).astype(str)
+    poss = np.asarray(poss, dtype=np.int64)
+    match_alleles = ref_col is not None and alt_col is not None and refs is not None and alts is not None
+    if match_alleles:
+        refs, alts = np.asarray(refs).astype(str), np.asarray(alts).astype(str)
+
+    with pysam.TabixFile(str(pon_path)) as tabix:
+        header = list(tabix.header)
+        columns = header[-1].lstrip('#').split('\t') if header else None
+        if columns is None:
+            raise ValueError(f'PoN {pon_path} has no header line with column names')
+        missing_cols = [
+            c for c in [chrom_col, pos_col, ref_col, alt_col] + (value_cols or []) if c is not None and c not in columns
+        ]
+        if missing_cols:
+            raise ValueError(f'Following columns do not exist in the PoN: {missing_cols}')
+        value_cols = [c for c in columns if c not in [chrom_col, pos_col, ref_col, alt_col]] \
+            if value_cols is None else value_cols
+        pos_i = columns.index(pos_col)
+        allele_is = (columns.index(ref_col), columns.index(alt_col)) if match_alleles else None
+        value_is = [columns.index(c) for c in value_cols]
+        contigs = set(tabix.contigs)
+
+        found = np.zeros(len(poss), dtype=bool)
+        values = np.full((len(poss), len(value_cols)), None, dtype=object)
+        for chrom in pd.unique(chroms):
+            contig = match_contig(contigs, chrom)
+            if contig is None:
+                continue
+            rows = np.flatnonzero(chroms == chrom)
+            rows = rows[np.argsort(poss[rows], kind='stable')]
+            chrom_poss = poss[rows]
+
+            region_starts, region_ends = merge_loci(chrom_poss, max_gap)
+            for start_i, end_i in zip(region_starts, region_ends):
+                region_rows = rows[start_i:end_i]
+                region_poss = chrom_poss[start_i:end_i]
+                for line in tabix.fetch(contig, max(region_poss[0] - 1, 0), region_poss[-1]):
+                    fields = line.split('\t')
+                    record_pos = int(fields[pos_i])
+                    lo, hi = np.searchsorted(region_poss, [record_pos, record_pos + 1])
+                    for row in region_rows[lo:hi]:
+                        if found[row]:
+                            continue
+                        if match_alleles and (
+                            fields[allele_is[0]] != refs[row] or alts[row] not in fields[allele_is[1]].split(',')
+                        ):
+                            continue
+                        found[row] = True
+                        values[row] = [fields[i] for i in value_is]
+
+    pon_df = pd.DataFrame(values, columns=[f'pon_{c}' for c in value_cols])
+    for col in pon_df.columns:
+        pon_df[col] = _to_numeric(pon_df[col])
+    pon_df.insert(0, 'pon_found', found)
+    return pon_df
+
+
+def compute_pon(
+    data,
+    pon_path: Union[str, Path],
+    ref_allele_col: str = None,
+    alt_allele_col: str = None,
+    cache_dir: Union[str, Path] = 'pon_cache/',
+    **query_kwargs
+) -> pd.DataFrame:
+    """
+    PoN records at the first locus of each mutation in mutations_df. Results are cached in cache_dir,
+    keyed by the checksum of the PoN, the loci and the query options.
+
+    Parameters
+    ----------
+    data: GeneralMutationData
+        Data object storing the mutations
+
+    pon_path: str, Path
+        bgzipped, tabix-indexed PoN. See query_pon()
+
+    ref_allele_col, alt_allele_col: str
+        Columns of mutations_df with the alleles, to match PoN records on alleles (with ref_col and alt_col)
+
+    cache_dir: str, Path, default='pon_cache/'
+        Directory to cache results in. If None, results are not cached
+
+    **query_kwargs:
+        Arguments for query_pon() (ie chrom_col, pos_col, ref_col, alt_col, value_cols)
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per row of mutations_df, in the same order. See query_pon()
+    """
+    chroms = data.mutations_df[data.chrom_cols[0]].astype(str).to_numpy()
+    poss = data.mutations_df[data.pos_cols[0]].to_numpy(dtype=np.int64)
+    refs = None if ref_allele_col is None else data.mutations_df[ref_allele_col].astype(str).to_numpy()
+    alts = None if alt_allele_col is None else data.mutations_df[alt_allele_col].astype(str).to_numpy()
+
+    cache_fn = None
+    if cache_dir is not None:
+        key = hashlib.sha1()
+        key.update(get_file_checksum(pon_path, cache_dir=cache_dir).encode())
+        key.update(json.dumps(query_kwargs, sort_keys=True, default=str).encode())
+        for values in [chroms, poss, refs, alts]:
+            if values is not None:
+                key.update(pd.util.hash_array(np.asarray(values, dtype=object)).tobytes())
+        cache_fn = os.path.join(str(cache_dir), f'pon.{key.hexdigest()}.pkl')
+        if os.path.exists(cache_fn):
+            with open(cache_fn, 'rb') as f:
+                return pickle.load(f)
+
+    pon_df = query_pon(pon_path, chroms, poss, refs=refs, alts=alts, **query_kwargs)
+
+    if cache_fn is not None:
+        os.makedirs(str(cache_dir), exist_ok=True)
+        tmp_fn = f'{cache_fn}.tmp'
+        with open(tmp_fn, 'wb') as f:
+            pickle.dump(pon_df, f)
+        os.replace(tmp_fn, cache_fn)
+    return pon_df
@@ -0,0 +1,243 @@
+"""
+Prefetches the reads around the next mutations to review into a local RegionCache,
+so they are already on disk when the reviewer gets to them.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import List, Tuple
+
+from MutationReviewer.DataTypes.GeneralMutationData import GeneralMutationData
+from MutationReviewer.AppComponents.BamTableComponent import gen_bam_table_df
+from MutationReviewer.AppComponents.IGVJSComponent import OAuthTokenError
+from MutationReviewer.ReadData.RegionCache import RegionCache, extract_region_bam
+
+
+def get_mutation_regions(data: GeneralMutationData, idx, padding=500) -> List[Tuple]:
+    """
+    Windows around the loci of a mutation, as displayed in IGV
+
+    Parameters
+    ----------
+    data: GeneralMutationData
+        Data object storing the relevant data for mutation review
+
+    idx: str
+        Mutation index name
+
+    padding: int, default=500
+        Number of bases to include on each side of each position
+
+    Returns
+    -------
+    List[Tuple]
+        List of (chrom, start, end) tuples
+    """
+    idx_mut_df = data.get_mutation_df(idx)
+    if idx_mut_df.empty:
+        return []
+    r = idx_mut_df.iloc[0]
+    return [
+        (str(r[chrom]), max(int(r[pos]) - padding, 1), int(r[pos]) + padding)
+        for chrom, pos in zip(data.chrom_cols, data.pos_cols)
+    ]
+
+
+def get_mutation_bams(data: GeneralMutationData, idx) -> List[Tuple]:
+    """
+    List of (bam, bai) paths of all the bams relevant to a mutation, in the order of the bam table
+    """
+    bams_df = gen_bam_table_df(data, idx, bam_table_display_cols=[])
+    bams_df = bams_df.loc[bams_df['bam'].notna()]
+    return list(zip(bams_df['bam'].astype(str), bams_df['bai'].astype(str)))
+
+
+class MutationPrefetcher:
+    """
+    Follows the current review position and extracts the reads around the current and next n_ahead mutations
+    from their bams into a RegionCache, using a thread or process pool.
+    """
+    def __init__(
+        self,
+        region_cache: RegionCache,
+        n_ahead=5,
+        n_workers=4,
+        padding=500,
+        use_processes=False,
+        oauth_token_provider=None,
+    ):
+        """
+        Parameters
+        ----------
+        region_cache: RegionCache
+            Cache to store the extracted reads in
+
+        n_ahead: int, default=5
+            Number of mutations after the current mutation to prefetch
+
+        n_workers: int, default=4
+            Number of threads or processes extracting reads in parallel
+
+        padding: int, default=500
+            Number of bases to include on each side of each mutation position
+
+        use_processes: bool, default=False
+            Use a process pool instead of a thread pool
+
+        oauth_token_provider: OAuthTokenProvider
+            Provider of the token used to read gs:// bams. See AppComponents.IGVJSComponent.get_oauth_token_provider
+        """
+        self.region_cache = region_cache
+        self.n_ahead = n_ahead
+        self.padding = padding
+        self.oauth_token_provider = oauth_token_provider
+        self.n_workers = n_workers
+        self.use_processes = use_processes
+        self.executor = self.gen_executor()
+
+        self.futures = {}
+        self.errors = {}
+        self._index_positions = None
+        self._positions_index = None
+        self._lock = threading.RLock()
+
+    def gen_executor(self):
+        return ProcessPoolExecutor(max_workers=self.n_workers) if self.use_processes else \
+            ThreadPoolExecutor(max_workers=self.n_workers)
+
+    def restart(self):
+        """
+        Replaces the pool and forgets scheduled extractions, ie in a forked process where the pool workers do not exist.
+        See Serving.WorkerPool
+        """
+        self.executor = self.gen_executor()
+        self.futures = {}
+        self._lock = threading.RLock()
+
+    def get_index_position(self, data: GeneralMutationData, idx) -> int:
+        # rebuilt when the index is replaced (ie a new review shard is claimed) or resized
+        if self._positions_index is not data.index or len(self._index_positions) != len(data.index):
+            self._index_positions = {name: i for i, name in enumerate(data.index)}
+            self._positions_index = data.index
+        return self._index_positions.get(idx)
+
+    def reset_position(self):
+        """
+        Forgets the positions of the mutations in the index, ie when the mutations to review change
+        """
+        with self._lock:
+            self._index_positions = None
+            self._positions_index = None
+
+    def update_position(self, data: GeneralMutationData, idx):
+        """
+        Sets the current review position. Schedules extraction for the current and next n_ahead mutations
+        and cancels scheduled extractions that have not started for mutations outside that window.
+
+        Parameters
+        ----------
+        data: GeneralMutationData
+            Data object storing the relevant data for mutation review
+
+        idx: str
+            Mutation index name currently being reviewed
+        """
+        i = self.get_index_position(data, idx)
+        if i is None:
+            return
+        window_idxs = data.index[i:i + self.n_ahead + 1]
+
+        requests = {}
+        for window_idx in window_idxs:
+            regions = get_mutation_regions(data, window_idx, padding=self.padding)
+            for bam, bai in get_mutation_bams(data, window_idx):
+                key = self.region_cache.get_key(bam, regions)
+                requests.setdefault(key, (bam, bai, regions))
+
+        with self._lock:
+            for key in [k for k in self.futures.keys() if k not in requests]:
+                if self.futures[key].cancel():
+                    del self.futures[key]
+
+            for key, (bam, bai, regions) in requests.items():
+                if key in self.futures or self.region_cache.contains(bam, regions):
+                    continue
+                self.submit(key, bam, bai, regions)
+
+    def submit(self, key, bam, bai, regions):
+        gcs_oauth_token = None
+        if bam.startswith('gs://') and self.oauth_token_provider is not None:
+            try:
+                gcs_oauth_token = self.oauth_token_provider.get_token()
+            except OAuthTokenError as e:
+                self.errors[key] = e
+                return
+
+        future = self.executor.submit(
+            extract_region_bam,
+            bam,
+            regions,
+            self.region_cache.get_bam_path(bam, regions),
+            bai_path=bai,
+            gcs_oauth_token=gcs_oauth_token,
+        )
+        self.futures[key] = future
+        future.add_done_callback(lambda f: self._on_done(key, bam, regions, f))
+
+    def _on_done(self, key, bam, regions, future):
+        # the future is only forgotten once the mini-bam is in the cache or the error is recorded, 
+        # so a mutation is never both not pending and missing its bam (see is_pending())
+        error = None
+        if not future.cancelled():
+            error = future.exception()
+            if error is None:
+                try:
+                    self.region_cache.add_entry(bam, regions, future.result())
+                except OSError as e:
+                    error = e
+        with self._lock:
+            if not future.cancelled():
+                if error is not None:
+                    self.errors[key] = error
+                else:
+                    self.errors.pop(key, None)
+            if self.futures.get(key) is future:
+                del self.futures[key]
+
+    def is_pending(self, data: GeneralMutationData, idx) -> bool:
+        """
+        Whether reads of any bam of the mutation are scheduled or being extracted
+        """
+        regions = get_mutation_regions(data, idx, padding=self.padding)
+        with self._lock:
+            return any(self.region_cache.get_key(bam, regions) in self.futures for bam, _ in get_mutation_bams(data, idx))
+
+    def get_cached_bams(self, data: GeneralMutationData, idx) -> set:
+        """
+        Bams of the mutation whose reads are cached. Does not count cache hits or misses
+        """
+        regions = get_mutation_regions(data, idx, padding=self.padding)
+        return {bam for bam, _ in get_mutation_bams(data, idx) if self.region_cache.contains(bam, regions)}
+
+    def get_cached_bam_table_df(self, data: GeneralMutationData, idx, bams_df):
+        """
+        Replaces the bam and bai paths in a bam table (see AppComponents.BamTableComponent.gen_bam_table_df) 
+        with the cached mini-bams of the mutation when they have been extracted. 
+        The original paths are kept in the source_bam and source_bai columns.
+        """
+        regions = get_mutation_regions(data, idx, padding=self.padding)
+        bams_df = bams_df.assign(source_bam=bams_df['bam'], source_bai=bams_df['bai'])
+        for i, bam in enumerate(bams_df['source_bam']):
+            cached = self.region_cache.get(str(bam), regions) if isinstance(bam, str) else None
+            if cached is not None:
+                bams_df.iloc[i, bams_df.columns.get_loc('bam')] = cached[0]
+                bams_df.iloc[i, bams_df.columns.get_loc('bai')] = cached[1]
+        return bams_df
+
+    def shutdown(self, wait=False):
+        """
+        Cancels scheduled extractions and stops the pool
+        """
+        with self._lock:
+            for future in list(self.futures.values()):
+                future.cancel()
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,322 @@
+"""
+Read evidence for each mutation in each relevant bam (ref/alt counts, VAF, strand split, qualities, alt read positions),
+computed once with a process pool by piling up the reads at each mutation locus.
+"""
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple, Union
+from pathlib import Path
+
+from MutationReviewer.ReadData.RegionCache import get_bam_contig, download_remote_index
+from MutationReviewer.Serving.BamServer import is_local_path
+
+
+READ_EVIDENCE_METRICS = [
+    'depth',
+    'ref_count',
+    'alt_count',
+    'vaf',
+    'ref_fwd',
+    'ref_rev',
+    'alt_fwd',
+    'alt_rev',
+    'ref_mean_mapq',
+    'alt_mean_mapq',
+    'ref_mean_base_qual',
+    'alt_mean_base_qual',
+    'alt_read_pos_median',
+    'alt_read_end_dist_median',
+    'alt_three_prime_dist_median',
+    'alt_unique_starts',
+]
+
+READ_EVIDENCE_SUMMARY_METRICS = ['ref_count', 'alt_count', 'vaf']
+
+
+def _mean(values):
+    return float(np.mean(values)) if len(values) > 0 else np.nan
+
+
+def _median(values):
+    return float(np.median(values)) if len(values) > 0 else np.nan
+
+
+def count_locus_read_evidence(bam, chrom, pos, ref_allele, alt_allele, min_mapping_quality=0, min_base_quality=0):
+    """
+    Piles up the reads at a mutation locus and counts the reads supporting the reference and alternate alleles
+
+    Parameters
+    ----------
+    bam: pysam.AlignmentFile
+        Open bam file
+
+    chrom: str
+        Chromosome of the mutation. A missing or extra "chr" prefix is allowed
+
+    pos: int
+        1-based start position of the mutation, as in a maf file (the base before an insertion,
+        the first deleted base of a deletion)
+
+    ref_allele: str
+        Reference allele. "-" for insertions
+
+    alt_allele: str
+        Alternate allele. "-" for deletions
+
+    min_mapping_quality: int, default=0
+        Reads with a lower mapping quality are ignored
+
+    min_base_quality: int, default=0
+        Bases with a lower base quality are ignored
+
+    Returns
+    -------
+    Dict
+        Value of each metric in READ_EVIDENCE_METRICS
+    """
+    ref_allele, alt_allele = str(ref_allele).upper(), str(alt_allele).upper()
+    is_insertion = ref_allele in ('-', '')
+    is_deletion = alt_allele in ('-', '')
+    # indels are reported by pysam on the base before the event
+    pileup_pos = int(pos) - 1 if is_deletion else int(pos)
+
+    counts = {
+        'ref': {'fwd': 0, 'rev': 0, 'mapq': [], 'base_qual': []},
+        'alt': {
+            'fwd': 0, 'rev': 0, 'mapq': [], 'base_qual': [], 'read_pos': [], 'end_dist': [], 'three_prime_dist': [], 
+            'starts': set(),
+        },
+    }
+    depth = 0
+
+    contig = get_bam_contig(bam, chrom)
+    if contig is not None and pileup_pos > 0:
+        for column in bam.pileup(
+            contig,
+            pileup_pos - 1,
+            pileup_pos,
+            truncate=True,
+            min_mapping_quality=min_mapping_quality,
+            min_base_quality=min_base_quality,
+            ignore_orphans=False,
+            max_depth=100000,
+        ):
+            for pileup_read in column.pileups:
+                read = pileup_read.alignment
+                qpos = pileup_read.query_position
+                depth += 1
+
+                if is_insertion:
+                    allele = 'alt' if pileup_read.indel > 0 else ('ref' if pileup_read.indel == 0 else None)
+                elif is_deletion:
+                    allele = 'alt' if pileup_read.indel < 0 else ('ref' if pileup_read.indel == 0 else None)
+                elif qpos is None:
+                    allele = None
+                else:
+                    n_bases = len(alt_allele)
+                    base = read.query_sequence[qpos:qpos + n_bases].upper()
+                    allele = 'alt' if base == alt_allele else ('ref' if base == ref_allele[:n_bases] else None)
+
+                if allele is None:
+                    continue
+                c = counts[allele]
+                c['rev' if read.is_reverse else 'fwd'] += 1
+                c['mapq'].append(read.mapping_quality)
+                if qpos is not None and read.query_qualities is not None:
+                    c['base_qual'].append(read.query_qualities[qpos])
+                if allele == 'alt':
+                    c['starts'].add((read.reference_start, read.reference_end))
+                if allele == 'alt' and qpos is not None:
+                    c['read_pos'].append(qpos)
+                    c['end_dist'].append(min(qpos, read.query_length - 1 - qpos))
+                    # query positions follow the reference strand, so the 3' end of reverse reads is at position 0
+                    c['three_prime_dist'].append(qpos if read.is_reverse else read.query_length - 1 - qpos)
+
+    ref_count = counts['ref']['fwd'] + counts['ref']['rev']
+    alt_count = counts['alt']['fwd'] + counts['alt']['rev']
+    return {
+        'depth': depth,
+        'ref_count': ref_count,
+        'alt_count': alt_count,
+        'vaf': alt_count / (ref_count + alt_count) if ref_count + alt_count > 0 else np.nan,
+        'ref_fwd': counts['ref']['fwd'],
+        'ref_rev': counts['ref']['rev'],
+        'alt_fwd': counts['alt']['fwd'],
+        'alt_rev': counts['alt']['rev'],
+        'ref_mean_mapq': _mean(counts['ref']['mapq']),
+        'alt_mean_mapq': _mean(counts['alt']['mapq']),
+        'ref_mean_base_qual': _mean(counts['ref']['base_qual']),
+        'alt_mean_base_qual': _mean(counts['alt']['base_qual']),
+        'alt_read_pos_median': _median(counts['alt']['read_pos']),
+        'alt_read_end_dist_median': _median(counts['alt']['end_dist']),
+        'alt_three_prime_dist_median': _median(counts['alt']['three_prime_dist']),
+        'alt_unique_starts': len(counts['alt']['starts']),
+    }
+
+
+def count_bam_read_evidence(
+    bam_path: Union[str, Path],
+    bai_path: Union[str, Path],
+    loci: List[Tuple],
+    min_mapping_quality=0,
+    min_base_quality=0,
+) -> List[dict]:
+    """
+    Counts the read evidence of a list of mutations in a single bam, opening the bam once.
+    See count_locus_read_evidence()
+
+    Parameters
+    ----------
+    bam_path: str, Path
+        Path or url to the bam. For gs:// urls, set the GCS_OAUTH_TOKEN environment variable.
+
+    bai_path: str, Path
+        Path or url to the bam's index. If None, the index is looked for next to the bam. 
+        Remote indices are downloaded to a temporary directory (see RegionCache.download_remote_index())
+
+    loci: List[Tuple]
+        List of (chrom, pos, ref_allele, alt_allele)
+
+    Returns
+    -------
+    List[dict]
+        Metrics of each locus, in the order of loci. Contains only an "error" key if the bam cannot be read
+    """
+    import pysam
+
+    bai_path = None if bai_path is None else str(bai_path)
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if not is_local_path(str(bam_path)) and not is_local_path(bai_path or f'{bam_path}.bai'):
+                download_remote_index(bai_path or f'{bam_path}.bai', os.path.join(tmp_dir, 'index.bai'))
+                bai_path = os.path.join(tmp_dir, 'index.bai')
+            with pysam.AlignmentFile(str(bam_path), 'rb', index_filename=bai_path) as bam:
+                return [
+                    count_locus_read_evidence(
+                        bam, chrom, pos, ref_allele, alt_allele,
+                        min_mapping_quality=min_mapping_quality,
+                        min_base_quality=min_base_quality,
+                    )
+                    for chrom, pos, ref_allele, alt_allele in loci
+                ]
+    except (OSError, ValueError) as e:
+        return [{'error': str(e)} for _ in loci]
+
+
+def compute_read_evidence(
+    data,
+    ref_allele_col: str,
+    alt_allele_col: str,
+    n_workers: int = None,
+    min_mapping_quality=0,
+    min_base_quality=0,
+) -> pd.DataFrame:
+    """
+    Counts the read evidence of each mutation in mutations_df in each bam referenced by the mutation,
+    with one task per bam run in a process pool
+
+    Parameters
+    ----------
+    data: GeneralMutationData
+        Data object storing the mutations and the long-form bam table
+
+    ref_allele_col: str
+        Column in mutations_df with the reference allele
+
+    alt_allele_col: str
+        Column in mutations_df with the alternate allele
+
+    n_workers: int
+        Number of processes. If None, uses the number of cpus
+
+    min_mapping_quality: int, default=0
+        Reads with a lower mapping quality are ignored
+
+    min_base_quality: int, default=0
+        Bases with a lower base quality are ignored
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per mutation (row position in mutations_df, mutation_row) and bam (row position in bam_table_df, bam_table_row),
+        with the bam_source and the READ_EVIDENCE_METRICS columns, and an error column
+    """
+    mutations_df = data.mutations_df
+    bam_table_df = data.bam_table_df
+
+    # evidence is counted at the first locus of each mutation
+    mut_loci_df = pd.DataFrame({
+        'mutation_row': np.arange(mutations_df.shape[0]),
+        'ref_value': mutations_df[data.mutations_df_bam_ref_col].to_numpy(),
+        'chrom': mutations_df[data.chrom_cols[0]].astype(str).to_numpy(),
+        'pos': mutations_df[data.pos_cols[0]].to_numpy(),
+        'ref_allele': mutations_df[ref_allele_col].astype(str).to_numpy(),
+        'alt_allele': mutations_df[alt_allele_col].astype(str).to_numpy(),
+    })
+    bam_rows_df = pd.DataFrame({
+        'bam_table_row': np.arange(bam_table_df.shape[0]),
+        'ref_value': bam_table_df[data.bams_df_ref_col].to_numpy(),
+    })
+    pairs_df = mut_loci_df.merge(bam_rows_df, on='ref_value', how='inner')
+
+    tasks = []
+    for bam_table_row, bam_pairs_df in pairs_df.groupby('bam_table_row', sort=True):
+        r = bam_table_df.iloc[bam_table_row]
+        loci = list(bam_pairs_df[['chrom', 'pos', 'ref_allele', 'alt_allele']].itertuples(index=False, name=None))
+        tasks.append((bam_pairs_df, r['bam'], r['bai'] if pd.notna(r['bai']) else None, loci))
+
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    with ProcessPoolExecutor(max_workers=max(min(n_workers, len(tasks)), 1)) as executor:
+        futures = [
+            executor.submit(
+                count_bam_read_evidence, bam, bai, loci,
+                min_mapping_quality=min_mapping_quality, min_base_quality=min_base_quality,
+            )
+            for _, bam, bai, loci in tasks
+        ]
+        evidence_dfs = [
+            pd.concat(
+                [
+                    bam_pairs_df[['mutation_row', 'bam_table_row']].reset_index(drop=True),
+                    pd.DataFrame(future.result(), columns=READ_EVIDENCE_METRICS + ['error']),
+                ],
+                axis=1,
+            )
+            for (bam_pairs_df, _, _, _), future in zip(tasks, futures)
+        ]
+
+    columns = ['mutation_row', 'bam_table_row', 'bam_source'] + READ_EVIDENCE_METRICS + ['error']
+    if len(evidence_dfs) == 0:
+        return pd.DataFrame(columns=columns)
+    read_evidence_df = pd.concat(evidence_dfs, ignore_index=True)
+    read_evidence_df['bam_source'] = bam_table_df['bam_source'].to_numpy()[read_evidence_df['bam_table_row'].to_numpy()]
+    return read_evidence_df[columns].sort_values(['mutation_row', 'bam_table_row']).reset_index(drop=True)
+
+
+def gen_mutation_read_evidence_df(read_evidence_df: pd.DataFrame, n_mutations: int, metrics: list = None) -> pd.DataFrame:
+    """
+    Pivots the read evidence to one row per mutation with one column per bam source and metric
+    (ie tumor_bam_alt_count). Rows are ordered like mutations_df and mutations without evidence have missing values.
+
+    Parameters
+    ----------
+    read_evidence_df: pd.DataFrame
+        Output of compute_read_evidence()
+
+    n_mutations: int
+        Number of rows in mutations_df
+
+    metrics: list
+        Metrics to include. Defaults to READ_EVIDENCE_SUMMARY_METRICS
+    """
+    metrics = READ_EVIDENCE_SUMMARY_METRICS if metrics is None else metrics
+    # a mutation can reference several bams from the same source (ie several rows in bams_df); keep the first
+    first_df = read_evidence_df.drop_duplicates(['mutation_row', 'bam_source'])
+    wide_df = first_df.pivot(index='mutation_row', columns='bam_source', values=metrics)
+    wide_df.columns = [f'{bam_source}_{metric}' for metric, bam_source in wide_df.columns]
+    sources = list(dict.fromkeys(first_df['bam_source']))
+    ordered_cols = [f'{bam_source}_{metric}' for bam_source in sources for metric in metrics]
+    return wide_df.reindex(index=np.arange(n_mutations), columns=ordered_cols)
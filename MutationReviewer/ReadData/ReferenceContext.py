@@ -0,0 +1,214 @@
+"""
+Reference sequence context of each mutation and the repeats (homopolymers, dinucleotide and tandem repeats) around it.
+Loci are sorted and the reference is read in blocks shared by nearby loci, then repeats are found with numpy
+over all loci at once.
+"""
+import numpy as np
+import pandas as pd
+from typing import Union
+from pathlib import Path
+
+from MutationReviewer.ReadData.RegionCache import get_bam_contig
+
+
+REFERENCE_CONTEXT_DISPLAY_COLS = ['ref_context', 'homopolymer_len', 'dinucleotide_units', 'tandem_repeat_units']
+
+DEFAULT_REPEAT_THRESHOLDS = {
+    'min_homopolymer_len': 5,
+    'min_dinucleotide_units': 4,
+    'min_tandem_repeat_units': 3,
+    'min_tandem_repeat_len': 10,
+    'max_tandem_repeat_period': 6,
+}
+
+
+def fetch_reference_contexts(
+    fasta_path: Union[str, Path],
+    chroms,
+    poss,
+    flank=20,
+    block_size=1_000_000,
+) -> np.ndarray:
+    """
+    Reference bases around each locus
+
+    Parameters
+    ----------
+    fasta_path: str, Path
+        Path to an indexed fasta file (with a .fai index). Requires pysam
+
+    chroms: array-like
+        Chromosome of each locus. A missing or extra "chr" prefix is allowed
+
+    poss: array-like
+        1-based position of each locus
+
+    flank: int, default=20
+        Number of bases on each side of the locus
+
+    block_size: int, default=1_000_000
+        Maximum span of the reference read at once. Loci within a block share one read of the fasta
+
+    Returns
+    -------
+    np.ndarray
+        uint8 array of shape (number of loci, 2 * flank + 1) of upper case ascii bases, centered on each locus.
+        Bases outside the chromosome or on missing chromosomes are "N"
+    """
+    import pysam
+
+    chroms = np.asarray(chroms).astype(str)
+    poss = np.asarray(poss, dtype=np.int64)
+    window = np.arange(-flank, flank + 1)
+    contexts = np.full((len(poss), len(window)), ord('N'), dtype=np.uint8)
+
+    with pysam.FastaFile(str(fasta_path)) as fasta:
+        for chrom in pd.unique(chroms):
+            contig = get_bam_contig(fasta, chrom)
+            if contig is None:
+                continue
+            contig_len = fasta.get_reference_length(contig)
+
+            rows = np.flatnonzero(chroms == chrom)
+            rows = rows[np.argsort(poss[rows], kind='stable')]
+            starts = poss[rows] - 1 - flank  # 0-based start of each window
+
+            i = 0
+            while i < len(rows):
+                block_start = max(starts[i], 0)
+                j = np.searchsorted(starts, block_start + block_size - len(window), side='right')
+                j = max(j, i + 1)
+                block_end = min(starts[j - 1] + len(window), contig_len)
+                block = np.frombuffer(fasta.fetch(contig, block_start, block_end).upper().encode(), dtype=np.uint8)
+
+                offsets = starts[i:j, None] + window[None, :] + flank - block_start
+                valid = (offsets >= 0) & (offsets < len(block))
+                contexts[rows[i:j]] = np.where(valid, block[np.clip(offsets, 0, max(len(block) - 1, 0))], ord('N'))
+                i = j
+    return contexts
+
+
+def get_run_length(eq: np.ndarray, col: int) -> np.ndarray:
+    """
+    Length of the run of consecutive True values containing column col of each row of eq (0 where eq[:, col] is False)
+    """
+    false_col = np.zeros((eq.shape[0], 1), dtype=bool)
+    right = np.argmin(np.concatenate([eq[:, col:], false_col], axis=1), axis=1)
+    left = np.argmin(np.concatenate([eq[:, col::-1], false_col], axis=1), axis=1)
+    return np.where(eq[:, col], left + right - 1, 0)
+
+
+def get_repeat_span(contexts: np.ndarray, period: int, first_base: int, last_base: int) -> np.ndarray:
+    """
+    Length in bases of the longest repeat with the given period (unit length) covering any base between 
+    first_base and last_base of each context. Returns the period itself (a single unit) where there is no repeat
+    """
+    # eq[:, i] is True when base i is repeated period bases later, so a repeat covering bases a to b
+    # is a run of eq from a to b - period
+    eq = (contexts[:, period:] == contexts[:, :-period]) & (contexts[:, period:] != ord('N'))
+    cols = range(max(first_base - period, 0), min(last_base + 1, eq.shape[1]))
+    return np.max([get_run_length(eq, col) for col in cols], axis=0) + period
+
+
+def find_repeats(contexts: np.ndarray, thresholds: dict = None) -> pd.DataFrame:
+    """
+    Finds the longest homopolymer, dinucleotide repeat and tandem repeat at or immediately after the center of each context
+
+    Parameters
+    ----------
+    contexts: np.ndarray
+        Output of fetch_reference_contexts()
+
+    thresholds: dict
+        Values overriding DEFAULT_REPEAT_THRESHOLDS
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per context with the homopolymer_len, dinucleotide_units, tandem_repeat_units and tandem_repeat_period,
+        and the mononucleotide_repeat, dinucleotide_repeat and tandem_repeat flags
+    """
+    t = {**DEFAULT_REPEAT_THRESHOLDS, **(thresholds or {})}
+    center = contexts.shape[1] // 2
+
+    def longest_span(period):
+        # indels are placed on the base before the event, so also check the repeat starting after the locus
+        return get_repeat_span(contexts, period, center, center + 1)
+
+    homopolymer_len = longest_span(1)
+    dinucleotide_units = longest_span(2) // 2
+
+    tandem_repeat_units = np.ones(len(contexts), dtype=int)
+    tandem_repeat_period = np.zeros(len(contexts), dtype=int)
+    tandem_repeat_len = np.zeros(len(contexts), dtype=int)
+    for period in range(3, t['max_tandem_repeat_period'] + 1):
+        span = longest_span(period)
+        longer = span // period > tandem_repeat_units
+        tandem_repeat_units = np.where(longer, span // period, tandem_repeat_units)
+        tandem_repeat_period = np.where(longer, period, tandem_repeat_period)
+        tandem_repeat_len = np.where(longer, span, tandem_repeat_len)
+
+    mononucleotide_repeat = homopolymer_len >= t['min_homopolymer_len']
+    # homopolymers also repeat with every period
+    dinucleotide_repeat = (dinucleotide_units >= t['min_dinucleotide_units']) & ~mononucleotide_repeat
+    tandem_repeat = (tandem_repeat_units >= t['min_tandem_repeat_units']) & \
+        (tandem_repeat_len >= t['min_tandem_repeat_len']) & ~mononucleotide_repeat & ~dinucleotide_repeat
+
+    return pd.DataFrame({
+        'homopolymer_len': homopolymer_len,
+        'dinucleotide_units': dinucleotide_units,
+        'tandem_repeat_units': tandem_repeat_units,
+        'tandem_repeat_period': tandem_repeat_period,
+        'mononucleotide_repeat': mononucleotide_repeat,
+        'dinucleotide_repeat': dinucleotide_repeat,
+        'tandem_repeat': tandem_repeat,
+    })
+
+
+def compute_reference_context(
+    data,
+    fasta_path: Union[str, Path],
+    flank=20,
+    block_size=1_000_000,
+    thresholds: dict = None,
+) -> pd.DataFrame:
+    """
+    Reference context and repeats at the first locus of each mutation in mutations_df
+
+    Parameters
+    ----------
+    data: GeneralMutationData
+        Data object storing the mutations
+
+    fasta_path: str, Path
+        Path to the indexed reference fasta the mutations were called against
+
+    flank: int, default=20
+        Number of reference bases on each side of the mutation
+
+    block_size: int, default=1_000_000
+        See fetch_reference_contexts()
+
+    thresholds: dict
+        See find_repeats()
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per row of mutations_df, in the same order, with the ref_context string
+        (the mutation base in lower case) and the columns of find_repeats()
+    """
+    contexts = fetch_reference_contexts(
+        fasta_path,
+        data.mutations_df[data.chrom_cols[0]].to_numpy(),
+        data.mutations_df[data.pos_cols[0]].to_numpy(),
+        flank=flank,
+        block_size=block_size,
+    )
+    reference_context_df = find_repeats(contexts, thresholds=thresholds)
+
+    display_contexts = contexts.copy()
+    display_contexts[:, flank] = np.char.lower(display_contexts[:, flank].view('S1')).view(np.uint8)
+    ref_context = np.ascontiguousarray(display_contexts).view(f'S{contexts.shape[1]}').ravel().astype(str)
+    reference_context_df.insert(0, 'ref_context', ref_context)
+    return reference_context_df
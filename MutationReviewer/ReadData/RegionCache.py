@@ -0,0 +1,401 @@
+"""
+Local cache of small indexed bams ("mini-bams") containing only the reads around the loci being reviewed.
+Extracting the reads once lets IGV load the region from local disk instead of the remote bam, 
+including when going back to a mutation or reviewing overlapping loci.
+"""
+import os
+import re
+import hashlib
+import json
+import shutil
+import uuid
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from typing import List, Tuple, Union
+from pathlib import Path
+
+from MutationReviewer.Serving.BamServer import is_local_path, is_gcs_url
+
+
+# htslib reads the token from the environment when a gs:// file is opened
+_gcs_oauth_token_lock = threading.Lock()
+
+# mini-bams (<sha1 key>.bam), extractions in progress (<sha1 key>.bam.<uuid>.tmp.bam) and their indices, 
+# and the downloaded indices of remote bams being extracted (<sha1 key>.bam.<uuid>.tmp.bai)
+CACHE_FN_PATTERN = re.compile(r'^[0-9a-f]{40}\.bam(\.[0-9a-f]{32}\.tmp\.(bam|bai))?(\.bai)?$')
+
+
+def merge_regions(regions: List[Tuple]) -> List[Tuple]:
+    """
+    Sorts regions and merges overlapping or adjacent regions on the same chromosome
+
+    Parameters
+    ----------
+    regions: List[Tuple]
+        List of (chrom, start, end) tuples
+
+    Returns
+    -------
+    List[Tuple]
+        Sorted, non-overlapping list of (chrom, start, end) tuples
+    """
+    merged = []
+    for chrom, start, end in sorted((str(c), int(s), int(e)) for c, s, e in regions):
+        if merged and merged[-1][0] == chrom and start <= merged[-1][2]:
+            merged[-1] = (chrom, merged[-1][1], max(merged[-1][2], end))
+        else:
+            merged.append((chrom, start, end))
+    return merged
+
+
+def match_contig(contigs, chrom):
+    """
+    Returns the name of chrom in a collection of contig names, allowing for a missing or extra "chr" prefix.
+    Returns None if the contig is not in contigs.
+    """
+    chrom = str(chrom)
+    for contig in [chrom, f'chr{chrom}', chrom[3:] if chrom.startswith('chr') else None]:
+        if contig is not None and contig in contigs:
+            return contig
+    return None
+
+
+def get_bam_contig(bam, chrom):
+    """
+    Returns the name of chrom in the bam header, allowing for a missing or extra "chr" prefix.
+    Returns None if the contig is not in the bam.
+    """
+    return match_contig(bam.references, chrom)
+
+
+def download_remote_index(
+    url: str,
+    output_fn: Union[str, Path],
+    gcs_oauth_token: str = None,
+    gs_endpoint='https://storage.googleapis.com',
+    timeout=60,
+):
+    """
+    Downloads the index of a remote bam to a local file. 
+    Opening a remote bam with a remote index makes htslib save the index into the working directory
+
+    Parameters
+    ----------
+    url: str
+        Url (gs://, https://, ftp://) of the index
+
+    output_fn: str, Path
+        Path to write the index to
+
+    gcs_oauth_token: str
+        Token to read gs:// urls with. Defaults to the GCS_OAUTH_TOKEN environment variable
+
+    gs_endpoint: str, default='https://storage.googleapis.com'
+        Endpoint gs:// urls are read from
+
+    Raises
+    ------
+    FileNotFoundError
+        If the index could not be downloaded
+    """
+    http_url = url
+    if url.startswith('gs://'):
+        bucket, _, blob = url[len('gs://'):].partition('/')
+        http_url = f'{gs_endpoint}/{bucket}/{urllib.parse.quote(blob)}'
+    request = urllib.request.Request(http_url)
+    gcs_oauth_token = gcs_oauth_token or os.environ.get('GCS_OAUTH_TOKEN')
+    if is_gcs_url(url) and gcs_oauth_token:
+        request.add_header('Authorization', f'Bearer {gcs_oauth_token}')
+
+    tmp_fn = f'{output_fn}.{uuid.uuid4().hex}.tmp'
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response, open(tmp_fn, 'wb') as f:
+            shutil.copyfileobj(response, f)
+        os.replace(tmp_fn, str(output_fn))
+    except (OSError, ValueError) as e:
+        # urllib's HTTPError cannot be pickled back from a process pool worker
+        raise FileNotFoundError(f'Could not download {url}: {e}')
+    finally:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+
+
+def extract_region_bam(
+    bam_path: Union[str, Path],
+    regions: List[Tuple],
+    output_bam: Union[str, Path],
+    bai_path: Union[str, Path] = None,
+    gcs_oauth_token: str = None,
+) -> int:
+    """
+    Writes the reads overlapping regions of a (local or remote) bam to a new indexed bam.
+    Files are written to temporary paths and renamed, so a partially written bam is never visible at output_bam.
+
+    Parameters
+    ----------
+    bam_path: str, Path
+        Path or url (gs://, https://) to the bam. Remote bams require pysam to be built with libcurl.
+        For gs:// urls, pass gcs_oauth_token or set the GCS_OAUTH_TOKEN environment variable.
+
+    regions: List[Tuple]
+        List of (chrom, start, end) tuples of 1-based coordinates to extract
+
+    output_bam: str, Path
+        Path to write the bam to. The index is written to f'{output_bam}.bai'
+
+    bai_path: str, Path
+        Path or url to the bam's index. If None, the index is looked for next to the bam. 
+        Remote indices are downloaded next to output_bam while extracting (see download_remote_index())
+
+    gcs_oauth_token: str
+        Token to read gs:// urls with. Passed with each call, so extractions running in pool workers 
+        use the current token instead of the one in the environment when the worker started
+
+    Returns
+    -------
+    int
+        Number of bytes written (bam and index)
+    """
+    import pysam
+
+    output_bam = str(output_bam)
+    tmp_id = uuid.uuid4().hex
+    tmp_bam = f'{output_bam}.{tmp_id}.tmp.bam'
+    bai_path = None if bai_path is None else str(bai_path)
+    tmp_bai = None
+    if not is_local_path(str(bam_path)) and not is_local_path(bai_path or f'{bam_path}.bai'):
+        tmp_bai = f'{output_bam}.{tmp_id}.tmp.bai'
+        download_remote_index(bai_path or f'{bam_path}.bai', tmp_bai, gcs_oauth_token=gcs_oauth_token)
+        bai_path = tmp_bai
+
+    try:
+        with _gcs_oauth_token_lock:
+            if gcs_oauth_token is not None:
+                os.environ['GCS_OAUTH_TOKEN'] = gcs_oauth_token
+            bam = pysam.AlignmentFile(str(bam_path), 'rb', index_filename=bai_path)
+        with bam:
+            contig_regions = []
+            for chrom, start, end in merge_regions(regions):
+                contig = get_bam_contig(bam, chrom)
+                if contig is not None:
+                    contig_regions.append((bam.get_tid(contig), contig, start, end))
+
+            with pysam.AlignmentFile(tmp_bam, 'wb', template=bam) as out:
+                last_end = {}
+                for tid, contig, start, end in sorted(contig_regions):
+                    for read in bam.fetch(contig, max(start - 1, 0), end):
+                        # merged regions do not overlap, but a read spanning two regions was already written
+                        if read.reference_start < last_end.get(tid, -1):
+                            continue
+                        out.write(read)
+                    last_end[tid] = end
+    finally:
+        # htslib loads the index of a remote bam when it is first queried
+        if tmp_bai is not None and os.path.exists(tmp_bai):
+            os.remove(tmp_bai)
+
+    pysam.index(tmp_bam, f'{tmp_bam}.bai')
+    os.replace(f'{tmp_bam}.bai', f'{output_bam}.bai')
+    os.replace(tmp_bam, output_bam)
+    return os.path.getsize(output_bam) + os.path.getsize(f'{output_bam}.bai')
+
+
+class RegionCache:
+    """
+    Size-bounded directory of mini-bams keyed by the source bam and the regions extracted from it.
+    When the cache is larger than max_bytes, the least recently used mini-bams are deleted.
+    A manifest (manifest.json) records the entries, hits, misses and bytes stored.
+    """
+    def __init__(
+        self, 
+        cache_dir: Union[str, Path] = 'read_cache/', 
+        max_bytes=10 * 1024 ** 3,
+        manifest_save_interval=5,
+        orphan_grace_period=3600,
+    ):
+        """
+        Parameters
+        ----------
+        cache_dir: str, Path
+            Directory to store the mini-bams in. Created if it does not exist
+            
+        max_bytes: int, default=10GB
+            Maximum total size of the cached mini-bams and their indices
+            
+        manifest_save_interval: int, default=5
+            Minimum number of seconds between saving hit and miss counts to the manifest. 
+            Adding or evicting entries always saves the manifest.
+            
+        orphan_grace_period: int, default=3600
+            Minimum age in seconds of a cache file missing from the manifest before it is deleted on load. 
+            Younger files may be extractions in progress in another process sharing cache_dir.
+        """
+        self.cache_dir = str(cache_dir)
+        self.max_bytes = max_bytes
+        self.manifest_save_interval = manifest_save_interval
+        self.orphan_grace_period = orphan_grace_period
+        self.manifest_fn = os.path.join(self.cache_dir, 'manifest.json')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._last_save = 0
+        self._lock = threading.RLock()
+        self._load_manifest()
+
+    @property
+    def bytes(self):
+        return sum(entry['bytes'] for entry in self.entries.values())
+        
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_fn):
+            with open(self.manifest_fn) as f:
+                manifest = json.load(f)
+            self.hits = manifest.get('hits', 0)
+            self.misses = manifest.get('misses', 0)
+            self.evictions = manifest.get('evictions', 0)
+            for key, entry in sorted(manifest.get('entries', {}).items(), key=lambda kv: kv[1]['last_access']):
+                if os.path.exists(os.path.join(self.cache_dir, f'{key}.bam')):
+                    self.entries[key] = entry
+                    
+        # remove interrupted extractions and mini-bams missing from the manifest. 
+        # Only files named by the cache are removed, so other bams in cache_dir are kept
+        recorded_fns = {fn for key in self.entries.keys() for fn in [f'{key}.bam', f'{key}.bam.bai']}
+        now = time.time()
+        for fn in os.listdir(self.cache_dir):
+            if fn in recorded_fns or not CACHE_FN_PATTERN.match(fn):
+                continue
+            path = os.path.join(self.cache_dir, fn)
+            try:
+                if now - os.path.getmtime(path) > self.orphan_grace_period:
+                    os.remove(path)
+            except FileNotFoundError:
+                # finished or removed by another process
+                pass
+        self._evict()
+        self.save_manifest()
+    
+    def save_manifest(self):
+        """
+        Writes the manifest with the cache entries and statistics
+        """
+        with self._lock:
+            manifest = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'entries': dict(self.entries),
+            }
+            tmp_fn = f'{self.manifest_fn}.tmp'
+            with open(tmp_fn, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(tmp_fn, self.manifest_fn)
+            self._last_save = time.time()
+            
+    def stats(self):
+        """
+        Returns the number of hits, misses, evictions, entries and bytes stored
+        """
+        with self._lock:
+            return {
+                'hits': self.hits, 
+                'misses': self.misses, 
+                'evictions': self.evictions, 
+                'entries': len(self.entries), 
+                'bytes': self.bytes
+            }
+
+    def get_key(self, bam_path, regions: List[Tuple]) -> str:
+        """
+        Name of the cache entry for the regions of bam_path
+        """
+        key_str = json.dumps([str(bam_path), merge_regions(regions)])
+        return hashlib.sha1(key_str.encode()).hexdigest()
+
+    def get_bam_path(self, bam_path, regions: List[Tuple]) -> str:
+        """
+        Path of the cached mini-bam for the regions of bam_path, whether or not it exists yet
+        """
+        return os.path.join(self.cache_dir, f'{self.get_key(bam_path, regions)}.bam')
+
+    def contains(self, bam_path, regions: List[Tuple]) -> bool:
+        """
+        Whether the regions of bam_path are cached. Unlike get(), does not count a hit or miss 
+        or change which entries are evicted first
+        """
+        key = self.get_key(bam_path, regions)
+        with self._lock:
+            return key in self.entries and os.path.exists(os.path.join(self.cache_dir, f'{key}.bam'))
+
+    def get(self, bam_path, regions: List[Tuple]):
+        """
+        Returns the (bam, bai) paths of the cached mini-bam, or None if the regions have not been extracted
+        """
+        key = self.get_key(bam_path, regions)
+        cached_bam = os.path.join(self.cache_dir, f'{key}.bam')
+        with self._lock:
+            if key in self.entries and os.path.exists(cached_bam):
+                self.hits += 1
+                self.entries[key]['last_access'] = time.time()
+                self.entries.move_to_end(key)
+                result = cached_bam, f'{cached_bam}.bai'
+            else:
+                self.misses += 1
+                result = None
+            
+            if time.time() - self._last_save > self.manifest_save_interval:
+                self.save_manifest()
+        return result
+    
+    def add_entry(self, bam_path, regions: List[Tuple], n_bytes: int):
+        """
+        Records a mini-bam written to get_bam_path(bam_path, regions) and evicts 
+        the least recently used entries if the cache is larger than max_bytes
+        """
+        key = self.get_key(bam_path, regions)
+        with self._lock:
+            self.entries[key] = {
+                'bam_path': str(bam_path),
+                'regions': merge_regions(regions),
+                'bytes': n_bytes,
+                'last_access': time.time(),
+            }
+            self.entries.move_to_end(key)
+            self._evict(keep_key=key)
+            self.save_manifest()
+    
+    def _evict(self, keep_key=None):
+        with self._lock:
+            total_bytes = self.bytes
+            for key in list(self.entries.keys()):
+                if total_bytes <= self.max_bytes:
+                    break
+                if key == keep_key:
+                    continue
+                entry = self.entries.pop(key)
+                total_bytes -= entry['bytes']
+                self.evictions += 1
+                for fn in [f'{key}.bam', f'{key}.bam.bai']:
+                    if os.path.exists(os.path.join(self.cache_dir, fn)):
+                        os.remove(os.path.join(self.cache_dir, fn))
+
+    def fetch(self, bam_path, regions: List[Tuple], bai_path=None):
+        """
+        Returns the (bam, bai) paths of the cached mini-bam, extracting the regions from bam_path if needed.
+        See extract_region_bam()
+        """
+        cached = self.get(bam_path, regions)
+        if cached is not None:
+            return cached
+
+        cached_bam = self.get_bam_path(bam_path, regions)
+        n_bytes = extract_region_bam(bam_path, regions, cached_bam, bai_path=bai_path)
+        self.add_entry(bam_path, regions, n_bytes)
+        return cached_bam, f'{cached_bam}.bai'
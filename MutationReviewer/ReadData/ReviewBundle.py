@@ -0,0 +1,221 @@
+"""
+Review bundles: the reads needed to review all the mutations, extracted from each source bam into one small indexed bam.
+Loci of all mutations of a sample are padded and merged, and each source bam is read once. A new bams_df pointing
+to the bundle bams is written next to them, so a review can be moved to another machine and run without network access.
+"""
+import os
+import hashlib
+import json
+import pandas as pd
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Dict, List, Tuple, Union
+from pathlib import Path
+
+from MutationReviewer.DataTypes.GeneralMutationData import GeneralMutationData
+from MutationReviewer.ReadData.RegionCache import extract_region_bam, merge_regions
+
+
+REVIEW_BUNDLE_BAMS_DF_FN = 'bams_df.tsv'
+
+REVIEW_BUNDLE_MANIFEST_FN = 'manifest.json'
+
+
+def get_bundle_bam_regions(data: GeneralMutationData, padding=500) -> Dict[Tuple[str, str], List[Tuple]]:
+    """
+    Windows around the loci of all the mutations of each bam
+
+    Parameters
+    ----------
+    data: GeneralMutationData
+        Data object storing the mutations and bams
+
+    padding: int, default=500
+        Number of bases to include on each side of each mutation position
+
+    Returns
+    -------
+    Dict[Tuple[str, str], List[Tuple]]
+        (bam, bai) paths to the sorted, merged list of (chrom, start, end) regions of the mutations in the bam
+    """
+    loci_df = pd.concat([
+        pd.DataFrame({
+            'ref': data.mutations_df[data.mutations_df_bam_ref_col].astype(str).to_numpy(),
+            'chrom': data.mutations_df[chrom_col].astype(str).to_numpy(),
+            'pos': data.mutations_df[pos_col].to_numpy(),
+        })
+        for chrom_col, pos_col in zip(data.chrom_cols, data.pos_cols)
+    ], ignore_index=True).dropna().drop_duplicates()
+    loci_df['start'] = (loci_df['pos'].astype('int64') - padding).clip(lower=1)
+    loci_df['end'] = loci_df['pos'].astype('int64') + padding
+
+    bam_table_df = data.bam_table_df[[data.bams_df_ref_col, 'bam', 'bai']].rename(columns={data.bams_df_ref_col: 'ref'})
+    bam_loci_df = loci_df.merge(bam_table_df.astype({'ref': str}), on='ref')
+    return {
+        (str(bam), str(bai)): merge_regions(list(zip(df['chrom'], df['start'], df['end'])))
+        for (bam, bai), df in bam_loci_df.groupby(['bam', 'bai'], sort=False)
+    }
+
+
+def get_bundle_bam_fn(bam_path: str) -> str:
+    # source bams in different directories can share a file name
+    return f'{hashlib.sha1(str(bam_path).encode()).hexdigest()[:12]}.{os.path.basename(str(bam_path))}'
+
+
+def export_review_bundle(
+    data: GeneralMutationData,
+    bundle_dir: Union[str, Path],
+    padding=500,
+    n_workers=4,
+    use_processes=True,
+    overwrite=False,
+    oauth_token_provider=None,
+    verbose=True,
+) -> pd.DataFrame:
+    """
+    Writes a review bundle: one indexed bam per source bam with the reads around all its mutations,
+    and a bams_df pointing to them (REVIEW_BUNDLE_BAMS_DF_FN, with paths relative to bundle_dir)
+
+    Parameters
+    ----------
+    data: GeneralMutationData
+        Data object storing the mutations and bams
+
+    bundle_dir: str, Path
+        Directory to write the bundle to
+
+    padding: int, default=500
+        Number of bases to include on each side of each mutation position
+
+    n_workers: int, default=4
+        Number of source bams extracted in parallel
+
+    use_processes: bool, default=True
+        Extract with a process pool instead of a thread pool
+
+    overwrite: bool, default=False
+        Extract bams already in the bundle again. By default bams already extracted with the same regions 
+        (recorded in REVIEW_BUNDLE_MANIFEST_FN) are kept, so an interrupted export resumes where it stopped
+
+    oauth_token_provider: OAuthTokenProvider
+        Provider of the token used to read gs:// bams. See AppComponents.IGVJSComponent.get_oauth_token_provider
+
+    verbose: bool, default=True
+        Print progress
+
+    Returns
+    -------
+    pd.DataFrame
+        bams_df with the bam and bai columns replaced by the absolute paths of the bundle bams.
+        Bams without mutations are missing (NaN). See read_review_bundle_bams_df()
+
+    Raises
+    ------
+    RuntimeError
+        If any bam could not be extracted, after the other bams and the bams_df (where they are missing) are written. 
+        Exporting again retries them
+    """
+    bundle_dir = os.path.abspath(str(bundle_dir))
+    bams_dir = os.path.join(bundle_dir, 'bams')
+    os.makedirs(bams_dir, exist_ok=True)
+
+    manifest_fn = os.path.join(bundle_dir, REVIEW_BUNDLE_MANIFEST_FN)
+    manifest = {}
+    if os.path.exists(manifest_fn) and not overwrite:
+        with open(manifest_fn) as f:
+            manifest = json.load(f)
+
+    bam_regions = get_bundle_bam_regions(data, padding=padding)
+    bundle_paths = {bam: os.path.join(bams_dir, get_bundle_bam_fn(bam)) for bam, _ in bam_regions.keys()}
+    to_extract = {
+        (bam, bai): regions for (bam, bai), regions in bam_regions.items()
+        if manifest.get(bam) != [list(region) for region in regions] or not os.path.exists(bundle_paths[bam])
+    }
+
+    if verbose:
+        print(f'Extracting {len(to_extract)} of {len(bam_regions)} bams '
+              f'({sum(len(r) for r in to_extract.values())} regions) to {bams_dir}')
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    pending = list(to_extract.items())
+    errors = {}
+    n_bytes = 0
+    n_done = 0
+    with executor_class(max_workers=n_workers) as executor:
+        running = {}
+        while pending or running:
+            # bams are only submitted when a worker is free, so each gets a token fetched when its extraction starts
+            while pending and len(running) < n_workers:
+                (bam, bai), regions = pending.pop(0)
+                try:
+                    gcs_oauth_token = oauth_token_provider.get_token() \
+                        if bam.startswith('gs://') and oauth_token_provider is not None else None
+                except Exception as e:
+                    errors[bam] = e
+                    continue
+                future = executor.submit(
+                    extract_region_bam, bam, regions, bundle_paths[bam], bai_path=bai, gcs_oauth_token=gcs_oauth_token
+                )
+                running[future] = (bam, regions)
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                bam, regions = running.pop(future)
+                n_done += 1
+                try:
+                    n_bytes += future.result()
+                except Exception as e:
+                    errors[bam] = e
+                    if verbose:
+                        print(f'[{n_done}/{len(to_extract)}] Failed {bam}: {e}')
+                    continue
+                manifest[bam] = [list(region) for region in regions]
+                with open(f'{manifest_fn}.tmp', 'w') as f:
+                    json.dump(manifest, f)
+                os.replace(f'{manifest_fn}.tmp', manifest_fn)
+                if verbose:
+                    print(f'[{n_done}/{len(to_extract)}] {bam}')
+    if verbose and len(to_extract) > 0:
+        print(f'Wrote {n_bytes / 1024 ** 2:.1f} MB')
+    for bam in errors:
+        bundle_paths.pop(bam)
+
+    bams_df = data.bams_df.copy()
+    for bam_col, bai_col in zip(data.bam_cols, data.bai_cols):
+        bundle_bams = bams_df[bam_col].map(lambda bam: bundle_paths.get(str(bam)))
+        bams_df[bam_col] = bundle_bams
+        bams_df[bai_col] = bundle_bams.map(lambda bam: f'{bam}.bai' if isinstance(bam, str) else None)
+
+    relative_bams_df = bams_df.copy()
+    for col in data.bam_cols + data.bai_cols:
+        relative_bams_df[col] = bams_df[col].map(lambda path: os.path.relpath(path, bundle_dir) if isinstance(path, str) else None)
+    tmp_fn = os.path.join(bundle_dir, f'{REVIEW_BUNDLE_BAMS_DF_FN}.tmp')
+    relative_bams_df.to_csv(tmp_fn, sep='\t', index=False)
+    os.replace(tmp_fn, os.path.join(bundle_dir, REVIEW_BUNDLE_BAMS_DF_FN))
+
+    if len(errors) > 0:
+        raise RuntimeError(
+            f'Could not extract {len(errors)} of {len(bam_regions)} bams: ' + 
+            '; '.join(f'{bam}: {e}' for bam, e in errors.items())
+        )
+    return bams_df
+
+
+def read_review_bundle_bams_df(bundle_dir: Union[str, Path], bam_cols: List[str], bai_cols: List[str]) -> pd.DataFrame:
+    """
+    Reads the bams_df of a review bundle (ie copied to another machine), with absolute paths to the bundle bams. 
+    All columns are read as strings
+
+    Parameters
+    ----------
+    bundle_dir: str, Path
+        Directory of the bundle. See export_review_bundle()
+
+    bam_cols, bai_cols: List[str]
+        Columns of bams_df with the bam and bai paths
+    """
+    bundle_dir = os.path.abspath(str(bundle_dir))
+    bams_df = pd.read_csv(os.path.join(bundle_dir, REVIEW_BUNDLE_BAMS_DF_FN), sep='\t', dtype=str)
+    for col in bam_cols + bai_cols:
+        bams_df[col] = bams_df[col].map(lambda path: os.path.join(bundle_dir, path) if isinstance(path, str) else None)
+    return bams_df
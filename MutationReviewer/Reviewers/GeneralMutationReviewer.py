@@ -18,11 +18,26 @@ from pathlib import Path
 
 import pandas as pd
 import numpy as np
+import os
 from MutationReviewer.AppComponents.BamTableComponent import gen_bam_table_component
-from MutationReviewer.AppComponents.IGVJSComponent import gen_igv_js_component
+from MutationReviewer.AppComponents.IGVJSComponent import gen_igv_js_component, get_oauth_token_provider, DEFAULT_IGV_JS_URL
 from MutationReviewer.AppComponents.IGVLocalComponent import gen_igv_local_component
 from MutationReviewer.AppComponents.MutationTableComponent import gen_mutation_table_component
-from MutationReviewer.DataTypes.GeneralMutationData import GeneralMutationData
+from MutationReviewer.AppComponents.SuggestedTagsComponent import gen_suggested_tags_component, get_suggested_tags_store_id
+from MutationReviewer.AppComponents.utils import get_igv_local_session, gen_igv_snapshot_filename, run_igv_snapshot_batch
+from MutationReviewer.AppComponents.BamTableComponent import gen_bam_table_df
+from MutationReviewer.DataTypes.GeneralMutationData import GeneralMutationData, build_mutation_index, gen_mutation_index_name
+from MutationReviewer.DataTypes.DataStore import save_mutation_data, load_mutation_data, get_manifest_fn
+from MutationReviewer.ReadData.Prefetcher import MutationPrefetcher
+from MutationReviewer.ReadData.RegionCache import RegionCache
+from MutationReviewer.ReadData.ReviewBundle import export_review_bundle
+from MutationReviewer.Annotations.TagRules import TAG_ANNOTATIONS
+from MutationReviewer.Annotations.AnnotationLog import AnnotationLogDataInterface
+from MutationReviewer.Serving.WorkerPool import serve_review_workers
+from MutationReviewer.Serving.BamServer import register_bam_server_route, register_bam_files, register_bam_dir
+from MutationReviewer.Serving.BlockCacheProxy import (
+    BlockCache, set_block_cache, register_proxy_urls, register_block_cache_proxy_route
+)
 
 import igv_remote
         
@@ -59,6 +74,18 @@ class GeneralMutationReviewer(ReviewerTemplate):
         annot_col_config_dict: Dict = None,
         history_df: pd.DataFrame = None,
         index: List = None,
+        ref_allele_col: str = None,
+        alt_allele_col: str = None,
+        read_evidence_n_workers: int = None,
+        tumor_bam_col: str = None,
+        normal_bam_col: str = None,
+        reference_fasta: Union[str, Path] = None,
+        pon_path: Union[str, Path] = None,
+        pon_config: Dict = None,
+        compact_mutations_df: bool = False,
+        mutations_df_keep_cols: list = None,
+        data_store_dir: Union[str, Path] = None,
+        data_store_slim_pickle: bool = False,
     ) -> GeneralMutationData:
         """
         Parameters
@@ -99,14 +126,78 @@ class GeneralMutationReviewer(ReviewerTemplate):
         bai_cols: Union[str, list]
             Column(s) with corresponding bai files to view bams. Corresponding bai columns must be in same order as the bam_cols
             
+        ref_allele_col: str
+            Column in mutations_df with the reference allele (ie Reference_Allele). 
+            If ref_allele_col and alt_allele_col are provided, the reads supporting each mutation are counted in 
+            each of its bams with a process pool and displayed in the mutation and bam tables. Requires pysam.
+            
+        alt_allele_col: str
+            Column in mutations_df with the alternate allele (ie Tumor_Seq_Allele2)
+            
+        read_evidence_n_workers: int
+            Number of processes to count reads with. If None, uses the number of cpus
+            
+        tumor_bam_col: str
+            Column in bam_cols with the tumor bams, used to suggest tags from the read evidence. Defaults to the first bam column.
+            See set_default_autofill()
+            
+        normal_bam_col: str
+            Column in bam_cols with the normal bams, used to suggest normal_tags. If None, normal_tags are not suggested
+            
+        reference_fasta: str, Path
+            Path to the indexed reference fasta the mutations were called against. If provided, the reference context 
+            of each mutation is displayed in the mutation table and repeats are suggested as alignment_tags. Requires pysam.
+            
+        pon_path: str, Path
+            Path to a bgzipped, tabix-indexed panel of normals. If provided, the PoN record of each mutation is 
+            displayed in the mutation table and used to suggest normal_tags. Requires pysam.
+            
+        pon_config: Dict
+            Arguments for GeneralMutationData.compute_pon() describing the PoN columns 
+            (ie {'chrom_col': 'CHROM', 'pos_col': 'POS', 'coverage_col': 'n_normals_covered', 'value_cols': [...]}).
+            ref_allele_col and alt_allele_col are used to match alleles if the PoN ref_col and alt_col are set
+            
+        compact_mutations_df: bool, default=False
+            Store mutations_df compactly: repeated strings become categorical, integer columns int32, 
+            and only the key columns, ref_allele_col, alt_allele_col and mutations_df_keep_cols are kept. 
+            Prints the memory before and after. See GeneralMutationData.compact_mutations_df()
+            
+        mutations_df_keep_cols: list
+            Columns of mutations_df to keep when compact_mutations_df is True, 
+            ie the mutation_table_display_cols passed to gen_review_app(). If None, all columns are kept
+            
+        data_store_dir: str, Path
+            Directory to save the data object to as memory-mappable Feather files (see DataTypes.DataStore). 
+            If it already contains a saved data object, it is loaded instead of being rebuilt, 
+            and mutations_df and bams_df are not used. Requires pyarrow.
+            
+        data_store_slim_pickle: bool, default=False
+            Leave the tables saved in data_store_dir out of the data pickle, so annotations are saved faster. 
+            The pickle can then only be loaded while data_store_dir exists at the same absolute path. 
+            See DataTypes.DataStore.save_mutation_data
+            
         Returns
         -------
         GeneralMutationData
             Data object containing the relevant data for mutation review
         """
-        index = [self.gen_data_mut_index_name(list(map(str, idx))) for idx in mutations_df.groupby(mutation_groupby_cols).count().index]
-        mutations_df[chrom_cols] = mutations_df[chrom_cols].astype(str)
-        return GeneralMutationData(
+        if data_store_dir is not None and os.path.exists(get_manifest_fn(data_store_dir)):
+            return load_mutation_data(
+                data_store_dir, 
+                description=description, 
+                annot_df=annot_df, 
+                annot_col_config_dict=annot_col_config_dict, 
+                history_df=history_df,
+                slim_pickle=data_store_slim_pickle,
+            )
+            
+        # gen_data_mut_index_name is only called for each group when it is overridden
+        gen_data_mut_index_name_func = gen_mutation_index_name \
+            if type(self).gen_data_mut_index_name is GeneralMutationReviewer.gen_data_mut_index_name \
+            else self.gen_data_mut_index_name
+        mutation_index = build_mutation_index(mutations_df, mutation_groupby_cols, gen_data_mut_index_name_func)
+        index = mutation_index.keys()
+        data = GeneralMutationData(
             index=index,
             description=description,
             mutations_df=mutations_df,
@@ -121,6 +212,231 @@ class GeneralMutationReviewer(ReviewerTemplate):
             annot_df=annot_df,
             annot_col_config_dict=annot_col_config_dict,
             history_df=history_df,
+            mutation_index=mutation_index,
+        )
+        if compact_mutations_df:
+            data.compact_mutations_df(
+                keep_cols=None if mutations_df_keep_cols is None else 
+                list(mutations_df_keep_cols) + [c for c in [ref_allele_col, alt_allele_col] if c is not None]
+            )
+        if ref_allele_col is not None and alt_allele_col is not None:
+            data.compute_read_evidence(ref_allele_col, alt_allele_col, n_workers=read_evidence_n_workers)
+        if reference_fasta is not None:
+            data.compute_reference_context(reference_fasta)
+        if pon_path is not None:
+            data.compute_pon(pon_path, ref_allele_col=ref_allele_col, alt_allele_col=alt_allele_col, **(pon_config or {}))
+        if data.read_evidence_df is not None or data.reference_context_df is not None or data.pon_df is not None:
+            data.compute_mutation_tags(tumor_bam_col=tumor_bam_col, normal_bam_col=normal_bam_col)
+        if data_store_dir is not None:
+            save_mutation_data(data, data_store_dir, slim_pickle=data_store_slim_pickle)
+        return data
+    
+    def set_review_data(
+        self, 
+        data_path: Union[str, Path], 
+        *args, 
+        annotation_log: bool = False, 
+        annotation_log_compact_interval=60, 
+        annotation_log_fn: Union[str, Path] = None,
+        reviewer_name: str = None,
+        **kwargs
+    ):
+        """
+        Sets the review session data. See AnnoMate.ReviewerTemplate.set_review_data() and gen_data()
+        
+        Parameters
+        ----------
+        data_path: str, Path
+            Directory where the data pickle and metadata of the review session are saved
+            
+        annotation_log: bool, default=False
+            Append each annotation to an SQLite log (data_path/annotations.sqlite) instead of rewriting the data pickle 
+            on every submit, so saving does not slow down as the history grows. The pickle is rewritten in the background 
+            every annotation_log_compact_interval seconds if there are new annotations, 
+            and newer annotations are replayed from the log when the session is reopened. 
+            See Annotations.AnnotationLog
+            
+        annotation_log_compact_interval: float, default=60
+            Seconds between background rewrites of the data pickle
+            
+        annotation_log_fn: str, Path
+            Path to the annotation log, instead of data_path/annotations.sqlite. 
+            To split a review across several reviewers, each reviewer sets their own data_path and reviewer_name 
+            and the same annotation_log_fn (on a local filesystem shared by the reviewers' apps; 
+            SQLite locking is unreliable on network filesystems). Implies annotation_log
+            
+        reviewer_name: str
+            Name of the reviewer in a shared review. Annotations from the other reviewers are synced into this session, 
+            annotating a mutation that another reviewer annotated since it was loaded is recorded as a conflict 
+            (see get_annotation_conflicts()), and claim_review_shard() hands out mutations to review. 
+            Implies annotation_log
+        """
+        super().set_review_data(data_path, *args, **kwargs)
+        if annotation_log or annotation_log_fn is not None or reviewer_name is not None:
+            review_data_interface = self.review_data_interface
+            self.review_data_interface = AnnotationLogDataInterface(
+                review_data_interface.data_pkl_fn,
+                review_data_interface.data,
+                review_data_interface.mh,
+                log_fn=os.path.join(str(data_path), 'annotations.sqlite') if annotation_log_fn is None else annotation_log_fn,
+                compact_interval=annotation_log_compact_interval,
+                reviewer=reviewer_name,
+            )
+            
+    def claim_review_shard(self, shard_size=100, lease_seconds=8 * 3600) -> List:
+        """
+        Leases a shard of unannotated mutations to this reviewer in a shared review (see set_review_data()), 
+        and restricts the app to them. Mutations leased to other reviewers are skipped until their lease expires. 
+        Call before run(); call again for a new shard once the current one is annotated.
+        
+        Parameters
+        ----------
+        shard_size: int, default=100
+            Number of mutations to hold, including unannotated mutations already leased to this reviewer
+            
+        lease_seconds: float, default=8 hours
+            How long the mutations are reserved
+            
+        Returns
+        -------
+        List
+            Leased mutations, in index order
+            
+        Raises
+        ------
+        ValueError
+            If no unannotated mutations are left to lease. The current shard is kept
+        """
+        review_data_interface = self.review_data_interface
+        if not isinstance(review_data_interface, AnnotationLogDataInterface) or review_data_interface.reviewer is None:
+            raise ValueError('Set reviewer_name in set_review_data() to claim a shard of a shared review')
+        data = review_data_interface.data
+        review_data_interface.replay_log()
+        shard = review_data_interface.log.acquire_leases(
+            review_data_interface.reviewer, data.mutation_index.keys(), shard_size, lease_seconds=lease_seconds
+        )
+        if len(shard) == 0:
+            raise ValueError(
+                f'No unannotated mutations are left to lease to {review_data_interface.reviewer}. '
+                f'The current shard of {len(data.index)} mutations is kept'
+            )
+        data.index = shard
+        if getattr(self, 'prefetcher', None) is not None:
+            self.prefetcher.reset_position()
+        return shard
+    
+    def release_review_shard(self):
+        """
+        Returns the unannotated mutations leased to this reviewer to the shared review
+        """
+        self.review_data_interface.log.release_leases(self.review_data_interface.reviewer)
+        
+    def get_annotation_conflicts(self) -> pd.DataFrame:
+        """
+        Mutations annotated by a reviewer after another reviewer had annotated them, from the annotation log
+        """
+        return self.review_data_interface.log.get_conflicts()
+    
+    def get_reviewer_progress(self) -> pd.DataFrame:
+        """
+        Number of annotations, annotated mutations and leased mutations of each reviewer, from the annotation log
+        """
+        return self.review_data_interface.log.get_reviewer_progress()
+    
+    def export_review_bundle(
+        self, 
+        bundle_dir: Union[str, Path], 
+        padding=500, 
+        n_workers=4, 
+        use_processes=True, 
+        overwrite=False, 
+        set_env_command=None,
+    ) -> pd.DataFrame:
+        """
+        Extracts the reads around all the mutations from each bam into one small indexed bam in bundle_dir, 
+        and writes a bams_df pointing to them (bundle_dir/bams_df.tsv). Use the returned bams_df 
+        (or ReadData.ReviewBundle.read_review_bundle_bams_df() on another machine) in gen_data() 
+        to review without reading the original bams. See ReadData.ReviewBundle.export_review_bundle()
+        
+        Parameters
+        ----------
+        bundle_dir: str, Path
+            Directory to write the bundle to
+            
+        padding: int, default=500
+            Number of bases to include on each side of each mutation position
+            
+        n_workers: int, default=4
+            Number of bams extracted in parallel
+            
+        use_processes: bool, default=True
+            Extract with a process pool instead of a thread pool
+            
+        overwrite: bool, default=False
+            Extract bams already in the bundle again
+            
+        set_env_command: str
+            bash command to run to set the environment before getting the token to read gs:// bams
+            
+        Returns
+        -------
+        pd.DataFrame
+            bams_df pointing to the bundle bams
+        """
+        return export_review_bundle(
+            self.review_data_interface.data, 
+            bundle_dir, 
+            padding=padding, 
+            n_workers=n_workers, 
+            use_processes=use_processes, 
+            overwrite=overwrite,
+            oauth_token_provider=get_oauth_token_provider(set_env_command=set_env_command),
+        )
+    
+    def run_workers(
+        self, 
+        n_workers=4, 
+        host='0.0.0.0', 
+        port=8050, 
+        data_store_dir: Union[str, Path] = None, 
+        sync_interval=1, 
+        **kwargs
+    ):
+        """
+        Runs the app in several worker processes sharing one port, so callbacks (ie loading bams into IGV) 
+        run in parallel. Workers memory-map the mutation, bam and precomputed tables from a data store 
+        (saved first if the data was not saved to or loaded from one), and annotations are written 
+        to the annotation log by a single writer in this process. Requires set_review_data(annotation_log=True). 
+        Linux and macOS only (workers are forked). See Serving.WorkerPool
+        
+        Parameters
+        ----------
+        n_workers: int, default=4
+            Number of worker processes
+            
+        host: str, default='0.0.0.0'
+            Host address
+            
+        port: int, default=8050
+            Port number
+            
+        data_store_dir: str, Path
+            Directory to save the data store in. Defaults to data_store/ next to the data pickle
+            
+        sync_interval: float, default=1
+            Seconds between syncs of annotations between workers
+            
+        **kwargs:
+            Other arguments for run() (ie review_data_table_df)
+        """
+        serve_review_workers(
+            self, 
+            n_workers=n_workers, 
+            host=host, 
+            port=port, 
+            data_store_dir=data_store_dir, 
+            sync_interval=sync_interval, 
+            **kwargs
         )
         
         
@@ -134,8 +450,22 @@ class GeneralMutationReviewer(ReviewerTemplate):
         init_max_bams_view=2,
         igv_mode='igv_js', # or 'igv_local'
         bam_table_page_size=10,
+        mutation_table_mode='static',
+        mutation_table_page_size=20,
         set_env_command=None,
-        local_igv_view_type="collapsed", local_igv_sort="base", local_igv_img_dir= "igv_snapshots/"
+        local_igv_view_type="collapsed", local_igv_sort="base", local_igv_img_dir= "igv_snapshots/",
+        prefetch_n_ahead=0,
+        prefetch_n_workers=4,
+        prefetch_padding=500,
+        prefetch_use_processes=False,
+        read_cache_dir='read_cache/',
+        read_cache_max_bytes=10 * 1024 ** 3,
+        use_cached_bams=False,
+        serve_local_bams=True,
+        block_cache_dir: Union[str, Path] = None,
+        block_cache_max_bytes=10 * 1024 ** 3,
+        block_cache_block_size=1024 ** 2,
+        igv_js_url: str = DEFAULT_IGV_JS_URL,
     ) -> ReviewDataApp:
         """
         Parameters
@@ -173,6 +503,69 @@ class GeneralMutationReviewer(ReviewerTemplate):
                 
             both: Have both igv_js and igv_local available to load bams
             
+        mutation_table_mode: str, ['static', 'paged'], default='static'
+            'static' displays all the mutations in the group. 
+            'paged' sorts, filters and pages the mutation table on the server and only sends the visible page. 
+            Use when mutation groups are large (ie grouping by gene across a cohort)
+            
+        mutation_table_page_size: int, default=20
+            Number of mutations per page in 'paged' mode
+            
+        local_igv_view_type: str, ["collapsed", "expanded", "squished"], default="collapsed"
+            How to view the alignments in the local IGV app
+            
+        local_igv_sort: str, default="base"
+            Feature to sort the alignments by in the local IGV app
+            
+        local_igv_img_dir: str, default="igv_snapshots/"
+            Directory where the local IGV app saves snapshots
+            
+        prefetch_n_ahead: int, default=0
+            Number of upcoming mutations to prefetch reads for into read_cache_dir. If 0, nothing is prefetched.
+            See ReadData.Prefetcher.MutationPrefetcher
+            
+        prefetch_n_workers: int, default=4
+            Number of threads or processes prefetching reads in parallel
+            
+        prefetch_padding: int, default=500
+            Number of bases to prefetch on each side of each mutation position
+            
+        prefetch_use_processes: bool, default=False
+            Prefetch with a process pool instead of a thread pool
+            
+        read_cache_dir: str, default='read_cache/'
+            Directory to store prefetched reads in
+            
+        read_cache_max_bytes: int, default=10GB
+            Maximum size of read_cache_dir. Least recently used reads are deleted first
+            
+        use_cached_bams: bool, default=False
+            Point the bam table, and so IGV, to the prefetched reads instead of the original bams when available. 
+            Cached bams are local files, so they can be loaded by the local IGV app. 
+            
+        serve_local_bams: bool, default=True
+            In IGV.js mode, serve the bams and bais of bams_df that are local paths (and the cached bams) 
+            from the app with HTTP range requests, so IGV.js can load them. Other files are not accessible. 
+            See Serving.BamServer
+            
+        block_cache_dir: str, Path
+            In IGV.js mode, load the remote (gs://, https://) bams and bais of bams_df through a caching proxy in the app, 
+            which stores the blocks read by IGV.js in block_cache_dir, so reviewers loading the same bams 
+            do not download the same blocks again. If None, IGV.js reads remote bams directly. 
+            See Serving.BlockCacheProxy
+            
+        block_cache_max_bytes: int, default=10GB
+            Maximum size of block_cache_dir. Least recently used blocks are deleted first
+            
+        block_cache_block_size: int, default=1MB
+            Size of the cached blocks
+            
+        igv_js_url: str, default=DEFAULT_IGV_JS_URL
+            Url to load igv.js from (ie a copy served with the app). A single IGV.js browser is kept 
+            and only the locus and changed tracks are updated for each mutation. 
+            If None, or if igv.js cannot be loaded (ie offline), IGV.js is rebuilt for each mutation 
+            with the igv.js bundled in dash-bio
+            
         Returns
         -------
         ReviewDataApp
@@ -181,21 +574,54 @@ class GeneralMutationReviewer(ReviewerTemplate):
         """
         app = ReviewDataApp()
         
+        self.prefetcher = None
+        if prefetch_n_ahead > 0:
+            self.prefetcher = MutationPrefetcher(
+                RegionCache(read_cache_dir, max_bytes=read_cache_max_bytes),
+                n_ahead=prefetch_n_ahead,
+                n_workers=prefetch_n_workers,
+                padding=prefetch_padding,
+                use_processes=prefetch_use_processes,
+                oauth_token_provider=get_oauth_token_provider(set_env_command=set_env_command),
+            )
+        
         app.add_component(
-            gen_mutation_table_component(),
+            gen_mutation_table_component(
+                mutation_table_mode=mutation_table_mode, 
+                mutation_table_page_size=mutation_table_page_size
+            ),
             mutation_table_display_cols=mutation_table_display_cols,
-            gen_data_mut_index_name_func=self.gen_data_mut_index_name
         )
         
+        if self.review_data_interface.data.mutation_tags_df is not None:
+            app.add_component(gen_suggested_tags_component())
+        
         app.add_component(
             gen_bam_table_component(bam_table_page_size=bam_table_page_size, init_max_bams_view=init_max_bams_view),
             bam_table_display_cols=bam_table_display_cols,
-            gen_data_mut_index_name_func=self.gen_data_mut_index_name,
-            init_max_bams_view=init_max_bams_view
+            init_max_bams_view=init_max_bams_view,
+            prefetcher=self.prefetcher,
+            use_cached_bams=use_cached_bams,
         )
         
         if (igv_mode == 'igv_js') or (igv_mode == 'both'):
             
+            if serve_local_bams and register_bam_server_route():
+                data = self.review_data_interface.data
+                register_bam_files(data.bams_df[data.bam_cols + data.bai_cols].stack().dropna().astype(str))
+                if self.prefetcher is not None:
+                    register_bam_dir(read_cache_dir)
+                    
+            if block_cache_dir is not None and register_block_cache_proxy_route():
+                data = self.review_data_interface.data
+                set_block_cache(BlockCache(
+                    block_cache_dir, 
+                    block_size=block_cache_block_size, 
+                    max_bytes=block_cache_max_bytes,
+                    oauth_token_provider=get_oauth_token_provider(set_env_command=set_env_command),
+                ))
+                register_proxy_urls(data.bams_df[data.bam_cols + data.bai_cols].stack().dropna().astype(str))
+                    
             app.add_component(
                 gen_igv_js_component(
                     bam_table_state=State('bam-table', 'data'), 
@@ -204,37 +630,128 @@ class GeneralMutationReviewer(ReviewerTemplate):
                 genome=genome,
                 track_height=track_height,
                 minimumBases=minimumBases,
-                gen_data_mut_index_name_func=self.gen_data_mut_index_name,
-                set_env_command=set_env_command
+                set_env_command=set_env_command,
+                init_max_bams_view=init_max_bams_view,
+                igv_js_url=igv_js_url,
             )
             
         if igv_mode == 'igv_local' or (igv_mode == 'both'):
 
-            # self.ir = igv_remote.IGV_remote()
-
-            # try:
-            #     self.ir.connect()
-            #     self.ir.close()
-            # except ConnectionRefusedError as e:
-            #     print(e)
-            #     raise ConnectionRefusedError("IGV application is not open.")
-
-            # print('set_saveopts')
-            # self.ir.set_saveopts(img_dir=local_igv_img_dir, img_basename = "test.png" )
-            # print('set viewopts')
-            # self.ir.set_viewopts(view_type=local_igv_view_type, sort=local_igv_sort)
+            self.igv_local_session = get_igv_local_session(
+                view_type=local_igv_view_type, 
+                sort=local_igv_sort, 
+                img_dir=local_igv_img_dir
+            )
             
             app.add_component(
                 gen_igv_local_component(
                     bam_table_data_state=State('bam-table', 'data'), 
                     bam_table_selected_rows_state=State('bam-table', 'selected_rows')
                 ),
-                gen_data_mut_index_name_func=self.gen_data_mut_index_name,
-                # ir=self.ir
+                igv_local_session=self.igv_local_session
             )
         
         return app
         
+    def gen_igv_snapshots(
+        self,
+        img_dir="igv_snapshots/",
+        ports=(60151,),
+        host='127.0.0.1',
+        max_bams_view=2,
+        view_type="collapsed",
+        sort="base",
+        max_retries=2,
+        resume=True,
+        write_batch_scripts=True,
+        idxs=None,
+        timeout=300,
+        verbose=True,
+    ) -> pd.DataFrame:
+        """
+        Takes an IGV snapshot of every locus of every mutation in the index with a pool of running IGV apps.
+        Snapshots are named {mutation index name}.locus{i}.{chrom}_{pos}.png. See AppComponents.utils.run_igv_snapshot_batch
+        
+        Parameters
+        ----------
+        img_dir: str, Path, default="igv_snapshots/"
+            Directory to save the snapshots in
+            
+        ports: List[int], default=(60151,)
+            Ports of the running IGV apps (one app per port). Snapshots are taken in parallel across apps. 
+            All apps must be able to read the bams (ie logged in to google for gs:// urls)
+            
+        host: str, default='127.0.0.1'
+            Host running the IGV apps
+            
+        max_bams_view: int, default=2
+            Number of bams from the bam table to load for each mutation
+            
+        view_type: str, ["collapsed", "expanded", "squished"], default="collapsed"
+            How to view the alignments
+        
+        sort: str, default="base"
+            Feature to sort the alignments by
+            
+        max_retries: int, default=2
+            Number of times to retry a failed mutation
+            
+        resume: bool, default=True
+            Skip mutations whose snapshots already exist in img_dir
+            
+        write_batch_scripts: bool, default=True
+            Write the IGV batch script of each mutation to img_dir/batch_scripts
+            
+        idxs: list
+            Subset of the index to take snapshots of. If None, uses the whole index
+            
+        timeout: int, default=300
+            Seconds to wait for IGV to reply to each command
+            
+        Returns
+        -------
+        pd.DataFrame
+            Status of each mutation, with the paths to its snapshots
+        """
+        data = self.review_data_interface.data
+        img_dir = os.path.abspath(img_dir)
+        idxs = data.index if idxs is None else idxs
+        
+        tasks = []
+        for idx in idxs:
+            idx_mut_df = data.get_mutation_df(idx)
+            if idx_mut_df.empty:
+                continue
+            r = idx_mut_df.iloc[0]
+            loci = [(str(r[chrom]), r[pos]) for chrom, pos in zip(data.chrom_cols, data.pos_cols)]
+            bams_df = gen_bam_table_df(data, idx, bam_table_display_cols=[]).iloc[:max_bams_view]
+            tasks.append({
+                'idx': idx,
+                'bams': bams_df['bam'].astype(str).tolist(),
+                'bais': bams_df['bai'].astype(str).tolist(),
+                'loci': loci,
+                'snapshot_fns': [
+                    os.path.join(img_dir, gen_igv_snapshot_filename(idx, i, chrom, pos)) 
+                    for i, (chrom, pos) in enumerate(loci)
+                ],
+            })
+            
+        results_df = run_igv_snapshot_batch(
+            tasks,
+            ports=ports,
+            host=host,
+            script_dir=os.path.join(img_dir, 'batch_scripts') if write_batch_scripts else None,
+            max_retries=max_retries,
+            resume=resume,
+            timeout=timeout,
+            view_type=view_type,
+            sort=sort,
+            verbose=verbose,
+        )
+        snapshot_fns = {task['idx']: task['snapshot_fns'] for task in tasks}
+        results_df['snapshot_fns'] = results_df['idx'].map(snapshot_fns)
+        return results_df
+        
     def set_default_review_data_annotations(self):
         
         # Calls
@@ -322,5 +839,12 @@ class GeneralMutationReviewer(ReviewerTemplate):
         self.add_annotation_display_component('Notes', TextAreaAnnotationDisplay())
         
     def set_default_autofill(self):
-        pass
+        # tags suggested from the read evidence (see GeneralMutationData.compute_mutation_tags)
+        if self.review_data_interface.data.mutation_tags_df is not None:
+            for annot_name in TAG_ANNOTATIONS:
+                self.add_autofill(
+                    'Suggested tags', 
+                    State(get_suggested_tags_store_id(annot_name), 'data'), 
+                    annot_name
+                )
     
\ No newline at end of file
@@ -0,0 +1,244 @@
+"""
+Serves whitelisted local bam, bai and cram files from the reviewer app's Flask server with HTTP range requests,
+so IGV.js in the browser can load bams that are only on the machine running the app
+(ie local_bam_path in 1k_genomes_bam_paths.txt, or the prefetched reads of a RegionCache).
+Files are registered before the app is run; IGV.js tracks pointing to registered paths are rewritten to the served urls.
+Requires dash>=3.0 (dash.hooks).
+"""
+import os
+import re
+import ssl
+import hashlib
+import threading
+import warnings
+from typing import Iterable, Union
+from pathlib import Path
+
+
+BAM_SERVER_ROUTE = 'igv-files'
+
+BAM_SERVER_EXTENSIONS = ('.bam', '.bai', '.cram', '.crai', '.csi')
+
+BAM_SERVER_CHUNK_SIZE = 1024 ** 2
+
+_served_paths = {}
+_served_paths_lock = threading.Lock()
+_bam_server_route_registered = False
+
+
+def is_local_path(path: str) -> bool:
+    """
+    Whether path is a local file path rather than a url (ie gs://, https://)
+    """
+    return isinstance(path, str) and path != '' and re.match(r'^[a-zA-Z][a-zA-Z0-9+.-]*://', path) is None
+
+
+def is_gcs_url(path: str) -> bool:
+    """
+    Whether path is a Google Cloud Storage url (gs://bucket/object or its https:// form), read with an oauth token
+    """
+    return isinstance(path, str) and re.match(r'^(gs://|https://storage\.(googleapis|cloud\.google)\.com/)', path) is not None
+
+
+def get_path_token(path: Union[str, Path]) -> str:
+    # derived from the path only, so urls are the same in all serving workers
+    return hashlib.sha1(os.path.realpath(str(path)).encode()).hexdigest()[:20]
+
+
+def register_bam_file(path: Union[str, Path]) -> str:
+    """
+    Whitelists a local bam, bai or cram file (see BAM_SERVER_EXTENSIONS)
+
+    Returns
+    -------
+    str
+        Url of the file, relative to the app
+    """
+    path = os.path.realpath(str(path))
+    if not path.endswith(BAM_SERVER_EXTENSIONS):
+        raise ValueError(f'{path} is not one of {BAM_SERVER_EXTENSIONS}')
+    token = get_path_token(path)
+    with _served_paths_lock:
+        _served_paths[token] = ('file', path)
+    return f'{BAM_SERVER_ROUTE}/{token}/{os.path.basename(path)}'
+
+
+def register_bam_dir(path: Union[str, Path]) -> str:
+    """
+    Whitelists the bam, bai and cram files in a local directory and its subdirectories,
+    including files added later (ie the RegionCache of the prefetcher)
+
+    Returns
+    -------
+    str
+        Token of the directory
+    """
+    path = os.path.realpath(str(path))
+    token = get_path_token(path)
+    with _served_paths_lock:
+        _served_paths[token] = ('dir', path)
+    return token
+
+
+def register_bam_files(paths: Iterable) -> int:
+    """
+    Whitelists the local paths in paths. Urls and missing values are skipped
+
+    Returns
+    -------
+    int
+        Number of files registered
+    """
+    n = 0
+    for path in set(paths):
+        if is_local_path(path) and str(path).endswith(BAM_SERVER_EXTENSIONS):
+            register_bam_file(path)
+            n += 1
+    return n
+
+
+def get_bam_url(path: str) -> str:
+    """
+    Served url of a whitelisted local file, relative to the app. Other paths and urls are returned unchanged
+    """
+    if not is_local_path(path):
+        return path
+    real_path = os.path.realpath(path)
+    with _served_paths_lock:
+        if _served_paths.get(get_path_token(real_path)) == ('file', real_path):
+            return f'{BAM_SERVER_ROUTE}/{get_path_token(real_path)}/{os.path.basename(real_path)}'
+        for token, (kind, served_path) in _served_paths.items():
+            if kind == 'dir' and real_path.startswith(served_path + os.sep):
+                return f'{BAM_SERVER_ROUTE}/{token}/{os.path.relpath(real_path, served_path)}'
+    return path
+
+
+def resolve_bam_url(token: str, filename: str) -> str:
+    """
+    Local path of a served url, or None if it is not whitelisted
+    """
+    with _served_paths_lock:
+        kind, served_path = _served_paths.get(token, (None, None))
+    if kind == 'file':
+        return served_path if filename == os.path.basename(served_path) else None
+    if kind == 'dir':
+        path = os.path.realpath(os.path.join(served_path, filename))
+        if path.startswith(served_path + os.sep) and path.endswith(BAM_SERVER_EXTENSIONS):
+            return path
+    return None
+
+
+def _iter_file_range(environ, path: str, start: int, length: int):
+    with open(path, 'rb') as f:
+        sock = environ.get('werkzeug.socket')
+        if sock is not None and not isinstance(sock, ssl.SSLSocket) and sock.gettimeout() is None \
+                and hasattr(os, 'sendfile'):
+            # werkzeug sends the headers on the first (empty) write, then the range is copied
+            # from the page cache to the socket by the kernel
+            yield b''
+            end = start + length
+            while start < end:
+                sent = os.sendfile(sock.fileno(), f.fileno(), start, min(end - start, 64 * BAM_SERVER_CHUNK_SIZE))
+                if sent == 0:
+                    break
+                start += sent
+            return
+
+        end = start + length
+        while start < end:
+            chunk = os.pread(f.fileno(), min(end - start, BAM_SERVER_CHUNK_SIZE), start)
+            if not chunk:
+                break
+            start += len(chunk)
+            yield chunk
+
+
+def gen_range_response(size: int, etag: str, gen_body, content_type='application/octet-stream'):
+    """
+    Response to the current Flask request for a resource of size bytes. Supports single byte ranges
+    (Range, If-Range), ETags (If-None-Match) and HEAD requests
+
+    Parameters
+    ----------
+    size: int
+        Size of the resource in bytes
+
+    etag: str
+        Unquoted ETag of the resource
+
+    gen_body: Callable
+        gen_body(start, length) returns an iterable of the bytes of the resource from start
+
+    Returns
+    -------
+    flask.Response
+    """
+    from flask import request, Response
+    from werkzeug.http import quote_etag
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': quote_etag(etag),
+        'Cache-Control': 'no-cache',
+        'Content-Type': content_type,
+    }
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    start, length, status = 0, size, 200
+    byte_range = request.range
+    if_range = request.if_range
+    # multiple ranges, and ranges of a changed file (If-Range), are answered with the whole file
+    if byte_range is not None and len(byte_range.ranges) == 1 and if_range.date is None \
+            and if_range.etag in (None, etag):
+        range_bounds = byte_range.range_for_length(size)
+        if range_bounds is None:
+            return Response(status=416, headers={**headers, 'Content-Range': f'bytes */{size}'})
+        start, length, status = range_bounds[0], range_bounds[1] - range_bounds[0], 206
+        headers['Content-Range'] = f'bytes {range_bounds[0]}-{range_bounds[1] - 1}/{size}'
+    headers['Content-Length'] = str(length)
+
+    if request.method == 'HEAD':
+        return Response(status=status, headers=headers)
+    return Response(gen_body(start, length), status=status, headers=headers, direct_passthrough=True)
+
+
+def serve_bam_file(token: str, filename: str):
+    """
+    Flask view serving a whitelisted file. See gen_range_response().
+    Connections are kept alive by servers supporting it
+    """
+    from flask import request, Response
+
+    path = resolve_bam_url(token, filename)
+    if path is None or not os.path.isfile(path):
+        return Response('Not found', status=404)
+
+    stat = os.stat(path)
+    return gen_range_response(
+        stat.st_size,
+        f'{stat.st_size:x}-{stat.st_mtime_ns:x}',
+        lambda start, length: _iter_file_range(request.environ, path, start, length),
+    )
+
+
+def register_bam_server_route() -> bool:
+    """
+    Adds the route serving registered files to Dash apps created afterwards (see dash.hooks)
+
+    Returns
+    -------
+    bool
+        Whether the route is available
+    """
+    global _bam_server_route_registered
+    if _bam_server_route_registered:
+        return True
+    try:
+        from dash import hooks
+    except ImportError:
+        warnings.warn('Serving local bams to IGV.js requires dash>=3.0. Local bam paths are passed to IGV.js unchanged')
+        return False
+    hooks.route(name=f'{BAM_SERVER_ROUTE}/<token>/<path:filename>', methods=('GET', 'HEAD'))(serve_bam_file)
+    _bam_server_route_registered = True
+    return True
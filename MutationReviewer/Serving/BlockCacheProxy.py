@@ -0,0 +1,396 @@
+"""
+Read-through caching proxy for remote (gs://, https://) bams loaded by IGV.js. IGV.js track urls are rewritten to
+a route of the reviewer app, which answers range requests from fixed-size blocks cached on local disk
+(least recently used blocks are deleted first) and fetches missing blocks from the remote file once,
+however many reviewers request them at the same time. Index files (bai, crai, csi) are kept whole in memory.
+Requires dash>=3.0 (dash.hooks).
+"""
+import os
+import re
+import hashlib
+import itertools
+import threading
+import uuid
+import urllib.request
+import urllib.parse
+import warnings
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Iterable, Union
+from pathlib import Path
+
+from MutationReviewer.Serving.BamServer import gen_range_response, is_local_path, is_gcs_url
+
+
+BLOCK_CACHE_PROXY_ROUTE = 'igv-proxy'
+
+INDEX_EXTENSIONS = ('.bai', '.crai', '.csi', '.tbi')
+
+_proxied_urls = {}
+_proxied_urls_lock = threading.Lock()
+_block_cache = None
+_block_cache_proxy_route_registered = False
+
+
+class RemoteFileError(IOError):
+    """
+    Raised when a remote file cannot be read
+    """
+    pass
+
+
+class BlockCache:
+    """
+    Size-bounded directory of fixed-size blocks of remote files, plus an in-memory cache of whole index files.
+    Concurrent requests for a block that is being fetched wait for that fetch instead of starting another one.
+    """
+    def __init__(
+        self,
+        cache_dir: Union[str, Path] = 'block_cache/',
+        block_size=1024 ** 2,
+        max_bytes=10 * 1024 ** 3,
+        index_max_bytes=256 * 1024 ** 2,
+        oauth_token_provider=None,
+        gs_endpoint='https://storage.googleapis.com',
+        timeout=60,
+    ):
+        """
+        Parameters
+        ----------
+        cache_dir: str, Path, default='block_cache/'
+            Directory to store the blocks in. Created if it does not exist
+
+        block_size: int, default=1MB
+            Size of the cached blocks. Requests are answered from whole blocks
+
+        max_bytes: int, default=10GB
+            Maximum total size of the cached blocks
+
+        index_max_bytes: int, default=256MB
+            Maximum total size of the index files kept in memory
+
+        oauth_token_provider: OAuthTokenProvider
+            Provider of the token used to read gs:// and https://storage.googleapis.com files. See AppComponents.IGVJSComponent.get_oauth_token_provider
+
+        gs_endpoint: str, default='https://storage.googleapis.com'
+            Url gs://bucket/object urls are read from, as {gs_endpoint}/bucket/object (ie a local stand-in for tests)
+
+        timeout: float, default=60
+            Seconds to wait for the remote server
+        """
+        self.cache_dir = str(cache_dir)
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.index_max_bytes = index_max_bytes
+        self.oauth_token_provider = oauth_token_provider
+        self.gs_endpoint = gs_endpoint.rstrip('/')
+        self.timeout = timeout
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.entries = OrderedDict()
+        self.index_files = OrderedDict()
+        self.sizes = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.remote_bytes = 0
+        self._fetches = {}
+        self._lock = threading.RLock()
+        self._load_entries()
+
+    def _load_entries(self):
+        # blocks left by a previous session, oldest first. Interrupted writes are removed
+        block_fns = []
+        for fn in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, fn)
+            if fn.endswith('.tmp'):
+                os.remove(path)
+            elif fn.endswith('.block'):
+                stat = os.stat(path)
+                block_fns.append((stat.st_mtime, fn[:-len('.block')], stat.st_size))
+        for _, key, n_bytes in sorted(block_fns):
+            self.entries[key] = n_bytes
+        self._evict()
+
+    @property
+    def bytes(self):
+        return sum(self.entries.values())
+
+    def stats(self):
+        """
+        Returns the number of hits, misses, evictions, cached blocks, bytes stored and bytes read from remote files
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'blocks': len(self.entries),
+                'bytes': self.bytes,
+                'index_files': len(self.index_files),
+                'index_bytes': sum(len(v) for v in self.index_files.values()),
+                'remote_bytes': self.remote_bytes,
+            }
+
+    def get_http_url(self, url: str) -> str:
+        """
+        Url to read a remote file from. gs:// urls are read from gs_endpoint
+        """
+        if url.startswith('gs://'):
+            bucket, _, blob = url[len('gs://'):].partition('/')
+            return f'{self.gs_endpoint}/{bucket}/{urllib.parse.quote(blob)}'
+        return url
+
+    def _open(self, url: str, start: int, end: int):
+        request = urllib.request.Request(self.get_http_url(url), headers={'Range': f'bytes={start}-{end - 1}'})
+        if is_gcs_url(url) and self.oauth_token_provider is not None:
+            request.add_header('Authorization', f'Bearer {self.oauth_token_provider.get_token()}')
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout)
+        except (OSError, ValueError) as e:
+            raise RemoteFileError(f'Could not read bytes {start}-{end - 1} of {url}: {e}')
+
+    def get_size(self, url: str) -> int:
+        """
+        Size of a remote file in bytes, from the Content-Range of a one byte request
+        """
+        with self._lock:
+            if url in self.sizes:
+                return self.sizes[url]
+        return self._single_flight(('size', url), lambda: self._fetch_size(url))
+
+    def _fetch_size(self, url: str) -> int:
+        with self._open(url, 0, 1) as response:
+            content_range = response.headers.get('Content-Range', '')
+            match = re.match(r'bytes \d+-\d+/(\d+)', content_range)
+            if match is not None:
+                size = int(match.group(1))
+            elif response.status == 200 and response.headers.get('Content-Length') is not None:
+                size = int(response.headers['Content-Length'])
+            else:
+                raise RemoteFileError(f'{url} does not support range requests')
+        with self._lock:
+            self.sizes[url] = size
+        return size
+
+    def get_block_key(self, url: str, block_i: int) -> str:
+        # the size is part of the key, so blocks of a replaced file are not reused
+        url_key = hashlib.sha1(f'{url}|{self.get_size(url)}|{self.block_size}'.encode()).hexdigest()
+        return f'{url_key}.{block_i}'
+
+    def _single_flight(self, cache_key, fetch):
+        """
+        Runs fetch() unless a fetch of cache_key is running, in which case its result is returned
+        """
+        with self._lock:
+            future = self._fetches.get(cache_key)
+            owner = future is None
+            if owner:
+                future = self._fetches[cache_key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            result = fetch()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._fetches[cache_key]
+
+    def _fetch_block(self, url: str, block_i: int, key: str) -> bytes:
+        size = self.get_size(url)
+        start = block_i * self.block_size
+        end = min(start + self.block_size, size)
+        with self._open(url, start, end) as response:
+            block = response.read()
+            if response.status == 200 and len(block) == size:
+                # server ignored the range
+                block = block[start:end]
+        if len(block) != end - start:
+            raise RemoteFileError(f'Expected {end - start} bytes from {url} at {start}, received {len(block)}')
+
+        path = os.path.join(self.cache_dir, f'{key}.block')
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(block)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.misses += 1
+            self.remote_bytes += len(block)
+            self.entries[key] = len(block)
+            self.entries.move_to_end(key)
+            self._evict(keep_key=key)
+        return block
+
+    def get_block(self, url: str, block_i: int) -> bytes:
+        """
+        Returns block block_i of a remote file, from the cache or the remote file
+        """
+        key = self.get_block_key(url, block_i)
+        with self._lock:
+            cached = key in self.entries
+            if cached:
+                self.entries.move_to_end(key)
+        if cached:
+            try:
+                with open(os.path.join(self.cache_dir, f'{key}.block'), 'rb') as f:
+                    block = f.read()
+                os.utime(os.path.join(self.cache_dir, f'{key}.block'))
+                with self._lock:
+                    self.hits += 1
+                return block
+            except FileNotFoundError:
+                # evicted by another process sharing the cache directory
+                with self._lock:
+                    self.entries.pop(key, None)
+        return self._single_flight(key, lambda: self._fetch_block(url, block_i, key))
+
+    def _evict(self, keep_key=None):
+        with self._lock:
+            total_bytes = self.bytes
+            for key in list(self.entries.keys()):
+                if total_bytes <= self.max_bytes:
+                    break
+                if key == keep_key:
+                    continue
+                total_bytes -= self.entries.pop(key)
+                self.evictions += 1
+                if os.path.exists(os.path.join(self.cache_dir, f'{key}.block')):
+                    os.remove(os.path.join(self.cache_dir, f'{key}.block'))
+
+    def _fetch_index_file(self, url: str) -> bytes:
+        size = self.get_size(url)
+        with self._open(url, 0, size) as response:
+            index = response.read()
+        with self._lock:
+            self.misses += 1
+            self.remote_bytes += len(index)
+            self.index_files[url] = index
+            while sum(len(v) for v in self.index_files.values()) > self.index_max_bytes and len(self.index_files) > 1:
+                self.index_files.popitem(last=False)
+        return index
+
+    def get_index_file(self, url: str) -> bytes:
+        """
+        Returns a whole remote index file, from memory or the remote file
+        """
+        with self._lock:
+            if url in self.index_files:
+                self.hits += 1
+                self.index_files.move_to_end(url)
+                return self.index_files[url]
+        return self._single_flight(('index', url), lambda: self._fetch_index_file(url))
+
+    def iter_range(self, url: str, start: int, length: int):
+        """
+        Yields the bytes of a remote file from start, block by block
+        """
+        if url.endswith(INDEX_EXTENSIONS):
+            yield self.get_index_file(url)[start:start + length]
+            return
+
+        end = start + length
+        for block_i in range(start // self.block_size, (end - 1) // self.block_size + 1 if length > 0 else 0):
+            block = self.get_block(url, block_i)
+            block_start = block_i * self.block_size
+            yield block[max(start - block_start, 0):end - block_start]
+
+
+def set_block_cache(block_cache: BlockCache):
+    """
+    Sets the BlockCache the proxy route reads from
+    """
+    global _block_cache
+    _block_cache = block_cache
+
+
+def get_url_token(url: str) -> str:
+    return hashlib.sha1(url.encode()).hexdigest()[:20]
+
+
+def register_proxy_urls(urls: Iterable) -> int:
+    """
+    Whitelists remote urls (gs://, http://, https://) for the proxy. Local paths and missing values are skipped
+
+    Returns
+    -------
+    int
+        Number of urls registered
+    """
+    n = 0
+    with _proxied_urls_lock:
+        for url in set(urls):
+            if isinstance(url, str) and not is_local_path(url) and url.startswith(('gs://', 'http://', 'https://')):
+                _proxied_urls[get_url_token(url)] = url
+                n += 1
+    return n
+
+
+def get_proxy_url(url: str) -> str:
+    """
+    Proxy url of a whitelisted remote url, relative to the app. Other urls and paths are returned unchanged
+    """
+    token = get_url_token(url) if isinstance(url, str) else None
+    with _proxied_urls_lock:
+        if _block_cache is None or _proxied_urls.get(token) != url:
+            return url
+    name = os.path.basename(urllib.parse.urlparse(url).path)
+    return f'{BLOCK_CACHE_PROXY_ROUTE}/{token}/{name}'
+
+
+def iter_range_first_block(block_cache: BlockCache, url: str, start: int, length: int):
+    """
+    BlockCache.iter_range() with the first block already read, so a RemoteFileError is raised before 
+    the response is started (and answered with an error status) instead of aborting the streamed response
+    """
+    blocks = block_cache.iter_range(url, start, length)
+    first_block = next(blocks, None)
+    return blocks if first_block is None else itertools.chain([first_block], blocks)
+
+
+def serve_proxy_file(token: str, filename: str):
+    """
+    Flask view answering range requests on a whitelisted remote file from the BlockCache.
+    See Serving.BamServer.gen_range_response()
+    """
+    from flask import Response
+
+    with _proxied_urls_lock:
+        url = _proxied_urls.get(token)
+    if url is None or _block_cache is None:
+        return Response('Not found', status=404)
+    try:
+        size = _block_cache.get_size(url)
+        return gen_range_response(
+            size,
+            f'{token}-{size:x}',
+            lambda start, length: iter_range_first_block(_block_cache, url, start, length),
+        )
+    except RemoteFileError as e:
+        return Response(str(e), status=502)
+
+
+def register_block_cache_proxy_route() -> bool:
+    """
+    Adds the proxy route to Dash apps created afterwards (see dash.hooks)
+
+    Returns
+    -------
+    bool
+        Whether the route is available
+    """
+    global _block_cache_proxy_route_registered
+    if _block_cache_proxy_route_registered:
+        return True
+    try:
+        from dash import hooks
+    except ImportError:
+        warnings.warn('The block cache proxy requires dash>=3.0. Remote bam urls are passed to IGV.js unchanged')
+        return False
+    hooks.route(name=f'{BLOCK_CACHE_PROXY_ROUTE}/<token>/<path:filename>', methods=('GET', 'HEAD'))(serve_proxy_file)
+    _block_cache_proxy_route_registered = True
+    return True
@@ -0,0 +1,297 @@
+"""
+Serves a reviewer app from several worker processes, so slow callbacks (ie loading bams into IGV) do not block
+the other reviewers. Workers accept connections from one shared listening socket, and read the mutation, bam and
+precomputed tables from the memory-mapped Feather files of a data store (see DataTypes.DataStore) instead of each
+holding a copy. Annotations are written by a single writer in the main process, which appends them to the
+annotation log and rewrites the data pickle (see Annotations.AnnotationLog); workers sync them from the log.
+"""
+import os
+import pickle
+import socket
+import threading
+import multiprocessing
+import traceback
+from datetime import datetime
+from typing import Dict, Tuple, Union
+from pathlib import Path
+
+from AnnoMate.Data import Data
+from AnnoMate.MetadataHandler import MetadataHandler
+
+from MutationReviewer.Annotations.AnnotationLog import AnnotationLogDataInterface
+from MutationReviewer.DataTypes.DataStore import save_mutation_data, read_data_store_tables, DATA_STORE_TABLES
+
+
+class WorkerDataInterface(AnnotationLogDataInterface):
+    """
+    AnnotationLogDataInterface of a serving worker. Annotations are sent to the AnnotationWriter of the main process
+    instead of being appended to the log directly, annotations made through the other workers are synced from the log
+    every sync_interval seconds, and the data pickle is never rewritten by the worker.
+    """
+    def __init__(
+        self,
+        data_pkl_fn: Union[str, Path],
+        data: Data,
+        mh: MetadataHandler,
+        log_fn: Union[str, Path],
+        writer_conn,
+        reviewer: str = None,
+        sync_interval=1,
+    ):
+        """
+        Parameters
+        ----------
+        data_pkl_fn, data, mh, log_fn, reviewer:
+            See AnnotationLogDataInterface
+
+        writer_conn: multiprocessing.connection.Connection
+            Connection to the AnnotationWriter
+
+        sync_interval: float, default=1
+            Seconds between syncs of the annotations made through the other workers
+        """
+        self.writer_conn = writer_conn
+        self._writer_lock = threading.Lock()
+        super().__init__(
+            data_pkl_fn,
+            data,
+            mh,
+            log_fn,
+            compact_interval=sync_interval,
+            reviewer=reviewer,
+            sync_interval=sync_interval,
+        )
+
+    def save_data(self):
+        # the data pickle is only rewritten by the writer
+        return
+
+    def _compaction_loop(self):
+        while not self._stop_compaction.wait(self.sync_interval):
+            self.replay_log()
+
+    def _write_event(self, data_idx, dictionary: Dict, timestamp: datetime, base_event_id: int) -> Tuple[int, bool]:
+        with self._writer_lock:
+            self.writer_conn.send((data_idx, dictionary, timestamp, base_event_id))
+            status, result = self.writer_conn.recv()
+        if status == 'error':
+            raise RuntimeError(f'Annotation writer failed to save the annotations of {data_idx}:\n{result}')
+        return result
+
+
+class AnnotationWriter:
+    """
+    Single writer of the annotations of all serving workers. Each worker has its own connection, served by a thread;
+    events are appended through the review data interface of the main process, so the log, the annotation tables
+    and the compacted data pickle stay in one process.
+    """
+    def __init__(self, review_data_interface: AnnotationLogDataInterface):
+        self.review_data_interface = review_data_interface
+        self.threads = []
+
+    def add_connection(self, conn):
+        thread = threading.Thread(target=self._serve_connection, args=(conn,), daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def _serve_connection(self, conn):
+        while True:
+            try:
+                data_idx, dictionary, timestamp, base_event_id = conn.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                result = ('ok', self.review_data_interface.append_event(
+                    data_idx, dictionary, timestamp, base_event_id=base_event_id
+                ))
+            except Exception:
+                result = ('error', traceback.format_exc())
+            conn.send(result)
+
+
+def prepare_shared_data(data: Data, store_dir: Union[str, Path]):
+    """
+    Makes sure the tables of data are saved in a data store, and replaces them with their memory-mapped copies,
+    so pickling data with slim_pickle (ie to send it to a worker) leaves them out. See GeneralMutationData.__getstate__
+
+    Parameters
+    ----------
+    data: GeneralMutationData
+        Data object to share
+
+    store_dir: str, Path
+        Directory to save the data store in, if data was not saved to or loaded from one
+    """
+    table_names = DATA_STORE_TABLES + ['mutation_index']
+    data_store_objects = getattr(data, '_data_store_objects', None) or {}
+    saved = getattr(data, 'data_store_dir', None) is not None and all(
+        data_store_objects.get(name) is getattr(data, name) for name in table_names if getattr(data, name) is not None
+    )
+    if not saved:
+        print(f'Saving data store to {store_dir}')
+        save_mutation_data(data, store_dir, slim_pickle=getattr(data, 'slim_pickle', False))
+    # release the in-memory tables of the main process too
+    data._data_store_objects = read_data_store_tables(data.data_store_dir, table_names)
+    data.__dict__.update(data._data_store_objects)
+
+
+def serve_dash_app(app, host='0.0.0.0', port=8050, sock: socket.socket = None, **kwargs):
+    """
+    Serves a Dash app on an already listening socket, without the reloader and debugger
+    """
+    from werkzeug.serving import make_server
+
+    server = make_server(host, port, app.server, threaded=True, fd=None if sock is None else sock.fileno())
+    server.serve_forever()
+
+
+# listening socket of this process if it is a serving worker. See _serve_on_worker_socket()
+_worker_socket = None
+
+def _serve_on_worker_socket(app):
+    # AnnoMate builds the Dash app and runs it in ReviewDataApp.run(), so the app is set up to serve 
+    # on the worker's shared socket when it is created (see dash.hooks). Apps of other processes are unchanged
+    if _worker_socket is not None:
+        sock = _worker_socket
+        app.run = lambda host='0.0.0.0', port=8050, **kwargs: serve_dash_app(app, host, port, sock=sock)
+
+
+def _run_worker(reviewer, worker_i: int, data_pkl: bytes, sock: socket.socket, writer_conn, sync_interval, run_kwargs):
+    from dash import hooks
+    global _worker_socket
+
+    # the parent's log connection was closed before forking and is reopened by the parent only
+    parent_interface = reviewer.review_data_interface
+    # unpickling memory-maps the tables from the data store
+    data = pickle.loads(data_pkl)
+    reviewer.review_data_interface = WorkerDataInterface(
+        parent_interface.data_pkl_fn,
+        data,
+        parent_interface.mh,
+        parent_interface.log.log_fn,
+        writer_conn,
+        reviewer=parent_interface.reviewer,
+        sync_interval=sync_interval,
+    )
+    if getattr(reviewer, 'prefetcher', None) is not None:
+        reviewer.prefetcher.restart()
+
+    _worker_socket = sock
+    if _serve_on_worker_socket not in [hook.func for hook in hooks.get_hooks('setup')]:
+        hooks.setup()(_serve_on_worker_socket)
+    print(f'Worker {worker_i} (pid {os.getpid()}) serving')
+    reviewer.run(mode='external', host=sock.getsockname()[0], port=sock.getsockname()[1], **run_kwargs)
+
+
+def serve_review_workers(
+    reviewer,
+    n_workers=4,
+    host='0.0.0.0',
+    port=8050,
+    data_store_dir: Union[str, Path] = None,
+    sync_interval=1,
+    backlog=128,
+    **run_kwargs
+):
+    """
+    Runs the reviewer app in n_workers processes sharing one port. Blocks until interrupted or all workers exit
+
+    Parameters
+    ----------
+    reviewer: GeneralMutationReviewer
+        Reviewer with the review data and app set (see set_review_data() and set_review_app()),
+        and an annotation log (see set_review_data(annotation_log=True))
+
+    n_workers: int, default=4
+        Number of worker processes
+
+    host: str, default='0.0.0.0'
+        Host address
+
+    port: int, default=8050
+        Port number
+
+    data_store_dir: str, Path
+        Directory to save the data store in if the data was not saved to or loaded from one.
+        Defaults to data_store/ next to the data pickle
+
+    sync_interval: float, default=1
+        Seconds between syncs of annotations between workers
+
+    backlog: int, default=128
+        Number of pending connections of the listening socket
+
+    **run_kwargs:
+        Other arguments for reviewer.run() (ie review_data_table_df)
+    """
+    from werkzeug.serving import select_address_family
+    try:
+        from dash import hooks
+    except ImportError:
+        raise ImportError('Serving workers requires dash>=3.0')
+
+    review_data_interface = reviewer.review_data_interface
+    if not isinstance(review_data_interface, AnnotationLogDataInterface):
+        raise ValueError('Serving workers write annotations to an annotation log. Set annotation_log=True in set_review_data()')
+    data_store_dir = os.path.join(os.path.dirname(str(review_data_interface.data_pkl_fn)), 'data_store') \
+        if data_store_dir is None else data_store_dir
+
+    # the listening socket is inherited by the workers, which accept connections from it in turn
+    sock = socket.socket(select_address_family(host, port), socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    # workers that lose the race for a connection go back to waiting instead of blocking in accept()
+    sock.setblocking(False)
+    sock.set_inheritable(True)
+
+    # workers are forked, so they share the reviewer app without pickling it
+    context = multiprocessing.get_context('fork')
+    workers = []
+    parent_conns = []
+    with review_data_interface._lock, review_data_interface.log._lock:
+        prepare_shared_data(review_data_interface.data, data_store_dir)
+        # workers read the tables from the data store, which exists while they run
+        slim_pickle = review_data_interface.data.slim_pickle
+        review_data_interface.data.slim_pickle = True
+        try:
+            data_pkl = pickle.dumps(review_data_interface.data, protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            review_data_interface.data.slim_pickle = slim_pickle
+        # a SQLite connection must not be used across a fork, so the workers do not inherit an open one
+        review_data_interface.log.close()
+        try:
+            for worker_i in range(n_workers):
+                parent_conn, worker_conn = context.Pipe()
+                worker = context.Process(
+                    target=_run_worker,
+                    args=(reviewer, worker_i, data_pkl, sock, worker_conn, sync_interval, run_kwargs),
+                    daemon=True,
+                )
+                worker.start()
+                worker_conn.close()
+                parent_conns.append(parent_conn)
+                workers.append(worker)
+        finally:
+            review_data_interface.log.reopen()
+    del data_pkl
+
+    # the writer threads are started once all the workers are forked
+    writer = AnnotationWriter(review_data_interface)
+    for parent_conn in parent_conns:
+        writer.add_connection(parent_conn)
+    print(f'Serving {n_workers} workers on http://{host}:{port}')
+
+    try:
+        for worker_i, worker in enumerate(workers):
+            worker.join()
+            print(f'Worker {worker_i} exited with code {worker.exitcode}')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        sock.close()
+        review_data_interface.save_data()
@@ -0,0 +1,74 @@
+"""
+Benchmark of the mutation index construction in GeneralMutationReviewer.gen_data, from 10^4 to 10^7 mutations.
+Compares build_mutation_index() to the previous construction in gen_data, which counted the rows of each group 
+with groupby and joined the values of each group key into its name. 
+The previous construction only built the names. build_mutation_index() also maps each name to its rows.
+
+Usage: python benchmarks/benchmark_mutation_index.py [--max-rows 10000000] [--groupby-cols 4]
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+
+from MutationReviewer.DataTypes.GeneralMutationData import build_mutation_index, gen_mutation_index_name
+
+
+def gen_mutations_df(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    n_samples = max(n_rows // 1000, 1)
+    return pd.DataFrame({
+        'Chromosome': rng.choice([str(c) for c in range(1, 23)] + ['X', 'Y'], n_rows),
+        'Start_position': rng.integers(1, 250_000_000, n_rows),
+        'Reference_Allele': rng.choice(list('ACGT'), n_rows),
+        'Tumor_Seq_Allele2': rng.choice(list('ACGT'), n_rows),
+        'Tumor_Sample_Barcode': rng.integers(0, n_samples, n_rows).astype(str),
+    })
+
+
+def build_mutation_index_groupby_count(mutations_df, mutation_groupby_cols):
+    """
+    Previous construction in gen_data
+    """
+    return [
+        gen_mutation_index_name(list(map(str, idx))) 
+        for idx in mutations_df.groupby(mutation_groupby_cols).count().index
+    ]
+
+
+def time_func(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-rows', type=int, default=10_000_000)
+    parser.add_argument('--max-previous-rows', type=int, default=10_000_000,
+                        help='Largest size the previous construction is run on')
+    parser.add_argument('--groupby-cols', type=int, default=4, choices=[1, 2, 3, 4, 5])
+    args = parser.parse_args()
+
+    results = []
+    n_rows = 10_000
+    while n_rows <= args.max_rows:
+        mutations_df = gen_mutations_df(n_rows)
+        groupby_cols = mutations_df.columns[:args.groupby_cols].tolist()
+        result = {
+            'n_rows': n_rows,
+            'build_mutation_index_s': time_func(build_mutation_index, mutations_df, groupby_cols),
+            'previous_s': time_func(build_mutation_index_groupby_count, mutations_df, groupby_cols)
+            if n_rows <= args.max_previous_rows else np.nan,
+        }
+        results.append(result)
+        print(result, flush=True)
+        n_rows *= 10
+
+    results_df = pd.DataFrame(results)
+    results_df['speedup'] = results_df['previous_s'] / results_df['build_mutation_index_s']
+    print(results_df.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,51 +1,196 @@
 import os
 import argparse
+import gzip
+import hashlib
+import json
+import shutil
+import tempfile
+import urllib.error
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from ftplib import FTP 
+import numpy as np
 import pandas as pd
 import tqdm
 
+from MutationReviewer.ReadData.RegionCache import extract_region_bam
+
+_ftp_sessions = {}
+
+def get_ftp_session(onek_genomes_ftp, ftp_port=21, reconnect=False):
+    # one session per worker process, reused across patients
+    key = (onek_genomes_ftp, ftp_port)
+    if reconnect or key not in _ftp_sessions:
+        ftp = FTP()
+        ftp.connect(onek_genomes_ftp, ftp_port)
+        ftp.login()
+        _ftp_sessions[key] = ftp
+    return _ftp_sessions[key]
+
+def resolve_bam_path(patient_path, onek_genomes_ftp, ftp_port=21):
+    if '*' not in patient_path:
+        return patient_path
+    try:
+        matches = get_ftp_session(onek_genomes_ftp, ftp_port).nlst(patient_path)
+    except (EOFError, OSError):
+        matches = get_ftp_session(onek_genomes_ftp, ftp_port, reconnect=True).nlst(patient_path)
+    if len(matches) == 0:
+        raise FileNotFoundError(f'No file matching {patient_path} on {onek_genomes_ftp}')
+    return matches[0]
+
+def get_file_sha1(path, chunk_size=1024 ** 2):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def parse_region_str(region_str):
+    chrom, _, interval = region_str.rpartition(':')
+    start, _, end = interval.replace(',', '').partition('-')
+    return chrom, int(start), int(end)
+
+def download_patient(
+    patient_id,
+    patient_path,
+    output_bam_path,
+    output_bai_path,
+    region_strs,
+    onek_genomes_ftp,
+    ftp_port=21,
+    bam_url_prefix=None,
+):
+    bam_path = resolve_bam_path(patient_path, onek_genomes_ftp, ftp_port=ftp_port)
+    bam_url_prefix = f"https://{onek_genomes_ftp}/" if bam_url_prefix is None else bam_url_prefix
+    full_bam_path = f"{bam_url_prefix}{bam_path}"
+
+    # paths do not depend on the working directory of the worker process
+    output_bam_path = os.path.abspath(output_bam_path)
+    output_bai_path = os.path.abspath(output_bai_path)
+
+    # htslib saves a remote index in the working directory, so the index is downloaded to a scratch directory first
+    work_dir = tempfile.mkdtemp(prefix=f'.{patient_id}.', dir=os.path.dirname(output_bam_path))
+    try:
+        remote_bai_path = os.path.join(work_dir, f'{patient_id}.remote.bai')
+        try:
+            urllib.request.urlretrieve(f'{full_bam_path}.bai', remote_bai_path)
+        except urllib.error.URLError as e:
+            # url errors hold the open response, which cannot be sent back from the worker process
+            raise FileNotFoundError(f'Could not download {full_bam_path}.bai: {e}') from None
+        # all regions are read in one pass, and written to temporary files renamed when complete
+        extract_region_bam(
+            full_bam_path,
+            [parse_region_str(region_str) for region_str in region_strs],
+            output_bam_path,
+            bai_path=remote_bai_path,
+        )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    os.replace(f'{output_bam_path}.bai', output_bai_path)
+
+    return {
+        'patient_id': patient_id,
+        'original_ftp_path': full_bam_path,
+        'original_ftp_path_bai': f'{full_bam_path}.bai',
+        'local_bam_path': output_bam_path,
+        'local_bai_path': output_bai_path,
+        'local_bam_sha1': get_file_sha1(output_bam_path),
+        'local_bam_bytes': os.path.getsize(output_bam_path),
+        'region_strs': list(region_strs),
+    }
+
+def is_download_complete(entry, region_strs, verify_checksums=False):
+    if entry is None or entry['region_strs'] != list(region_strs):
+        return False
+    if not (os.path.exists(entry['local_bam_path']) and os.path.exists(entry['local_bai_path'])):
+        return False
+    if os.path.getsize(entry['local_bam_path']) != entry['local_bam_bytes']:
+        return False
+    return not verify_checksums or get_file_sha1(entry['local_bam_path']) == entry['local_bam_sha1']
+
+def write_manifest(manifest, manifest_fn):
+    with open(f'{manifest_fn}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(f'{manifest_fn}.tmp', manifest_fn)
+
 def download_genomes(
     patient_ids, # list of patient ids
     output_dir,
     onek_genomes_ftp="ftp.1000genomes.ebi.ac.uk",
     patient_path_str_format="/vol1/ftp/phase3/data/REPLACE/exome_alignment/REPLACE.mapped.ILLUMINA.bwa.GBR.exome.*.bam",
-    region_str="17:7571739-7590808",
+    region_str="17:7571739-7590808", # or a list of regions, extracted into one bam per patient
     replace_str='REPLACE',
-    overwrite=False
+    overwrite=False,
+    n_workers=4, # number of patients downloaded at the same time
+    ftp_port=21,
+    bam_url_prefix=None, # prefix of the bam paths listed on the ftp server, defaults to https://{onek_genomes_ftp}/
+    verify_checksums=False, # recompute the checksums of finished downloads before skipping them
 ):
+    """
+    Downloads the reads in region_str of each patient's bam, a bounded number of patients at a time. 
+    Finished downloads are recorded in output_dir/download_manifest.json with their checksums and skipped 
+    when downloading again, so an interrupted download resumes where it stopped.
+    """
+    output_dir = os.path.abspath(output_dir)
     if not os.path.exists(output_dir):
         print(f"Making output directory: {output_dir}")
-        os.mkdir(output_dir)
-    
-    ftp = FTP(onek_genomes_ftp) 
-    ftp.login() 
-
-    region_str_formatted = region_str.replace(':', '_').replace('-', '_')
-    paths_df = pd.DataFrame(index=patient_ids)
-    for patient_id in tqdm.tqdm(patient_ids, total=len(patient_ids)):
-        bam_path = ftp.nlst(patient_path_str_format.replace(replace_str, patient_id))[0]
-        full_bam_path = f"https://{onek_genomes_ftp}/{bam_path}"
-        
-        output_bam_path = f"{output_dir}/{patient_id}.{region_str_formatted}.bam"
-        output_bai_path = f"{output_bam_path.strip('.bam')}.bai"
-        if (not os.path.exists(output_bam_path)) or overwrite:
-        
-            bam_cmd = f'samtools view -bh "{full_bam_path}" "{region_str}" > {output_bam_path}'
-            os.system(bam_cmd)
-
-            make_new_bai_cmd = f"samtools index {output_bam_path} {output_bai_path}"
-            os.system(make_new_bai_cmd)
-
-            rm_tmp_bai_cmd = f'rm {bam_path.split("/")[-1]}.bai'
-            os.system(rm_tmp_bai_cmd)
-
-        paths_df.loc[patient_id, 'original_ftp_path'] = full_bam_path
-        paths_df.loc[patient_id, 'original_ftp_path_bai'] = f'{full_bam_path}.bai'
-        paths_df.loc[patient_id, 'local_bam_path'] = output_bam_path
-        paths_df.loc[patient_id, 'local_bai_path'] = output_bai_path
+        os.makedirs(output_dir)
+
+    region_strs = [region_str] if isinstance(region_str, str) else list(region_str)
+    region_str_formatted = '.'.join(r.replace(':', '_').replace('-', '_') for r in region_strs)
+
+    manifest_fn = f'{output_dir}/download_manifest.json'
+    manifest = {}
+    if os.path.exists(manifest_fn) and not overwrite:
+        with open(manifest_fn) as f:
+            manifest = json.load(f)
+
+    to_download = [
+        patient_id for patient_id in patient_ids 
+        if not is_download_complete(manifest.get(patient_id), region_strs, verify_checksums=verify_checksums)
+    ]
+    print(f'Downloading {len(to_download)} of {len(patient_ids)} patients')
+
+    errors = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {}
+        for patient_id in to_download:
+            output_bam_path = f"{output_dir}/{patient_id}.{region_str_formatted}.bam"
+            futures[executor.submit(
+                download_patient,
+                patient_id,
+                patient_path_str_format.replace(replace_str, patient_id),
+                output_bam_path,
+                f"{output_bam_path[:-len('.bam')]}.bai",
+                region_strs,
+                onek_genomes_ftp,
+                ftp_port=ftp_port,
+                bam_url_prefix=bam_url_prefix,
+            )] = patient_id
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+            try:
+                manifest[futures[future]] = future.result()
+                write_manifest(manifest, manifest_fn)
+            except Exception as e:
+                errors[futures[future]] = e
+    for patient_id, e in errors.items():
+        print(f'Failed to download {patient_id}: {e}')
+    if len(errors) == len(patient_ids) and len(patient_ids) > 0:
+        raise RuntimeError(f'Failed to download all {len(patient_ids)} patients. See the errors above')
+
+    paths_df = pd.DataFrame.from_records(
+        [manifest[patient_id] for patient_id in patient_ids if patient_id in manifest],
+        columns=['patient_id', 'original_ftp_path', 'original_ftp_path_bai', 'local_bam_path', 'local_bai_path', 'local_bam_sha1'],
+    ).set_index('patient_id')
+    paths_df.index.name = None
 
     paths_fn = f'{output_dir}/1k_genomes_bam_paths.txt'
     paths_df.to_csv(paths_fn, sep='\t')
+    if len(errors) > 0:
+        raise RuntimeError(
+            f'Failed to download {len(errors)} of {len(patient_ids)} patients ({", ".join(errors.keys())}). '
+            f'{paths_df.shape[0]} downloaded patients are listed in {paths_fn}. Rerun to retry the failed patients'
+        )
     return paths_fn
     
 def download_vcf(
@@ -60,23 +205,95 @@ def download_vcf(
     get_header_cmd = f'cat {output_vcf} | grep -v "^##" | head -n1 > {header_fn}'
     os.system(get_header_cmd)
 
-def format_vcf(vcf_path):
-    header_vcf_path = f'{vcf_path}.header.txt'
-    header = pd.read_csv(header_vcf_path, sep='\t')
+VCF_VARIANT_COLS = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT']
+
+def open_vcf(vcf_path):
+    return gzip.open(vcf_path, 'rt') if str(vcf_path).endswith('.gz') else open(vcf_path)
+
+def read_vcf_header(vcf_path):
+    # column names and number of lines before the first variant
+    with open_vcf(vcf_path) as f:
+        for i, line in enumerate(f):
+            if line.startswith('#CHROM'):
+                return line.rstrip('\n').lstrip('#').split('\t'), i + 1
+    raise ValueError(f'No #CHROM header line in {vcf_path}')
+
+def parse_gt_matrix(gt_values):
+    """
+    Number of alternate alleles called in each GT field of a (variants x samples) array of sample fields, as an int8 matrix.
+    Missing alleles ('.') count as reference
+    """
+    gt_values = np.ascontiguousarray(gt_values, dtype='S')
+    width = max(gt_values.dtype.itemsize, 1)
+    chars = gt_values.view(np.uint8).reshape(*gt_values.shape, width)
+    # only the GT subfield, before the first ':'
+    in_gt = np.cumsum(chars == ord(':'), axis=-1) == 0
+    allele_i = np.cumsum((chars == ord('|')) | (chars == ord('/')), axis=-1)
+    # allele indices > 0 are the only ones with a non-zero digit
+    alt_digit = (chars >= ord('1')) & (chars <= ord('9')) & in_gt
+    n_alt = np.zeros(gt_values.shape, dtype=np.int8)
+    for i in range(int(allele_i.max(initial=0)) + 1):
+        n_alt += (alt_digit & (allele_i == i)).any(axis=-1)
+    return n_alt
 
-    vcf_df = pd.read_csv(vcf_path, sep='\t', comment='#', header=None)
-    vcf_df.columns = header.columns.tolist()
+def gen_carriers_df(variants_df, n_alt, patients, patient_major=False):
+    # long form: one row per variant and patient carrying it
+    if patient_major:
+        patient_i, variant_i = np.nonzero(n_alt.T)
+    else:
+        variant_i, patient_i = np.nonzero(n_alt)
+    carriers_df = variants_df.iloc[variant_i].copy()
+    carriers_df['patient_id'] = np.asarray(patients)[patient_i]
+    carriers_df['n_alt_alleles'] = n_alt[variant_i, patient_i]
+    return carriers_df
+
+def iter_vcf_carriers(vcf_path, patients=None, chunksize=1000):
+    """
+    Streams the variants of a (optionally gzipped) vcf chunksize rows at a time, yielding for each chunk a long-form
+    mutations table (VCF_VARIANT_COLS, patient_id, n_alt_alleles) of the patients carrying each variant, 
+    for GeneralMutationReviewer.gen_data(mutations_df_bam_ref_col='patient_id'). 
+    Only the columns of patients (all samples if None) are read.
+    """
+    columns, n_header_lines = read_vcf_header(vcf_path)
+    columns = VCF_VARIANT_COLS + columns[len(VCF_VARIANT_COLS):]
+    patients = columns[len(VCF_VARIANT_COLS):] if patients is None else list(patients)
+    missing_patients = set(patients).difference(columns)
+    if missing_patients:
+        raise ValueError(f'Patients not in {vcf_path}: {sorted(missing_patients)}')
+
+    chunks = pd.read_csv(
+        vcf_path,
+        sep='\t',
+        header=None,
+        names=columns,
+        usecols=VCF_VARIANT_COLS + patients,
+        skiprows=n_header_lines,
+        dtype={**{col: str for col in VCF_VARIANT_COLS + patients}, 'POS': np.int64},
+        chunksize=chunksize,
+    )
+    for chunk in chunks:
+        yield gen_carriers_df(chunk[VCF_VARIANT_COLS], parse_gt_matrix(chunk[patients].to_numpy()), patients)
+
+def read_vcf_carriers(vcf_path, patients=None, chunksize=1000):
+    return pd.concat(
+        iter_vcf_carriers(vcf_path, patients=patients, chunksize=chunksize), 
+        ignore_index=True,
+    )
+
+def format_vcf(vcf_path):
+    columns, n_header_lines = read_vcf_header(vcf_path)
+    vcf_df = pd.read_csv(vcf_path, sep='\t', header=None, names=columns, skiprows=n_header_lines)
     vcf_df = vcf_df.rename(columns={'#CHROM': 'CHROM'})
 
     all_patients = vcf_df.columns[9:]
     return vcf_df, all_patients
 
 def subset_patients_vcf(vcf_df, patients):
-    def _get_patient(patient):
-        filtered_vcf_df = vcf_df[vcf_df[patient].str.contains('1')][vcf_df.columns.tolist()[:9]]
-        filtered_vcf_df['patient_id'] = patient
-        return filtered_vcf_df
-    
-    reformat_patient_vcf_df = pd.concat([_get_patient(p) for p in patients])
-    return reformat_patient_vcf_df
-
+    # grouped by patient, as before. For large vcfs use iter_vcf_carriers() instead of loading the whole vcf
+    patients = list(patients)
+    return gen_carriers_df(
+        vcf_df[vcf_df.columns.tolist()[:9]], 
+        parse_gt_matrix(vcf_df[patients].astype(str).to_numpy()), 
+        patients, 
+        patient_major=True,
+    ).drop(columns='n_alt_alleles')
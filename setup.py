@@ -27,5 +27,9 @@ setuptools.setup(
         'AnnoMate>=1.0.0',
         'firecloud-dalmatian',
         'dash-bio'
-    ]
+    ],
+    extras_require={
+        'reads': ['pysam'],
+        'store': ['pyarrow'],
+    }
 )   
@@ -0,0 +1,196 @@
+"""
+Runs the BlockCache and the proxy route against a local range server standing in for gs:// (see gs_endpoint)
+"""
+import os
+import re
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import pytest
+
+from MutationReviewer.Serving import BlockCacheProxy
+from MutationReviewer.Serving.BlockCacheProxy import BlockCache, register_proxy_urls, get_proxy_url, set_block_cache
+
+
+BLOCK_SIZE = 1000
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves server.files ({path: bytes}) with single byte ranges. Records the Range of each request in
+    server.requests, waits server.delay seconds before answering, and answers server.fail_paths with 500
+    except for the one byte size requests
+    """
+    def do_GET(self):
+        server = self.server
+        data = server.files.get(self.path)
+        byte_range = self.headers.get('Range')
+        with server.lock:
+            server.requests.append((self.path, byte_range))
+        time.sleep(server.delay)
+
+        if data is None:
+            self.send_error(404)
+            return
+        if self.path in server.fail_paths and byte_range != 'bytes=0-0':
+            self.send_error(500)
+            return
+        if byte_range is None:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        start, end = map(int, re.match(r'bytes=(\d+)-(\d+)', byte_range).groups())
+        end = min(end, len(data) - 1)
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(data[start:end + 1])
+
+    def log_message(self, format, *args):
+        return
+
+
+@pytest.fixture
+def range_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+    server.files = {'/bucket/sample.bam': np.random.default_rng(0).bytes(10 * BLOCK_SIZE + 500)}
+    server.requests = []
+    server.lock = threading.Lock()
+    server.delay = 0
+    server.fail_paths = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def gen_block_cache(range_server, cache_dir, **kwargs):
+    return BlockCache(
+        cache_dir,
+        block_size=BLOCK_SIZE,
+        gs_endpoint=f'http://127.0.0.1:{range_server.server_address[1]}',
+        **kwargs
+    )
+
+
+def get_block_requests(range_server):
+    return [byte_range for _, byte_range in range_server.requests if byte_range != 'bytes=0-0']
+
+
+def test_ranges_are_read_from_aligned_blocks(range_server, tmp_path):
+    block_cache = gen_block_cache(range_server, tmp_path)
+    data = range_server.files['/bucket/sample.bam']
+
+    assert block_cache.get_size('gs://bucket/sample.bam') == len(data)
+    assert b''.join(block_cache.iter_range('gs://bucket/sample.bam', 1500, 2000)) == data[1500:3500]
+    assert get_block_requests(range_server) == ['bytes=1000-1999', 'bytes=2000-2999', 'bytes=3000-3999']
+
+    # the last block is cut at the end of the file, and cached blocks are not requested again
+    assert b''.join(block_cache.iter_range('gs://bucket/sample.bam', 2500, len(data) - 2500)) == data[2500:]
+    assert get_block_requests(range_server)[3:] == [
+        f'bytes={i * BLOCK_SIZE}-{min((i + 1) * BLOCK_SIZE, len(data)) - 1}' for i in range(4, 11)
+    ]
+    assert sorted(os.path.getsize(tmp_path / fn) for fn in os.listdir(tmp_path)) == [500] + [BLOCK_SIZE] * 9
+    assert block_cache.stats()['hits'] == 2
+
+
+def test_least_recently_used_blocks_are_evicted(range_server, tmp_path):
+    block_cache = gen_block_cache(range_server, tmp_path, max_bytes=3 * BLOCK_SIZE)
+    url = 'gs://bucket/sample.bam'
+    for block_i in range(3):
+        block_cache.get_block(url, block_i)
+    # block 0 is used again, so block 1 is the least recently used
+    block_cache.get_block(url, 0)
+    block_cache.get_block(url, 3)
+
+    cached_keys = [block_cache.get_block_key(url, block_i) for block_i in [2, 0, 3]]
+    assert list(block_cache.entries.keys()) == cached_keys
+    assert sorted(os.listdir(tmp_path)) == sorted(f'{key}.block' for key in cached_keys)
+    assert block_cache.stats()['bytes'] <= 3 * BLOCK_SIZE
+    assert block_cache.stats()['evictions'] == 1
+
+    # blocks left on disk are loaded by a new cache, and still bounded
+    reloaded_cache = gen_block_cache(range_server, tmp_path, max_bytes=2 * BLOCK_SIZE)
+    assert len(reloaded_cache.entries) == 2 and set(reloaded_cache.entries.keys()) < set(cached_keys)
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def test_concurrent_requests_fetch_a_block_once(range_server, tmp_path):
+    block_cache = gen_block_cache(range_server, tmp_path)
+    url = 'gs://bucket/sample.bam'
+    block_cache.get_size(url)
+    range_server.delay = 0.5
+
+    n_threads = 8
+    blocks = [None] * n_threads
+    barrier = threading.Barrier(n_threads)
+
+    def get_block(i):
+        barrier.wait()
+        blocks[i] = block_cache.get_block(url, 2)
+
+    threads = [threading.Thread(target=get_block, args=(i,)) for i in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(block == range_server.files['/bucket/sample.bam'][2000:3000] for block in blocks)
+    assert get_block_requests(range_server) == ['bytes=2000-2999']
+    assert block_cache.stats()['misses'] == 1
+
+
+@pytest.fixture
+def proxy_client(range_server, tmp_path):
+    from flask import Flask
+
+    app = Flask(__name__)
+    app.add_url_rule(
+        f'/{BlockCacheProxy.BLOCK_CACHE_PROXY_ROUTE}/<token>/<path:filename>',
+        view_func=BlockCacheProxy.serve_proxy_file,
+        methods=['GET', 'HEAD'],
+    )
+    set_block_cache(gen_block_cache(range_server, tmp_path))
+    register_proxy_urls(['gs://bucket/sample.bam', 'gs://bucket/missing.bam'])
+    yield app.test_client()
+    set_block_cache(None)
+
+
+def test_proxy_passes_head_and_range_requests(range_server, proxy_client):
+    data = range_server.files['/bucket/sample.bam']
+    proxy_url = '/' + get_proxy_url('gs://bucket/sample.bam')
+
+    response = proxy_client.head(proxy_url)
+    assert response.status_code == 200
+    assert response.headers['Content-Length'] == str(len(data))
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert get_block_requests(range_server) == []
+
+    response = proxy_client.get(proxy_url, headers={'Range': 'bytes=1500-3499'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 1500-3499/{len(data)}'
+    assert response.data == data[1500:3500]
+
+    response = proxy_client.get(proxy_url, headers={'Range': f'bytes={len(data)}-'})
+    assert response.status_code == 416
+
+    response = proxy_client.get(proxy_url)
+    assert response.status_code == 200
+    assert response.data == data
+
+
+def test_proxy_answers_remote_errors_with_an_error_status(range_server, proxy_client):
+    assert proxy_client.get('/' + get_proxy_url('gs://bucket/missing.bam')).status_code == 502
+    assert proxy_client.get(f'/{BlockCacheProxy.BLOCK_CACHE_PROXY_ROUTE}/0000/unknown.bam').status_code == 404
+
+    # the size is read, but the first block fails before the response is started
+    range_server.fail_paths.add('/bucket/sample.bam')
+    response = proxy_client.get('/' + get_proxy_url('gs://bucket/sample.bam'), headers={'Range': 'bytes=1500-3499'})
+    assert response.status_code == 502
+    assert 'Could not read bytes 1000-1999' in response.get_data(as_text=True)
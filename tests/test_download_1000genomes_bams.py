@@ -0,0 +1,186 @@
+"""
+Runs example_notebooks/download_1000genomes_bams.download_genomes() against small bams served over local HTTP,
+with the FTP listing of the bam paths stubbed
+"""
+import os
+import re
+import sys
+import json
+import fnmatch
+import functools
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import pandas as pd
+import pytest
+
+pysam = pytest.importorskip('pysam')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'example_notebooks'))
+import download_1000genomes_bams
+
+
+PATIENT_IDS = ['HG00096', 'HG00097']
+REGION_STRS = ['17:7572000-7573000', '17:7578000-7579000']
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves the files of a directory with single byte ranges, and counts the requests of each path
+    """
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests[self.path] = self.server.requests.get(self.path, 0) + 1
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match is None:
+            start, end = 0, len(data) - 1
+            self.send_response(200)
+        else:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        self.wfile.write(data[start:end + 1])
+
+    def log_message(self, format, *args):
+        return
+
+
+class StubFTP:
+    """
+    FTP session listing a fixed set of paths
+    """
+    def __init__(self, paths):
+        self.paths = paths
+
+    def nlst(self, pattern):
+        return [path for path in self.paths if fnmatch.fnmatch(path, pattern)]
+
+
+def write_bam(bam_path, seed):
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': '17', 'LN': 8_000_000}]}
+    with pysam.AlignmentFile(bam_path, 'wb', header=header) as bam:
+        for i, pos in enumerate(range(7_570_000, 7_581_000, 50)):
+            read = pysam.AlignedSegment()
+            read.query_name = f'read_{seed}_{i}'
+            read.reference_id = 0
+            read.reference_start = pos + seed
+            read.query_sequence = 'ACGT' * 25
+            read.cigarstring = '100M'
+            read.mapping_quality = 60
+            read.query_qualities = pysam.qualitystring_to_array('I' * 100)
+            bam.write(read)
+    pysam.index(bam_path)
+
+
+@pytest.fixture
+def bam_server(tmp_path, monkeypatch):
+    remote_dir = tmp_path / 'remote'
+    remote_paths = []
+    for seed, patient_id in enumerate(PATIENT_IDS):
+        os.makedirs(remote_dir / patient_id)
+        remote_path = f'/{patient_id}/{patient_id}.mapped.ILLUMINA.bwa.GBR.exome.20120522.bam'
+        write_bam(str(remote_dir) + remote_path, seed)
+        remote_paths.append(remote_path)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(RangeRequestHandler, directory=str(remote_dir)))
+    server.requests = {}
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    # worker processes are forked, so they inherit the stubbed session
+    monkeypatch.setitem(download_1000genomes_bams._ftp_sessions, ('127.0.0.1', 21), StubFTP(remote_paths))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def download_genomes(bam_server, output_dir, patient_ids=PATIENT_IDS, **kwargs):
+    return download_1000genomes_bams.download_genomes(
+        patient_ids,
+        str(output_dir),
+        onek_genomes_ftp='127.0.0.1',
+        patient_path_str_format='/REPLACE/REPLACE.mapped.ILLUMINA.bwa.GBR.exome.*.bam',
+        region_str=REGION_STRS,
+        bam_url_prefix=f'http://127.0.0.1:{bam_server.server_address[1]}',
+        n_workers=2,
+        **kwargs
+    )
+
+
+def count_bam_requests(bam_server, patient_id):
+    return sum(n for path, n in bam_server.requests.items() if path.startswith(f'/{patient_id}/'))
+
+
+def test_downloads_regions_and_resumes_from_manifest(bam_server, tmp_path):
+    output_dir = tmp_path / 'output'
+    paths_df = pd.read_csv(download_genomes(bam_server, output_dir), sep='\t', index_col=0)
+    assert paths_df.index.tolist() == PATIENT_IDS
+    for patient_id, r in paths_df.iterrows():
+        with pysam.AlignmentFile(r['local_bam_path'], index_filename=r['local_bai_path']) as bam:
+            assert bam.count('17', 7_572_000, 7_573_000) > 0
+            assert bam.count('17', 7_575_000, 7_576_000) == 0
+        assert r['original_ftp_path'].endswith(f'/{patient_id}/{patient_id}.mapped.ILLUMINA.bwa.GBR.exome.20120522.bam')
+    # remote indices are downloaded to scratch directories, which are removed
+    assert sorted(os.listdir(output_dir)) == sorted(
+        ['download_manifest.json', '1k_genomes_bam_paths.txt'] +
+        [os.path.basename(path) for path in paths_df[['local_bam_path', 'local_bai_path']].to_numpy().ravel()]
+    )
+
+    # finished patients are skipped. A deleted bam is downloaded again
+    n_requests = {patient_id: count_bam_requests(bam_server, patient_id) for patient_id in PATIENT_IDS}
+    os.remove(paths_df.loc['HG00097', 'local_bam_path'])
+    download_genomes(bam_server, output_dir)
+    assert count_bam_requests(bam_server, 'HG00096') == n_requests['HG00096']
+    assert count_bam_requests(bam_server, 'HG00097') > n_requests['HG00097']
+    assert os.path.exists(paths_df.loc['HG00097', 'local_bam_path'])
+
+    # the manifest records the regions of each download, so other regions are downloaded again
+    with open(output_dir / 'download_manifest.json') as f:
+        manifest = json.load(f)
+    assert all(manifest[patient_id]['region_strs'] == REGION_STRS for patient_id in PATIENT_IDS)
+
+
+def test_checksums_are_verified_on_request(bam_server, tmp_path):
+    output_dir = tmp_path / 'output'
+    paths_df = pd.read_csv(download_genomes(bam_server, output_dir), sep='\t', index_col=0)
+    bam_path = paths_df.loc['HG00096', 'local_bam_path']
+    with open(bam_path, 'rb') as f:
+        bam_bytes = f.read()
+    # same size, different content
+    with open(bam_path, 'wb') as f:
+        f.write(bytes(len(bam_bytes)))
+
+    n_requests = count_bam_requests(bam_server, 'HG00096')
+    download_genomes(bam_server, output_dir)
+    assert count_bam_requests(bam_server, 'HG00096') == n_requests
+
+    download_genomes(bam_server, output_dir, verify_checksums=True)
+    assert count_bam_requests(bam_server, 'HG00096') > n_requests
+    assert download_1000genomes_bams.get_file_sha1(bam_path) == paths_df.loc['HG00096', 'local_bam_sha1']
+
+
+def test_failed_patients_raise_after_the_others_are_saved(bam_server, tmp_path):
+    output_dir = tmp_path / 'output'
+    with pytest.raises(RuntimeError, match=r'Failed to download 1 of 3 patients \(HGMISSING\)'):
+        download_genomes(bam_server, output_dir, patient_ids=PATIENT_IDS + ['HGMISSING'])
+
+    paths_df = pd.read_csv(output_dir / '1k_genomes_bam_paths.txt', sep='\t', index_col=0)
+    assert paths_df.index.tolist() == PATIENT_IDS
+    with open(output_dir / 'download_manifest.json') as f:
+        assert sorted(json.load(f).keys()) == PATIENT_IDS
+
+    # rerunning only retries the failed patient
+    n_requests = {patient_id: count_bam_requests(bam_server, patient_id) for patient_id in PATIENT_IDS}
+    with pytest.raises(RuntimeError, match='Failed to download all 1 patients'):
+        download_genomes(bam_server, output_dir, patient_ids=['HGMISSING'])
+    assert {patient_id: count_bam_requests(bam_server, patient_id) for patient_id in PATIENT_IDS} == n_requests
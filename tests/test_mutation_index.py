@@ -0,0 +1,97 @@
+"""
+Compares build_mutation_index() to the previous construction of the mutation index in gen_data, 
+which grouped mutations_df with groupby and named each group from the string values of its key, 
+and to the baseline row lookup of the app components, which matched the names built from each row's string values.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from MutationReviewer.DataTypes.GeneralMutationData import build_mutation_index, gen_mutation_index_name
+
+
+def build_mutation_index_groupby(mutations_df, mutation_groupby_cols, gen_data_mut_index_name_func=gen_mutation_index_name):
+    """
+    Previous construction: names of the sorted groupby keys, and the row positions of each group
+    """
+    mutation_index = {}
+    for key, positions in mutations_df.reset_index(drop=True).groupby(mutation_groupby_cols, sort=True).indices.items():
+        key = key if isinstance(key, tuple) else (key,)
+        name = gen_data_mut_index_name_func(list(map(str, key)))
+        mutation_index[name] = np.sort(np.concatenate([mutation_index.get(name, []), positions]).astype(np.int64))
+    return mutation_index
+
+
+def get_row_names(mutations_df, mutation_groupby_cols):
+    """
+    Baseline row lookup: the name of each row from its string values
+    """
+    return mutations_df[mutation_groupby_cols].apply(
+        lambda r: gen_mutation_index_name(r.astype(str).tolist()), axis=1
+    ).to_numpy()
+
+
+def gen_mutations_df(n_rows=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'Chromosome': rng.choice([str(c) for c in range(1, 23)] + ['X', 'Y'], n_rows),
+        'Start_position': rng.integers(1, 2000, n_rows),
+        'Reference_Allele': rng.choice(list('ACGT'), n_rows),
+        'Tumor_Seq_Allele2': rng.choice(list('ACGT'), n_rows),
+        'Tumor_Sample_Barcode': rng.choice(['sample_a', 'sample_b', 'sample_c'], n_rows),
+    })
+
+
+def assert_same_index(mutation_index, expected):
+    assert mutation_index.keys() == list(expected.keys())
+    for name, positions in expected.items():
+        np.testing.assert_array_equal(np.sort(mutation_index.get(name)), positions)
+
+
+@pytest.mark.parametrize('mutation_groupby_cols', [
+    ['Chromosome', 'Start_position'],
+    ['Chromosome', 'Start_position', 'Reference_Allele', 'Tumor_Seq_Allele2'],
+    ['Tumor_Sample_Barcode', 'Chromosome', 'Start_position', 'Reference_Allele', 'Tumor_Seq_Allele2'],
+])
+def test_matches_groupby(mutation_groupby_cols):
+    mutations_df = gen_mutations_df()
+    expected = build_mutation_index_groupby(mutations_df, mutation_groupby_cols)
+    assert_same_index(build_mutation_index(mutations_df, mutation_groupby_cols), expected)
+
+
+def test_matches_row_lookup():
+    mutations_df = gen_mutations_df()
+    mutation_groupby_cols = ['Chromosome', 'Start_position', 'Reference_Allele', 'Tumor_Seq_Allele2']
+    mutation_index = build_mutation_index(mutations_df, mutation_groupby_cols)
+    row_names = get_row_names(mutations_df, mutation_groupby_cols)
+    assert sorted(mutation_index.keys()) == sorted(set(row_names))
+    for name in mutation_index.keys():
+        np.testing.assert_array_equal(np.sort(mutation_index.get(name)), np.flatnonzero(row_names == name))
+
+
+def test_custom_name_func_merges_groups():
+    mutations_df = gen_mutations_df()
+    mutation_groupby_cols = ['Chromosome', 'Start_position', 'Tumor_Sample_Barcode']
+    name_func = lambda values: ':'.join(values[:2])
+    expected = build_mutation_index_groupby(mutations_df, mutation_groupby_cols, name_func)
+    assert_same_index(build_mutation_index(mutations_df, mutation_groupby_cols, name_func), expected)
+
+
+def test_numeric_keys_are_ordered_by_value():
+    mutations_df = pd.DataFrame({'Chromosome': [10, 2, 1, 2], 'Start_position': [5, 1000, 900, 900]})
+    mutation_groupby_cols = ['Chromosome', 'Start_position']
+    mutation_index = build_mutation_index(mutations_df, mutation_groupby_cols)
+    assert mutation_index.keys() == ['1:900', '2:900', '2:1000', '10:5']
+    assert_same_index(mutation_index, build_mutation_index_groupby(mutations_df, mutation_groupby_cols))
+
+
+def test_missing_keys_are_left_out():
+    mutations_df = pd.DataFrame({
+        'Chromosome': pd.Series(['1', None, '2', '1'], dtype=object),
+        'Start_position': [100, 100, np.nan, 200],
+    })
+    mutation_groupby_cols = ['Chromosome', 'Start_position']
+    mutation_index = build_mutation_index(mutations_df, mutation_groupby_cols)
+    assert mutation_index.keys() == ['1:100.0', '1:200.0']
+    assert_same_index(mutation_index, build_mutation_index_groupby(mutations_df, mutation_groupby_cols))
+    assert mutation_index.get('nan:100.0') is None